@@ -1,106 +1,498 @@
-from transformers import AutoTokenizer, T5ForConditionalGeneration
-# from Parsivar.normalizer import Normalizer
-from Parsivar.Parsivar.normalizer import Normalizer
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from normalizer import Normalizer, STRIP_DIACRITICS
+from cache import checkpoint_fingerprint, dictionary_fingerprint
+from decoding import is_repeating
+from segmenter import split_text, join_chunks
+from rule_engine import apply_rules, apply_rules_batch, spell_out, has_ezafe, add_ezafe
+from startup import timed
+from byte_tokenizer import load_tokenizer
+from instrument import stage, PeakMemory, NO_STAGE, SamplingProfiler
 
 class GE2PE():
 
-    def __init__(self, model_path = './content/checkpoint-320', GPU = False, dictionary = None):
+    def __init__(self, model_path = './content/checkpoint-320', GPU = False, dictionary = None, cache = None,
+                 max_length_ratio = 3.0, max_length_slack = 8, repeat_window = 24, precision = 'fp32', backend = 'torch',
+                 normalizer = 'native'):
         """ 
         model_path: path to where the GE2PE transformer is saved.
         GPU: boolean indicating use of GPU in generation.
-        dictionary: a dictionary for self-defined words.
+        dictionary: a dictionary for self-defined words; a lexicon_store.Lexicon serves large compiled lexicons
+                    from a memory-mapped file.
+        cache: optional GE2PECache (from cache.py) used to reuse outputs of previously seen sentences.
+        max_length_ratio, max_length_slack: each row may decode at most ratio * graphemes + slack tokens (never more than 512).
+        repeat_window: a row whose last repeat_window tokens are one short pattern repeated over and over is stopped
+                       (None disables the repetition guard).
+        precision: 'fp32', 'bf16' or 'int8' (dynamic quantization of the linear layers, CPU only); the converted
+                   artifact is written next to the checkpoint on first use (see quantize.py).
+        backend: 'torch' for HuggingFace generate, or 'onnx' to run beam search over ONNX Runtime sessions
+                 (exported next to the checkpoint on first use, see onnx_backend.py); serving an exported model
+                 with it imports neither torch nor transformers, since ByT5 checkpoints are tokenized by
+                 byte_tokenizer.py.
+        normalizer: 'native' for the built-in normalizer (normalizer.py, same output without importing Parsivar),
+                    or 'parsivar' for the bundled Parsivar normalizer.
         """
         
         self.GPU = GPU
-        self.model = T5ForConditionalGeneration.from_pretrained(model_path)
-        if self.GPU:
-            self.model = self.model.cuda()
-        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model_path = model_path
+        self.cache = cache
+        self.model_fingerprint = checkpoint_fingerprint(model_path) if cache is not None else None
+        self.precision = precision
+        self.backend_name = backend
+        # seconds spent in each part of loading, reported by startup.py
+        self.load_times = {}
+        # heavy modules are imported here rather than at module level, and the backends lazily so that
+        # serving with onnx does not pull in torch
+        with timed(self.load_times, 'imports'):
+            if backend == 'onnx':
+                from onnx_backend import OnnxBackend as Backend
+            elif backend == 'torch':
+                from torch_backend import TorchBackend as Backend
+            else:
+                raise ValueError(f"backend must be 'torch' or 'onnx', got '{backend}'")
+        with timed(self.load_times, 'weights'):
+            self.backend = Backend(model_path, GPU) if backend == 'onnx' else Backend(model_path, precision, GPU)
+        self.model = getattr(self.backend, 'model', None)
+        with timed(self.load_times, 'tokenizer'):
+            self.tokenizer = load_tokenizer(model_path)
         self.dictionary = dictionary
-        self.norma = Normalizer(pinglish_conversion_needed=True)
-    
+        with timed(self.load_times, 'normalizer'):
+            if normalizer == 'parsivar':
+                from Parsivar.Parsivar.normalizer import Normalizer as ParsivarNormalizer
+                self.norma = ParsivarNormalizer(pinglish_conversion_needed=True)
+            elif normalizer == 'native':
+                self.norma = Normalizer(pinglish_conversion_needed=True)
+            else:
+                raise ValueError(f"normalizer must be 'native' or 'parsivar', got '{normalizer}'")
+        self.batch_stats = {}
+        self.max_length_ratio = max_length_ratio
+        self.max_length_slack = max_length_slack
+        self.repeat_window = repeat_window
+        self.decode_stats = {'rows': 0, 'length_cap_hits': 0, 'repetition_stops': 0}
+        # seconds per input character of every beam width, learned while decoding, to plan under a deadline
+        self.decode_rates = {}
+        self.degrade_stats = {'requests': 0, 'degraded_requests': 0, 'sentences': 0, 'degraded_sentences': 0,
+                              'strategies': {'narrow_beam': 0, 'greedy': 0, 'lexicon': 0, 'cut': 0}}
+        self.last_degraded = []
+        self.hooks = []
+        self.profiler = None
+
+    def add_hook(self, hook):
+        """
+        hook: callable receiving one record per generate call: {'inputs', 'stages', 'batches'}, where stages maps
+              normalize, lookup, tokenize, lexicon, rules and store to {'wall', 'cpu'} seconds, and every batch is
+              {'batch_size', 'real_tokens', 'padded_tokens', 'decode_steps', 'peak_memory_mb', 'stages'} with
+              pad, beam_search and detokenize stages; peak_memory_mb is the peak while the batch decoded (see
+              instrument.PeakMemory). nothing is measured while no hook is attached.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @contextmanager
+    def instrument(self, hook):
+        """ attaches hook for the duration of a with block. """
+        self.add_hook(hook)
+        try:
+            yield hook
+        finally:
+            self.remove_hook(hook)
+
+    def profile(self, path, calls = 10, interval = 0.005):
+        """
+        samples the stack of the next calls generate calls every interval seconds and writes a flamegraph
+        to path (.svg) or folded stacks for flamegraph.pl / speedscope (any other extension).
+        """
+        self.profiler = SamplingProfiler(path, calls, interval)
+        return self.profiler
+
     def is_vowel(self, char):
         return (char in ['a', '/', 'i', 'e', 'u', 'o'])
    
     def rules(self, grapheme, phoneme):
-        grapheme = grapheme.replace('آ', 'ءا')
-        words = grapheme.split(' ')
-        prons = phoneme.replace('1', '').split(' ')
-        if len(words) != len(prons):
-            return phoneme
-        for i in range(len(words)):
-            if 'ِ' not in words[i] and  'ُ' not in words[i] and 'َ' not in words[i]:
-                continue
-            for j in range(len(words[i])):
-                if words[i][j] == 'َ':
-                    if j == len(words[i]) - 1 and prons[i][-1] != '/':
-                        prons[i] = prons[i] + '/'
-                    elif self.is_vowel(prons[i][j]):
-                        prons[i] = prons[i][:j] + '/' + prons[i][j+1:]
-                    else:
-                        prons[i] = prons[i][:j] + '/' + prons[i][j:]
-                if words[i][j] == 'ِ':
-                    if j == len(words[i]) - 1 and prons[i][-1] != 'e':
-                        prons[i] = prons[i] + 'e'
-                    elif self.is_vowel(prons[i][j]):
-                        prons[i] = prons[i][:j] + 'e' + prons[i][j+1:]
-                    else:
-                        prons[i] = prons[i][:j] + 'e' + prons[i][j:]
-                if words[i][j] == 'ُ':
-                    if j == len(words[i]) - 1 and prons[i][-1] != 'o':
-                        prons[i] = prons[i] + 'o'
-                    elif self.is_vowel(prons[i][j]):
-                        prons[i] = prons[i][:j] + 'o' + prons[i][j+1:]
-                    else:
-                        prons[i] = prons[i][:j] + 'o' + prons[i][j:]
-        return ' '.join(prons)
+        return apply_rules(grapheme, phoneme)
 
-    def lexicon(self, grapheme, phoneme):
+    def lexicon(self, grapheme, phoneme, dictionary = None):
+        dictionary = self.dictionary if dictionary is None else dictionary
+        if dictionary is None:
+            return phoneme
         words = grapheme.split(' ')
         prons = phoneme.split(' ')
         output = prons
-        for i in range(len(words)):
-            try:
-                output[i] = self.dictionary[words[i]]
-                if prons[i][-1] == '1' and output[i][-1] != 'e':
-                    output[i] = output[i] + 'e1'
-                elif prons[i][-1] == '1' and output[i][-1] == 'e':
-                    output[i] = output[i] + 'ye1'
-            except:
-              pass
+        for i in range(min(len(words), len(prons))):
+            entry = dictionary.get(words[i])
+            if entry is None:
+                continue
+            output[i] = entry
+            if has_ezafe(prons[i]):
+                output[i] = add_ezafe(output[i])
         return ' '.join(output)
 
-    def generate(self, input_list, batch_size = 10, use_rules = False, use_dict = False):
+    def normalize(self, text):
+        return self.norma.normalize(text).replace('ك', 'ک')
+
+    def generate(self, input_list, batch_size = 10, use_rules = False, use_dict = False, num_beams = 5, max_tokens = None,
+                 segment = False, max_chunk_chars = 200, dictionary = None, deadline = None):
         """
         input_list: list of sentences to be phonemized.
         batch_size: inference batch_size
+        max_tokens: if given, inputs are sorted by tokenized length and grouped so that each batch holds at most
+                    max_tokens padded tokens (batch_size is then only an upper bound on the rows per batch).
         use_rules: boolean indicating the use of rules to apply short vowels.
         use_dict: boolean indicating the use of self-defined dictionary.
+        num_beams: beam width of the T5 decoder.
+        segment: boolean indicating that long inputs are split at sentence and clause punctuation (and at spaces
+                 beyond max_chunk_chars characters); the chunks of all inputs are decoded as one batch and rejoined
+                 with the original punctuation and spacing.
+        dictionary: overrides the dictionary of this GE2PE for this call only, e.g. lexicon.overlay(custom_words); with a
+                    cache it must have a fingerprint() like Lexicon and LexiconOverlay.
+        deadline: seconds this call may take. Every batch is decoded with the widest of num_beams, half of it and
+                  greedy search expected to finish within its share of the time left (see decode_rates, seeded by
+                  startup.Warmup), or not at all when none is; decoding
+                  stops when the time is up, and the words left undecoded are taken from the dictionary or spelled
+                  out letter by letter. last_degraded then flags the outputs below num_beams quality, which are
+                  not cached, and degrade_stats counts them.
         returns the list of phonemized sentences.
         """
         
-        output_list = []
-        input_list = [self.norma.normalize(text).replace('ك', 'ک') for text in input_list]
-        input = input_list
-        input_list = [text.replace('ِ', '').replace('ُ', '').replace('َ', '') for text in input_list]
-        for i in range(0,len(input_list),batch_size):
-            in_ids = self.tokenizer(input_list[i:i+batch_size], padding=True,add_special_tokens=False, return_attention_mask=True,return_tensors='pt')
-            if self.GPU:
-                out_ids = self.model.generate(in_ids["input_ids"].cuda(), attention_mask=in_ids["attention_mask"].cuda(), num_beams=5,
-                                        min_length= 1, max_length=512, early_stopping=True,)
-            else:
-                out_ids = self.model.generate(in_ids["input_ids"], attention_mask=in_ids["attention_mask"], num_beams=5,
-                                        min_length= 1, max_length=512, early_stopping=True,)
-            output_list += self.tokenizer.batch_decode(out_ids, skip_special_tokens=True)
-        
-        
-        if use_dict:
-            for i in range(len(input_list)):
-                output_list[i] = self.lexicon(input_list[i], output_list[i])
+        if segment:
+            pieces = [split_text(text, max_chunk_chars) for text in input_list]
+            outputs = iter(self.generate([chunk for chunks, glue in pieces for chunk in chunks], batch_size, use_rules,
+                                         use_dict, num_beams, max_tokens, dictionary=dictionary, deadline=deadline))
+            degraded = iter(self.last_degraded)
+            output_list = [join_chunks([next(outputs) for _ in chunks], glue) for chunks, glue in pieces]
+            self.last_degraded = [any([next(degraded) for _ in chunks]) for chunks, glue in pieces]
+            return output_list
 
-        if use_rules:
-            for i in range(len(input_list)):
-                output_list[i] = self.rules(input[i], output_list[i])
+        expires = None if deadline is None else time.monotonic() + deadline
 
-        output_list = [i.strip() for i in output_list]
+        trace = {'inputs': len(input_list), 'stages': {}, 'batches': []} if self.hooks else None
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
+        try:
+            with stage(trace, 'normalize'):
+                input_list = [self.normalize(text) for text in input_list]
+            with stage(trace, 'lookup'):
+                keys, found, todo = self._lookup(input_list, use_rules, use_dict, num_beams, dictionary)
+            strategies = [None] * len(todo)
+            outputs = self._generate(list(todo.values()), batch_size, use_rules, use_dict, num_beams, max_tokens, dictionary,
+                                     trace, expires, strategies)
+            degraded = {key for key, strategy in zip(todo, strategies) if strategy is not None}
+            with stage(trace, 'store'):
+                output_list = self._store(keys, found, todo, outputs, degraded)
+        finally:
+            if profiler is not None and profiler.stop():
+                self.profiler = None
+        self.last_degraded = [key in degraded for key in keys]
+        if deadline is not None:
+            self._count_degraded(keys, degraded, dict(zip(todo, strategies)))
+        if trace is not None:
+            for hook in list(self.hooks):
+                hook(trace)
         return output_list
+
+    def generate_iter(self, iterable, batch_size = 10, use_rules = False, use_dict = False, num_beams = 5, prefetch = True,
+                      max_tokens = None, dictionary = None, deadline = None):
+        """
+        iterable: any iterable of sentences, e.g. an open file (trailing newlines are dropped).
+        batch_size: number of sentences read, decoded and yielded at a time.
+        use_rules, use_dict, num_beams, max_tokens, dictionary: as in generate.
+        prefetch: boolean indicating that the next batch is normalized and tokenized on a helper thread
+                  while the current one is decoding.
+        deadline: seconds each batch may take once its decoding starts, degrading as in generate; last_degraded
+                  flags the outputs of the batch yielded last.
+        yields (index, phonemes) pairs in input order, batch by batch, so memory stays bounded by batch_size.
+        """
+
+        def read():
+            chunk = []
+            for text in iterable:
+                chunk.append(text.rstrip('\r\n'))
+                if len(chunk) == batch_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        def prepare(chunk):
+            normalized = [self.normalize(text) for text in chunk]
+            keys, found, todo = self._lookup(normalized, use_rules, use_dict, num_beams, dictionary)
+            return keys, found, todo, self._prepare(list(todo.values()))
+
+        chunks = read()
+        index = 0
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            submit = pool.submit if prefetch else (lambda fn, arg: _Done(fn(arg)))
+            chunk = next(chunks, None)
+            pending = submit(prepare, chunk) if chunk is not None else None
+            while pending is not None:
+                keys, found, todo, prepared = pending.result()
+                chunk = next(chunks, None)
+                pending = submit(prepare, chunk) if chunk is not None else None
+                expires = None if deadline is None else time.monotonic() + deadline
+                strategies = [None] * len(todo)
+                outputs = self._generate(list(todo.values()), batch_size, use_rules, use_dict, num_beams, max_tokens,
+                                         dictionary, None, expires, strategies, prepared)
+                degraded = {key for key, strategy in zip(todo, strategies) if strategy is not None}
+                self.last_degraded = [key in degraded for key in keys]
+                if deadline is not None:
+                    self._count_degraded(keys, degraded, dict(zip(todo, strategies)))
+                for output in self._store(keys, found, todo, outputs, degraded):
+                    yield index, output
+                    index += 1
+
+    def _lookup(self, input_list, use_rules, use_dict, num_beams, dictionary = None):
+        """
+        splits normalized inputs into cached outputs and the unique sentences that still need decoding.
+        returns (keys, found, todo); without a cache every input is its own key and nothing is found.
+        """
+        if self.cache is None:
+            keys = list(range(len(input_list)))
+            return keys, {}, dict(zip(keys, input_list))
+        if use_dict and dictionary is not None and not hasattr(dictionary, 'fingerprint'):
+            # a per-call dictionary usually extends a large lexicon; as an overlay only its own entries are hashed
+            raise ValueError('with a cache, a per-call dictionary needs a fingerprint(): pass a Lexicon or an overlay '
+                             'such as lexicon_store.LexiconOverlay(g2p.dictionary, words)')
+        settings = [self.model_path, self.model_fingerprint, self.precision, self.backend_name, use_rules, num_beams,
+                    self.max_length_ratio, self.max_length_slack, self.repeat_window,
+                    dictionary_fingerprint(self.dictionary if dictionary is None else dictionary) if use_dict else None]
+        keys = [self.cache.make_key(text, *settings) for text in input_list]
+        found = self.cache.get_many(keys)
+        todo = {}
+        for key, text in zip(keys, input_list):
+            if key not in found and key not in todo:
+                todo[key] = text
+        return keys, found, todo
+
+    def _store(self, keys, found, todo, outputs, uncached = ()):
+        """ uncached: keys whose outputs are returned but not cached, such as degraded ones. """
+        computed = dict(zip(todo.keys(), outputs))
+        if self.cache is not None:
+            self.cache.set_many({key: output for key, output in computed.items() if key not in uncached})
+        found.update(computed)
+        return [found[key] for key in keys]
+
+    def plan_batches(self, lengths, batch_size, max_tokens = None):
+        """
+        lengths: tokenized length of every input.
+        returns a list of batches, each a list of input indices.
+        without max_tokens inputs are cut into batch_size chunks in arrival order; with it they are sorted by
+        length and a batch is closed as soon as adding the next input would exceed max_tokens padded tokens.
+        """
+        if max_tokens is None:
+            return [list(range(i, min(i + batch_size, len(lengths)))) for i in range(0, len(lengths), batch_size)]
+        batches = []
+        batch = []
+        longest = 0
+        for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            width = max(longest, lengths[index], 1)
+            if batch and (width * (len(batch) + 1) > max_tokens or len(batch) >= batch_size):
+                batches.append(batch)
+                batch = []
+                width = max(lengths[index], 1)
+            batch.append(index)
+            longest = width
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _prepare(self, input_list):
+        """
+        strips short-vowel diacritics (they are re-applied by rules) and tokenizes without padding.
+        returns (stripped sentences, token id lists).
+        """
+        stripped = [text.translate(STRIP_DIACRITICS) for text in input_list]
+        if not stripped:
+            return stripped, []
+        return stripped, self.tokenizer(stripped, add_special_tokens=False)["input_ids"]
+
+    def decode_limits(self, grapheme_lengths):
+        """
+        grapheme_lengths: number of characters of every (diacritic-free) input in a batch.
+        returns the maximum number of output tokens each row may decode; phoneme length closely follows grapheme length.
+        """
+        return [min(511, int(n * self.max_length_ratio) + self.max_length_slack) for n in grapheme_lengths]
+
+    def _decode(self, token_ids, num_beams, grapheme_lengths, record = None, expires = None, ended = None):
+        """
+        expires: time.monotonic() value at which the backend stops decoding.
+        ended: optional list receiving, for every row, whether it decoded up to eos.
+        """
+        with stage(record, 'pad'):
+            in_ids = self.tokenizer.pad({"input_ids": token_ids}, padding=True, return_attention_mask=True, return_tensors=self.backend.tensor_type)
+            limits = self.decode_limits(grapheme_lengths)
+        memory = PeakMemory(self.GPU) if record is not None else NO_STAGE
+        with stage(record, 'beam_search'), memory:
+            out_ids = self.backend.generate(in_ids["input_ids"], in_ids["attention_mask"], num_beams, limits, self.repeat_window,
+                                            expires)
+        with stage(record, 'detokenize'):
+            finished = self._count_limits(out_ids, limits)
+            if ended is not None:
+                ended.extend(finished)
+            output_list = self.tokenizer.batch_decode(out_ids, skip_special_tokens=True)
+        if record is not None:
+            record['decode_steps'] = int(out_ids.shape[1]) - 1
+            record['peak_memory_mb'] = memory.peak_mb
+        return output_list
+
+    def _count_limits(self, out_ids, limits):
+        # finished rows are filled up with eos/pad, so the real length is up to the first of them
+        ends = (self.tokenizer.eos_token_id, self.tokenizer.pad_token_id)
+        finished = []
+        for row, limit in zip(out_ids.tolist(), limits):
+            generated = row[1:]
+            finished.append(self.tokenizer.eos_token_id in generated)
+            for k, token in enumerate(generated):
+                if token in ends:
+                    generated = generated[:k]
+                    break
+            self.decode_stats['rows'] += 1
+            if len(generated) >= limit:
+                self.decode_stats['length_cap_hits'] += 1
+            elif self.repeat_window is not None and is_repeating(generated, self.repeat_window):
+                self.decode_stats['repetition_stops'] += 1
+        return finished
+
+    def _strategy(self, num_beams, chars, batches, expires):
+        """
+        chars: input characters of the batch about to be decoded; batches: batches left, this one included;
+        expires: time.monotonic() value they all have to be done by.
+        returns the widest of num_beams, num_beams // 2 and 1 beams expected to decode this batch within its share
+        of the time left, or 0 when only the lexicon fallback does. a width not timed yet is estimated from the
+        nearest timed one (a wider width bounds it, a narrower one is scaled by the beam ratio); with none timed
+        only greedy search is tried.
+        """
+        left = expires - time.monotonic()
+        if left <= 0:
+            return 0
+        share = left / batches
+        for beams in sorted({num_beams, max(1, num_beams // 2), 1}, reverse=True):
+            rate = self.decode_rates.get(beams)
+            if rate is None:
+                wider = [w for w in self.decode_rates if w > beams]
+                narrower = [w for w in self.decode_rates if w < beams]
+                if wider:
+                    rate = self.decode_rates[min(wider)]
+                elif narrower:
+                    rate = self.decode_rates[max(narrower)] * beams / max(narrower)
+                elif beams == 1:
+                    return 1
+                else:
+                    continue
+            if rate * chars <= share:
+                return beams
+        return 0
+
+    def _fallback(self, words, dictionary = None):
+        """ returns the dictionary pronunciation of every word, or its letter-by-letter reading (see spell_out). """
+        dictionary = self.dictionary if dictionary is None else dictionary
+        prons = []
+        for word in words:
+            entry = dictionary.get(word) if dictionary is not None else None
+            prons.append(spell_out(word) if entry is None else entry)
+        return ' '.join(prons)
+
+    def _complete(self, grapheme, phoneme, dictionary = None):
+        """
+        grapheme: diacritic-free input; phoneme: its decode, stopped before eos.
+        returns phoneme with its last, possibly unfinished word and every word it did not reach from _fallback.
+        """
+        words = grapheme.split(' ')
+        prons = phoneme.strip().split(' ') if phoneme.strip() else []
+        prons = prons[:len(prons) - 1][:len(words)]
+        rest = words[len(prons):]
+        return ' '.join(prons + ([self._fallback(rest, dictionary)] if rest else []))
+
+    def _count_degraded(self, keys, degraded, strategies):
+        stats = self.degrade_stats
+        stats['requests'] += 1
+        stats['sentences'] += len(keys)
+        if degraded:
+            stats['degraded_requests'] += 1
+        for key in keys:
+            if key in degraded:
+                stats['degraded_sentences'] += 1
+                stats['strategies'][strategies[key]] += 1
+
+    def _postprocess(self, input, input_list, output_list, use_rules, use_dict, dictionary = None, trace = None):
+        if use_dict:
+            with stage(trace, 'lexicon'):
+                for i in range(len(input_list)):
+                    output_list[i] = self.lexicon(input_list[i], output_list[i], dictionary)
+
+        with stage(trace, 'rules'):
+            if use_rules:
+                return apply_rules_batch(input, output_list)
+            return [i.strip() for i in output_list]
+
+    def _generate(self, input_list, batch_size, use_rules, use_dict, num_beams, max_tokens = None, dictionary = None,
+                  trace = None, expires = None, strategies = None, prepared = None):
+        """
+        expires: time.monotonic() value decoding has to be done by (see generate's deadline).
+        strategies: optional list receiving, for every input, None or how its output was degraded:
+                    'narrow_beam', 'greedy', 'lexicon' or 'cut' (decoding stopped at the deadline).
+        prepared: what _prepare returned for input_list, when it was tokenized ahead (see generate_iter).
+        """
+        if not input_list:
+            return []
+        output_list = [None] * len(input_list)
+        input = input_list
+        if prepared is None:
+            with stage(trace, 'tokenize'):
+                prepared = self._prepare(input_list)
+        input_list, token_ids = prepared
+        lengths = [len(ids) for ids in token_ids]
+        batches = self.plan_batches(lengths, batch_size, max_tokens)
+        padded = 0
+        for b, batch in enumerate(batches):
+            chars = sum(len(input_list[j]) for j in batch)
+            beams = num_beams if expires is None else self._strategy(num_beams, chars, len(batches) - b, expires)
+            if beams == 0:
+                for j in batch:
+                    output_list[j] = self._fallback(input_list[j].split(' '), dictionary)
+                    if strategies is not None:
+                        strategies[j] = 'lexicon'
+                continue
+            width = max(lengths[j] for j in batch) * len(batch)
+            padded += width
+            record = None
+            if trace is not None:
+                record = {'batch_size': len(batch), 'real_tokens': sum(lengths[j] for j in batch), 'padded_tokens': width,
+                          'stages': {}}
+                trace['batches'].append(record)
+            ended = []
+            started = time.monotonic()
+            texts = self._decode([token_ids[j] for j in batch], beams, [len(input_list[j]) for j in batch], record, expires, ended)
+            stopped = expires is not None and time.monotonic() >= expires
+            if not stopped:
+                rate = (time.monotonic() - started) / max(chars, 1)
+                previous = self.decode_rates.get(beams)
+                self.decode_rates[beams] = rate if previous is None else 0.8 * previous + 0.2 * rate
+            for j, text, finished in zip(batch, texts, ended):
+                strategy = None if beams == num_beams else 'greedy' if beams == 1 else 'narrow_beam'
+                if stopped and not finished:
+                    text = self._complete(input_list[j], text, dictionary)
+                    strategy = 'cut'
+                output_list[j] = text
+                if strategies is not None:
+                    strategies[j] = strategy
+
+        # padding that plain arrival-order batching would have cost, for comparison
+        fifo_padded = sum(max([lengths[j] for j in batch], default=0) * len(batch) for batch in self.plan_batches(lengths, batch_size))
+        self.batch_stats = {'batches': len(batches), 'real_tokens': sum(lengths), 'padded_tokens': padded,
+                            'fifo_padded_tokens': fifo_padded, 'padding_saved': fifo_padded - padded}
+
+        return self._postprocess(input, input_list, output_list, use_rules, use_dict, dictionary, trace)
+
+
+class _Done():
+    """ an already finished stand-in for concurrent.futures.Future, used when prefetching is off. """
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
@@ -0,0 +1,178 @@
+import time
+import argparse
+from quantize import character_error_rate
+from normalizer import STRIP_DIACRITICS
+from segmenter import split_text, join_chunks
+
+
+def _least(confidences):
+    known = [confidence for confidence in confidences if confidence is not None]
+    return min(known) if known else None
+
+
+class AdaptiveGE2PE():
+
+    def __init__(self, g2p, threshold = 0.9, num_beams = 5):
+        """
+        g2p: a loaded GE2PE instance (either backend).
+        threshold: a sentence whose greedy decode gave some token a probability below threshold is decoded again
+                   with num_beams beams; 0 never escalates, anything above 1 always does. calibrate() picks it
+                   from data.
+        num_beams: beam width of the escalated decode.
+        """
+
+        self.g2p = g2p
+        self.threshold = threshold
+        self.num_beams = num_beams
+        self.stats_counts = {'sentences': 0, 'escalated': 0}
+
+    def greedy(self, input_list, batch_size = 10, max_tokens = None):
+        """
+        input_list: normalized sentences.
+        max_tokens: as in GE2PE.generate.
+        returns (diacritic-free inputs, raw greedy phonemes, confidence of every sentence), before rules or dictionary.
+        """
+        g2p = self.g2p
+        stripped, token_ids = g2p._prepare(input_list)
+        outputs = [None] * len(input_list)
+        confidences = [None] * len(input_list)
+        for batch in g2p.plan_batches([len(ids) for ids in token_ids], batch_size, max_tokens):
+            in_ids = g2p.tokenizer.pad({"input_ids": [token_ids[j] for j in batch]}, padding=True, return_attention_mask=True,
+                                       return_tensors=g2p.backend.tensor_type)
+            limits = g2p.decode_limits([len(stripped[j]) for j in batch])
+            out_ids, scores = g2p.backend.generate_with_confidence(in_ids["input_ids"], in_ids["attention_mask"], limits,
+                                                                   g2p.repeat_window)
+            g2p._count_limits(out_ids, limits)
+            for j, text, score in zip(batch, g2p.tokenizer.batch_decode(out_ids, skip_special_tokens=True), scores):
+                outputs[j] = text
+                confidences[j] = score
+        return stripped, outputs, confidences
+
+    def generate(self, input_list, batch_size = 10, use_rules = False, use_dict = False, return_confidence = False,
+                 max_tokens = None, segment = False, max_chunk_chars = 200, dictionary = None, deadline = None):
+        """
+        same arguments and result as GE2PE.generate, decoding greedily and re-decoding only low-confidence
+        sentences (typically those holding homographs) with the full beam width. outputs are cached apart from
+        GE2PE's beam search outputs, and g2p.last_degraded flags those a deadline degraded.
+        return_confidence: also return the confidence of every sentence's greedy decode (the probability of its
+                           least certain token, None when served from the cache); escalated sentences are the ones
+                           below threshold.
+        deadline: as in GE2PE.generate; an escalated sentence that cannot get at least half the beam width in time
+                  keeps its greedy output, and with no time left for the greedy pass the lexicon fallback is used.
+        """
+        g2p = self.g2p
+        if segment:
+            pieces = [split_text(text, max_chunk_chars) for text in input_list]
+            outputs, confidences = self.generate([chunk for chunks, glue in pieces for chunk in chunks], batch_size, use_rules,
+                                                 use_dict, True, max_tokens, dictionary=dictionary, deadline=deadline)
+            outputs, confidences, degraded = iter(outputs), iter(confidences), iter(g2p.last_degraded)
+            output_list, confidence_list, degraded_list = [], [], []
+            for chunks, glue in pieces:
+                output_list.append(join_chunks([next(outputs) for _ in chunks], glue))
+                confidence_list.append(_least([next(confidences) for _ in chunks]))
+                degraded_list.append(any([next(degraded) for _ in chunks]))
+            g2p.last_degraded = degraded_list
+            return (output_list, confidence_list) if return_confidence else output_list
+
+        expires = None if deadline is None else time.monotonic() + deadline
+        normalized = [g2p.normalize(text) for text in input_list]
+        # greedy outputs are not what GE2PE caches for num_beams, so they get keys of their own
+        keys, found, todo = g2p._lookup(normalized, use_rules, use_dict, f'adaptive:{self.num_beams}:{self.threshold}',
+                                        dictionary)
+        texts = list(todo.values())
+        strategies = [None] * len(texts)
+        if expires is not None and time.monotonic() >= expires:
+            stripped = [text.translate(STRIP_DIACRITICS) for text in texts]
+            raw = [g2p._fallback(text.split(' '), dictionary) for text in stripped]
+            confidences = [None] * len(texts)
+            strategies = ['lexicon'] * len(texts)
+        else:
+            stripped, raw, confidences = self.greedy(texts, batch_size, max_tokens)
+        outputs = g2p._postprocess(texts, stripped, raw, use_rules, use_dict, dictionary)
+        escalate = [i for i, confidence in enumerate(confidences) if confidence is not None and confidence < self.threshold]
+        if escalate:
+            picked = [None] * len(escalate)
+            beams = g2p._generate([texts[i] for i in escalate], batch_size, use_rules, use_dict, self.num_beams, max_tokens,
+                                  dictionary, None, expires, picked)
+            for i, output, strategy in zip(escalate, beams, picked):
+                # below half the beam width, the greedy output already decoded is as good
+                if strategy in (None, 'narrow_beam'):
+                    outputs[i] = output
+                    strategies[i] = strategy
+                else:
+                    strategies[i] = 'greedy'
+        degraded = {key for key, strategy in zip(todo, strategies) if strategy is not None}
+        output_list = g2p._store(keys, found, todo, outputs, degraded)
+        g2p.last_degraded = [key in degraded for key in keys]
+        if deadline is not None:
+            g2p._count_degraded(keys, degraded, dict(zip(todo, strategies)))
+        self.stats_counts['sentences'] += len(texts)
+        self.stats_counts['escalated'] += len(escalate)
+        if return_confidence:
+            confidence = dict(zip(todo, confidences))
+            return output_list, [confidence.get(key) for key in keys]
+        return output_list
+
+    def calibrate(self, sentences, tolerance = 0.01, batch_size = 10):
+        """
+        sentences: representative traffic.
+        tolerance: largest character error rate against full beam search that is accepted.
+        sets threshold to the lowest value keeping the CER of the adaptive outputs within tolerance, i.e. the
+        fewest escalations, and returns {'threshold', 'escalation_rate', 'cer_vs_beam', 'sentences'}; without
+        sentences the threshold is left as it is.
+        """
+        if not sentences:
+            return {'threshold': self.threshold, 'escalation_rate': 0.0, 'cer_vs_beam': 0.0, 'sentences': 0}
+        g2p = self.g2p
+        normalized = [g2p.normalize(text) for text in sentences]
+        stripped, raw, confidences = self.greedy(normalized, batch_size)
+        greedy = g2p._postprocess(normalized, stripped, raw, False, False)
+        beams = g2p.generate(sentences, batch_size, num_beams=self.num_beams)
+        # escalating every sentence below a candidate threshold; the lowest one within tolerance wins
+        for threshold in sorted(set(confidences)) + [float('inf')]:
+            outputs = [b if c < threshold else g for g, b, c in zip(greedy, beams, confidences)]
+            cer = character_error_rate(beams, outputs)
+            if cer <= tolerance:
+                break
+        self.threshold = threshold
+        escalated = sum(c < threshold for c in confidences)
+        return {'threshold': threshold, 'escalation_rate': escalated / len(sentences),
+                'cer_vs_beam': cer, 'sentences': len(sentences)}
+
+    def stats(self):
+        """
+        returns the number of sentences decoded (cache hits are not), how many were escalated to beam search and
+        the escalation rate.
+        """
+        stats = dict(self.stats_counts)
+        stats['escalation_rate'] = stats['escalated'] / stats['sentences'] if stats['sentences'] else 0.0
+        return stats
+
+
+if __name__ == '__main__':
+    from GE2PE import GE2PE
+    from quantize import read_reference
+    parser = argparse.ArgumentParser(description='Calibrate the adaptive beam threshold on a set of sentences and '
+                                                 'compare its cost with full beam search.')
+    parser.add_argument('model_path')
+    parser.add_argument('--reference', help='text file with one sentence per line (default: the built-in reference set)')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='largest CER against full beam search')
+    parser.add_argument('--num-beams', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'])
+    args = parser.parse_args()
+
+    g2p = GE2PE(model_path=args.model_path, backend=args.backend)
+    adaptive = AdaptiveGE2PE(g2p, num_beams=args.num_beams)
+    sentences = read_reference(args.reference)
+    report = adaptive.calibrate(sentences, args.tolerance, args.batch_size)
+    print(f"threshold {report['threshold']:.4f}: escalates {report['escalation_rate']:.0%} of {report['sentences']} sentences, "
+          f"CER vs beam search {report['cer_vs_beam']:.4f}")
+    timings = {}
+    for name, run in [('beam search', lambda: g2p.generate(sentences, args.batch_size, num_beams=args.num_beams)),
+                      ('adaptive', lambda: adaptive.generate(sentences, args.batch_size))]:
+        start = time.perf_counter()
+        run()
+        timings[name] = time.perf_counter() - start
+        print(f'{name:<12} {timings[name] / len(sentences) * 1000:.1f} ms/sentence')
+    print(f"speedup {timings['beam search'] / timings['adaptive']:.2f}x")
@@ -1,110 +1,25 @@
 import os
 import io
+import time
 import asyncio
 import streamlit as st
-from openai import OpenAI
-from GE2PE import GE2PE
-import edge_tts
-from edge_tts.exceptions import NoAudioReceived
-from config import OPENROUTER_API_KEY, DEFAULT_VOICE, OPENROUTER_MODEL, MODEL_PATH, PROMPT_FILE , OPEN_ROUTER
+from async_ge2pe import AsyncGE2PE
+from startup import Warmup
+from cache import GE2PECache
+import metrics
+from validation import validate_persian_input
+from config import OPENROUTER_API_KEY, DEFAULT_VOICE, OPENROUTER_MODEL, MODEL_PATH, PROMPT_FILE , OPEN_ROUTER, METRICS_PORT, CACHE_PATH, G2P_DEADLINE
 
 
 REPLACEMENTS = {"a":"A", "$":"S", "/":"a", "1":"", ";":"Z", "@":"?", "c":"C"}
 
-# --- Persian language validation ---
-def is_persian_text(text):
-    """
-    Check if text is in Persian language.
-    Returns (is_persian, non_persian_chars)
-    """
-    if not text or not text.strip():
-        return False, []
-    
-    # Persian/Arabic Unicode ranges
-    persian_ranges = [
-        (0x0600, 0x06FF),  # Arabic block (includes Persian)
-        (0x06F0, 0x06F9),  # Persian numbers
-        (0x200C, 0x200D),  # Zero-width non-joiner and joiner
-        (0x064B, 0x065F),  # Arabic diacritics
-    ]
-    
-    # Allowed characters: whitespace, punctuation, Persian/Arabic
-    allowed_punctuation = set(".,;:!?()[]{}\"'«»،؛")
-    allowed_whitespace = set(" \t\n\r")
-    
-    non_persian_chars = []
-    persian_char_count = 0
-    total_char_count = 0
-    
-    for char in text:
-        if char in allowed_whitespace:
-            continue  # Skip whitespace
-            
-        total_char_count += 1
-        
-        # Check if character is in Persian ranges
-        is_persian_char = False
-        char_code = ord(char)
-        
-        for start, end in persian_ranges:
-            if start <= char_code <= end:
-                is_persian_char = True
-                persian_char_count += 1
-                break
-        
-        # Allow punctuation
-        if char in allowed_punctuation:
-            continue
-        
-        # If not Persian and not allowed punctuation, it's non-Persian
-        if not is_persian_char and char not in allowed_punctuation:
-            if char not in non_persian_chars:
-                non_persian_chars.append(char)
-    
-    # Text is considered Persian if:
-    # 1. It has Persian characters, AND
-    # 2. At least 70% of non-whitespace characters are Persian, OR
-    # 3. All characters are Persian/allowed (100% Persian)
-    if total_char_count == 0:
-        return False, []
-    
-    persian_ratio = persian_char_count / total_char_count if total_char_count > 0 else 0
-    is_persian = persian_char_count > 0 and (persian_ratio >= 0.7 or len(non_persian_chars) == 0)
-    
-    return is_persian, non_persian_chars
-
 def replace_sukkun(text : str)-> str:
     sukkun = '\u0652'
     return text.replace(sukkun , ''  )
 
-def validate_persian_input(text):
-    """
-    Validate that input text is in Persian.
-    Raises ValueError with descriptive message if not Persian.
-    """
-    if not text or not text.strip():
-        raise ValueError("Text cannot be empty")
-    
-    is_persian, non_persian_chars = is_persian_text(text)
-    
-    if not is_persian:
-        non_persian_sample = ''.join(non_persian_chars[:10])
-        if len(non_persian_chars) > 10:
-            non_persian_sample += "..."
-        
-        error_msg = (
-            f"⚠️ **ERROR: Non-Persian text detected!**\n\n"
-            f"This application only accepts Persian (Farsi) text. "
-            f"Please enter your text in Persian language only.\n\n"
-            f"**Detected non-Persian characters:** `{non_persian_sample}`\n\n"
-            f"Please rewrite your input in Persian and try again."
-        )
-        raise ValueError(error_msg)
-    
-    return True
-
 # --- voice selection helpers ---
 async def list_voices():
+    import edge_tts
     voices = await edge_tts.list_voices()
     return voices
 
@@ -121,7 +36,9 @@ def read_prompt(path):
 
 @st.cache_resource
 def load_g2p(path):
-    return GE2PE(model_path=path)
+    # loads and warms up in the background while the page renders; one model is shared by every session
+    # and concurrent clicks are micro-batched on its inference thread
+    return Warmup(path, wrap=lambda g2p: metrics.register_g2p(AsyncGE2PE(g2p)), cache=GE2PECache(CACHE_PATH))
 
 def replace_chars(s):
     return "".join(REPLACEMENTS.get(ch, ch) for ch in s)
@@ -131,6 +48,7 @@ def init_client():
     if not key:
         st.error("❗ Please set OPENROUTER_API_KEY in your .env file.")
         st.stop()
+    from openai import OpenAI
     return OpenAI(base_url=OPEN_ROUTER, api_key=key)
 
 def call_llm(client, model_id, sys, user):
@@ -142,9 +60,12 @@ def call_llm(client, model_id, sys, user):
             {"role": "user", "content": user},
         ],
     )
+    metrics.record_llm_usage(resp.usage)
     return resp.choices[0].message.content
 
 async def _speak_async(text, voice=None):
+    import edge_tts
+    from edge_tts.exceptions import NoAudioReceived
     voice = voice or DEFAULT_VOICE
     if not text or not text.strip():
         raise ValueError("Text cannot be empty")
@@ -168,13 +89,16 @@ def speak(text, voice=None):
 # --- app UI ---
 st.title("🗣️ GE2PE → LLM → TWO Persian Speech Outputs")
 
+metrics.serve(METRICS_PORT)
+
 base_prompt = read_prompt(PROMPT_FILE)
-g2p = load_g2p(MODEL_PATH)
+warmup = load_g2p(MODEL_PATH)
 client = init_client()
 
 # Voice selection
 st.subheader("🎤 Voice Selection")
-voices = get_available_voices()
+with st.spinner("Loading voices..."):
+    voices = get_available_voices()
 
 persian_voices = [
     v for v in voices
@@ -232,29 +156,39 @@ if st.button("Convert + Send to LLM + Speak Both"):
     if not text.strip():
         st.error("Please enter text.")
     else:
+        start = time.perf_counter()
         # Validate Persian input
         try:
-            validate_persian_input(text)
+            with metrics.timed_stage("validation"):
+                validate_persian_input(text)
         except ValueError as e:
             st.error(str(e))
             st.stop()
         
         # GE2PE
-        raw = g2p.generate([text], use_rules=True)
+        with st.spinner("Loading the GE2PE model..."):
+            g2p = warmup.result()
+        with metrics.timed_stage("g2p"):
+            raw, degraded = g2p.generate([text], use_rules=True, segment=True, deadline=G2P_DEADLINE, return_degraded=True)
         phoneme = replace_chars(raw[0])
         st.subheader("finglish Phoneme Output")
+        if degraded[0]:
+            st.warning(f"⚠️ Phonemized with a faster, less accurate search to stay within {G2P_DEADLINE:g}s.")
         st.code(phoneme)
 
         # LLM
         st.subheader("🤖 LLM Output")
-        ai_text = call_llm(client, OPENROUTER_MODEL, base_prompt, phoneme)
+        with metrics.timed_stage("llm"):
+            ai_text = call_llm(client, OPENROUTER_MODEL, base_prompt, phoneme)
         ai_text= replace_sukkun(ai_text)
         st.write(ai_text)
 
         # TTS #1 — Original input
         st.subheader("🔊 Speech: Original Input")
         try:
-            audio1 = speak(text, voice=selected_voice)
+            with metrics.timed_stage("tts_input"):
+                audio1 = speak(text, voice=selected_voice)
+            metrics.record_tts("input", text, audio1)
             st.audio(audio1, format="audio/mp3")
             st.download_button("Download Input Speech", audio1, "input_fa.mp3")
         except Exception as e:
@@ -264,9 +198,16 @@ if st.button("Convert + Send to LLM + Speak Both"):
         # TTS #2 — LLM Output
         st.subheader("🔊 Speech: LLM Output")
         try:
-            audio2 = speak(ai_text, voice=selected_voice)
+            with metrics.timed_stage("tts_llm"):
+                audio2 = speak(ai_text, voice=selected_voice)
+            metrics.record_tts("llm", ai_text, audio2)
             st.audio(audio2, format="audio/mp3")
             st.download_button("Download LLM Speech", audio2, "llm_fa.mp3")
         except Exception as e:
             st.error(f"Error generating speech for LLM output: {str(e)}")
             st.info(f"Voice used: {selected_voice}, Text length: {len(ai_text)}")
+        metrics.PIPELINE_SECONDS.observe(time.perf_counter() - start)
+
+if warmup.ready():
+    with st.expander("⏱️ Startup timing"):
+        st.markdown(warmup.report())
@@ -0,0 +1,312 @@
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from segmenter import split_text, join_chunks
+
+
+class Overloaded(queue.Full):
+    """ raised by submit when a lane already holds its max_queue sentences. """
+
+
+class Lane():
+
+    def __init__(self, name, max_batch_size = 32, max_wait = 0.01, max_queue = None):
+        """
+        name: lane name passed to submit / generate / agenerate.
+        max_batch_size: largest number of this lane's sentences decoded at once; while such a batch decodes,
+                        higher lanes wait for it, so a small value keeps them responsive.
+        max_wait: seconds to keep gathering this lane's requests after the first one before decoding.
+        max_queue: largest number of distinct sentences of this lane queued or decoding at once; submit raises
+                   Overloaded beyond it (None for no bound).
+        """
+
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.inflight = 0
+        self.requests = 0
+        self.merged = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.batches = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.waits = deque(maxlen=1000)
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {'requests': self.requests, 'merged': self.merged, 'rejected': self.rejected, 'dropped': self.dropped,
+                'batches': self.batches, 'inflight': self.inflight, 'queued': len(self.queue),
+                'wait_mean_ms': self.wait_seconds / self.waited * 1000 if self.waited else 0.0,
+                'wait_p95_ms': waits[int(len(waits) * 0.95)] * 1000 if waits else 0.0}
+
+
+def priority_lanes(interactive_batch_size = 8, interactive_queue = 64, bulk_batch_size = 32, bulk_queue = 4096,
+                   max_wait = 0.01):
+    """ an interactive lane for single latency-sensitive sentences, served first, and a bulk lane behind it. """
+    return [Lane('interactive', interactive_batch_size, max_wait, interactive_queue),
+            Lane('bulk', bulk_batch_size, max_wait, bulk_queue)]
+
+
+def _join_pieces(pieces, outputs, degraded, return_degraded):
+    """ rejoins the chunks of segmented inputs; an input is degraded when any of its chunks is. """
+    outputs, degraded = iter(outputs), iter(degraded)
+    joined = [join_chunks([next(outputs) for _ in chunks], glue) for chunks, glue in pieces]
+    if not return_degraded:
+        return joined
+    return joined, [any([next(degraded) for _ in chunks]) for chunks, glue in pieces]
+
+
+class AsyncGE2PE():
+
+    def __init__(self, g2p, max_batch_size = 32, max_wait = 0.01, max_queue = None, lanes = None):
+        """
+        g2p: a loaded GE2PE instance; only the inference thread of this wrapper calls it.
+        max_batch_size: largest number of distinct sentences decoded in one batched call.
+        max_wait: seconds to keep gathering requests after the first one arrives before decoding.
+        max_queue: largest number of distinct sentences queued or decoding at once; submit raises Overloaded
+                   (a queue.Full) beyond it (None for no bound).
+        lanes: optional list of Lane in priority order (e.g. priority_lanes()), replacing the three settings
+               above. The inference thread always serves the highest non-empty lane, one lane per batch.
+        """
+
+        self.g2p = g2p
+        self.lanes = {lane.name: lane for lane in lanes or [Lane('default', max_batch_size, max_wait, max_queue)]}
+        self.default_lane = next(iter(self.lanes))
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.inflight = {}
+        self.deadlines = {}  # earliest time.monotonic() deadline (or None) of every queued sentence
+        self.on_wait = None  # optional callable(lane name, seconds a sentence waited before its batch started)
+        self.thread = threading.Thread(target=self._run, name='ge2pe-inference', daemon=True)
+        self.thread.start()
+
+    def submit(self, text, use_rules = False, use_dict = False, num_beams = 5, lane = None, deadline = None):
+        """
+        queues one sentence on lane (default: the first lane) and returns a concurrent.futures.Future
+        resolving to its phonemes.
+        deadline: seconds from now the phonemes are needed in, queueing included (see GE2PE.generate); the
+                  future's degraded attribute tells whether the output was degraded to meet it.
+        a sentence that is already queued or decoding in the same lane with the same settings is not decoded twice;
+        callers with a deadline are only merged with callers that have one too, and the sentence keeps the earliest
+        of their deadlines while queued.
+        a sentence whose futures are all cancelled before its batch starts is not decoded at all.
+        """
+        lane = self.lanes[lane or self.default_lane]
+        expires = None if deadline is None else time.monotonic() + deadline
+        # without a deadline a caller expects the full search, so it never waits on a deadline-bound decode
+        key = (lane.name, text, use_rules, use_dict, num_beams, expires is None)
+        future = Future()
+        future.degraded = False
+        with self.lock:
+            lane.requests += 1
+            waiters = self.inflight.get(key)
+            if waiters is not None:
+                waiters.append(future)
+                lane.merged += 1
+                if key in self.deadlines and expires is not None:
+                    self.deadlines[key] = min(self.deadlines[key], expires)
+                return future
+            if lane.max_queue is not None and lane.inflight >= lane.max_queue:
+                lane.rejected += 1
+                raise Overloaded(f"lane '{lane.name}' is overloaded: {lane.inflight} sentences are already waiting")
+            self.inflight[key] = [future]
+            self.deadlines[key] = expires
+            lane.inflight += 1
+            lane.queue.append((key, time.monotonic()))
+            self.ready.notify()
+        return future
+
+    def _submit_all(self, input_list, use_rules, use_dict, num_beams, lane, deadline = None):
+        futures = []
+        try:
+            for text in input_list:
+                futures.append(self.submit(text, use_rules, use_dict, num_beams, lane, deadline))
+        except queue.Full:
+            for future in futures:
+                future.cancel()
+            raise
+        return futures
+
+    def generate(self, input_list, use_rules = False, use_dict = False, num_beams = 5, segment = False, max_chunk_chars = 200,
+                 timeout = None, lane = None, deadline = None, return_degraded = False):
+        """
+        blocking counterpart of agenerate for threaded callers such as Streamlit sessions.
+        """
+        if segment:
+            pieces = [split_text(text, max_chunk_chars) for text in input_list]
+            outputs, degraded = self.generate([chunk for chunks, glue in pieces for chunk in chunks], use_rules, use_dict,
+                                              num_beams, timeout=timeout, lane=lane, deadline=deadline, return_degraded=True)
+            return _join_pieces(pieces, outputs, degraded, return_degraded)
+        futures = self._submit_all(input_list, use_rules, use_dict, num_beams, lane, deadline)
+        expires = None if timeout is None else time.monotonic() + timeout
+        try:
+            outputs = [future.result(None if expires is None else max(0.0, expires - time.monotonic())) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise
+        if return_degraded:
+            return outputs, [future.degraded for future in futures]
+        return outputs
+
+    async def agenerate(self, input_list, use_rules = False, use_dict = False, num_beams = 5, segment = False, max_chunk_chars = 200,
+                        timeout = None, lane = None, deadline = None, return_degraded = False):
+        """
+        input_list: list of sentences to be phonemized.
+        segment, max_chunk_chars: as in GE2PE.generate; the chunks are queued individually, so they share
+                                  micro-batches with other callers.
+        timeout: seconds to wait for the whole list; on expiry TimeoutError is raised and sentences not yet
+                 decoding are dropped from the queue.
+        lane: name of the lane to queue on (default: the first lane).
+        deadline: seconds the phonemes are needed in; unlike timeout it never fails, sentences that would miss it
+                  are decoded with fewer beams, cut short or read from the lexicon (see GE2PE.generate).
+        return_degraded: also return whether each output was degraded to meet the deadline.
+        returns the list of phonemized sentences once the micro-batches holding them are decoded.
+        raises Overloaded when the lane already holds max_queue sentences; none of input_list is decoded then.
+        """
+        if segment:
+            pieces = [split_text(text, max_chunk_chars) for text in input_list]
+            outputs, degraded = await self.agenerate([chunk for chunks, glue in pieces for chunk in chunks], use_rules, use_dict,
+                                                     num_beams, timeout=timeout, lane=lane, deadline=deadline,
+                                                     return_degraded=True)
+            return _join_pieces(pieces, outputs, degraded, return_degraded)
+        futures = self._submit_all(input_list, use_rules, use_dict, num_beams, lane, deadline)
+        outputs = list(await asyncio.wait_for(asyncio.gather(*[asyncio.wrap_future(future) for future in futures]), timeout))
+        if return_degraded:
+            return outputs, [future.degraded for future in futures]
+        return outputs
+
+    def _next_lane(self):
+        return next((lane for lane in self.lanes.values() if lane.queue), None)
+
+    def _higher(self, lane):
+        """ returns a lane ranked above lane that has queued work, if any. """
+        for other in self.lanes.values():
+            if other is lane:
+                return None
+            if other.queue:
+                return other
+
+    def _collect(self):
+        """ waits for work and returns the lane to serve and up to its max_batch_size (key, enqueued) items. """
+        with self.ready:
+            while True:
+                lane = self._next_lane()
+                while lane is None:
+                    self.ready.wait()
+                    lane = self._next_lane()
+                items = [lane.queue.popleft()]
+                deadline = time.monotonic() + lane.max_wait
+                while len(items) < lane.max_batch_size:
+                    if lane.queue:
+                        items.append(lane.queue.popleft())
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._higher(lane) is not None:
+                        break
+                    self.ready.wait(remaining)
+                if self._higher(lane) is not None:
+                    # more urgent work arrived while gathering: put this batch back and serve it first
+                    lane.queue.extendleft(reversed(items))
+                    continue
+                return lane, items
+
+    def _run(self):
+        while True:
+            lane, items = self._collect()
+            pending = {key for key, _ in items}
+            try:
+                self._serve(lane, items, pending)
+            except Exception as e:
+                # a failing on_wait, hook or delivery must neither stop this thread nor leave callers waiting
+                self._fail(lane, pending, e)
+
+    def _serve(self, lane, items, pending):
+        """ decodes one collected batch and delivers its results; pending holds the keys not yet delivered. """
+        now = time.monotonic()
+        with self.lock:
+            lane.batches += 1
+            keys = []
+            deadlines = {}
+            for key, enqueued in items:
+                deadlines[key] = self.deadlines.pop(key, None)
+                lane.waited += 1
+                lane.wait_seconds += now - enqueued
+                lane.waits.append(now - enqueued)
+                # every caller of this sentence timed out or went away
+                if all(future.cancelled() for future in self.inflight[key]):
+                    del self.inflight[key]
+                    pending.discard(key)
+                    lane.inflight -= 1
+                    lane.dropped += 1
+                else:
+                    keys.append(key)
+        if self.on_wait is not None:
+            for key, enqueued in items:
+                self.on_wait(lane.name, now - enqueued)
+        # one batched call per combination of generation settings, deadline-bound sentences apart from the others
+        groups = {}
+        for key in keys:
+            groups.setdefault(key[2:], []).append(key)
+        for (use_rules, use_dict, num_beams, _), group in groups.items():
+            # the batch has to meet the earliest deadline among its sentences
+            expires = min([deadlines[key] for key in group if deadlines[key] is not None], default=None)
+            try:
+                outputs = self.g2p.generate([key[1] for key in group], batch_size=len(group), use_rules=use_rules,
+                                            use_dict=use_dict, num_beams=num_beams,
+                                            deadline=None if expires is None else expires - time.monotonic())
+                degraded = self.g2p.last_degraded
+                error = None
+            except Exception as e:
+                outputs = [None] * len(group)
+                degraded = [False] * len(group)
+                error = e
+            for key, output, flag in zip(group, outputs, degraded):
+                with self.lock:
+                    waiters = self.inflight.pop(key)
+                    pending.discard(key)
+                    lane.inflight -= 1
+                for future in waiters:
+                    future.degraded = flag
+                    try:
+                        if error is not None:
+                            future.set_exception(error)
+                        else:
+                            future.set_result(output)
+                    except InvalidStateError:
+                        pass  # cancelled by a caller that timed out
+        if pending:
+            raise RuntimeError(f'generate returned no output for {len(pending)} sentences of the batch')
+
+    def _fail(self, lane, keys, error):
+        """ fails every caller still waiting on keys with error. """
+        with self.lock:
+            waiters = []
+            for key in keys:
+                self.deadlines.pop(key, None)
+                if key in self.inflight:
+                    waiters.extend(self.inflight.pop(key))
+                    lane.inflight -= 1
+        for future in waiters:
+            try:
+                future.set_exception(error)
+            except InvalidStateError:
+                pass
+
+    def stats(self):
+        """
+        returns how many requests arrived, how many were merged with an identical in-flight input,
+        rejected because their lane was full or dropped because their callers gave up, how many batched
+        generate calls were made and how many sentences are queued or decoding now; 'lanes' holds the same
+        per lane, with the queue-wait mean and p95 (over the last 1000 sentences) in ms.
+        """
+        with self.lock:
+            lanes = {name: lane.stats() for name, lane in self.lanes.items()}
+        totals = {k: sum(lane[k] for lane in lanes.values()) for k in ['requests', 'merged', 'rejected', 'dropped', 'batches', 'inflight']}
+        return {**totals, 'lanes': lanes}
@@ -0,0 +1,65 @@
+import sys
+import argparse
+from benchmarks import suite
+
+
+def run(args):
+    results = suite.bench_functions(args.repeats)
+    if args.model_path:
+        backends = args.backends or suite.available_backends()
+        results += suite.bench_generate(args.model_path, backends, args.precisions, args.batch_sizes, args.beams,
+                                        args.lengths, [tuple(flag == 'on' for flag in pair.split(',')) for pair in args.flags],
+                                        args.batches)
+        if args.adaptive_tolerances:
+            results += suite.bench_adaptive(args.model_path, backends, args.adaptive_tolerances, max(args.batch_sizes),
+                                            max(args.beams), args.lengths, args.batches)
+        if args.pool_workers:
+            results += suite.bench_pool(args.model_path, args.pool_workers, args.threads_per_worker)
+    suite.save(args.output, suite.environment(args.model_path), results)
+    print(f'\n{len(results)} results written to {args.output}')
+
+
+def compare(args):
+    rows, regressions, env_diff = suite.compare(suite.load(args.baseline), suite.load(args.current), args.threshold)
+    for key, (before, after) in env_diff.items():
+        print(f'warning: environment differs in {key}: {before} -> {after}')
+    print('| benchmark | baseline/s | current/s | throughput | p95 | |')
+    print('|---|---|---|---|---|---|')
+    for key, before, after, throughput, p95, regressed in rows:
+        print(f"| {key} | {before:.1f} | {after:.1f} | {throughput:+.1%} | {p95:+.1%} | {'REGRESSION' if regressed else ''} |")
+    print(f'\n{regressions} regression(s) beyond {args.threshold:.0%} in {len(rows)} compared benchmarks')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmarks of the phonemization pipeline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks and write a JSON report')
+    run_parser.add_argument('model_path', nargs='?', help='GE2PE checkpoint; without it only the pure-Python stages are timed')
+    run_parser.add_argument('-o', '--output', default='benchmark.json')
+    run_parser.add_argument('--backends', nargs='+', choices=['torch', 'onnx'], help='default: every installed backend')
+    run_parser.add_argument('--precisions', nargs='+', default=['fp32'], choices=['fp32', 'bf16', 'int8'])
+    run_parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32])
+    run_parser.add_argument('--beams', nargs='+', type=int, default=[1, 5])
+    run_parser.add_argument('--lengths', nargs='+', default=['short', 'long'], choices=list(suite.LENGTHS))
+    run_parser.add_argument('--flags', nargs='+', default=['off,off', 'on,on'],
+                            help='use_rules,use_dict pairs such as on,off (default: off,off on,on)')
+    run_parser.add_argument('--batches', type=int, default=5, help='timed generate calls per combination')
+    run_parser.add_argument('--repeats', type=int, default=200, help='scale of the pure-Python timings')
+    run_parser.add_argument('--adaptive-tolerances', nargs='+', type=float,
+                            help='also time adaptive beam search calibrated to these CER tolerances against full beams')
+    run_parser.add_argument('--pool-workers', nargs='+', type=int, help='also time GE2PEPool with these worker counts')
+    run_parser.add_argument('--threads-per-worker', type=int, default=1)
+
+    compare_parser = commands.add_parser('compare', help='flag regressions of a report against a stored baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative throughput drop or p95 increase that counts as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
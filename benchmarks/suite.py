@@ -0,0 +1,231 @@
+import os
+import sys
+import time
+import json
+import platform
+import itertools
+import subprocess
+import importlib.util
+from datetime import datetime, timezone
+
+SENTENCES = [
+    'این کتابِ علی است',
+    'تست مدل تبدیل نویسه به واج',
+    'سعدی گفت: شکر خدا که هر چه طلب کردم از خدا بر منتهای همت خود کامران شدم',
+    'علی به مدرسه می‌رود',
+    'کاش تو هم می‌آمدی',
+    'دیروز باران شدیدی بارید و خیابان‌ها پر از آب شد',
+    'او کتاب‌هایش را روی میز گذاشت',
+    'شیر را از یخچال بیاور',
+    'مردم این شهر بسیار مهمان‌نواز هستند',
+    'قند را در چای حل کرد',
+]
+PINGLISH = ['kAS to ham miAmadi', 'in ketAb1 ?ali ast', 'diruz bArAn1 Sadidi bArid', 'Sir rA az yaxCAl biAvar']
+DICTIONARY = {'کتاب': 'ketAb', 'علی': '?ali', 'مدرسه': 'madrese', 'شهر': 'Sahr', 'چای': 'CAy'}
+# number of sentences joined into one input, per input length bucket
+LENGTHS = {'short': 1, 'medium': 3, 'long': 8}
+
+
+def percentile(values, q):
+    """ nearest-rank percentile, q in [0, 100]. """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(latencies, items):
+    """
+    latencies: seconds of every timed call.
+    items: number of sentences (or operations) processed by all those calls together.
+    """
+    total = sum(latencies)
+    return {'calls': len(latencies), 'throughput': items / total if total else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+
+
+def environment(model_path = None):
+    """ returns what the numbers depend on, so results from different machines or builds are not mixed up. """
+    env = {'timestamp': datetime.now(timezone.utc).isoformat(), 'python': platform.python_version(),
+           'platform': platform.platform(), 'machine': platform.machine(), 'processor': platform.processor(),
+           'cpu_count': os.cpu_count(), 'host': platform.node()}
+    for package in ['torch', 'transformers', 'onnxruntime', 'numpy']:
+        if importlib.util.find_spec(package) is not None:
+            module = __import__(package)
+            env[package] = getattr(module, '__version__', 'unknown')
+    if 'torch' in sys.modules:
+        env['torch_threads'] = sys.modules['torch'].get_num_threads()
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['git_commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                                           text=True).stdout.strip()
+        env['git_dirty'] = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                                               capture_output=True, text=True).stdout.strip())
+    except OSError:
+        pass
+    if model_path is not None:
+        from cache import checkpoint_fingerprint
+        env['model_path'] = model_path
+        env['model_fingerprint'] = checkpoint_fingerprint(model_path)
+    return env
+
+
+def available_backends():
+    backends = ['torch'] if importlib.util.find_spec('torch') is not None else []
+    if importlib.util.find_spec('onnxruntime') is not None and importlib.util.find_spec('onnx') is not None:
+        backends.append('onnx')
+    return backends
+
+
+def make_inputs(length, count):
+    join = LENGTHS[length]
+    cycle = itertools.cycle(SENTENCES)
+    return ['، '.join(next(cycle) for _ in range(join)) for _ in range(count)]
+
+
+def time_calls(fn, args, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for arg in args:
+            start = time.perf_counter()
+            fn(arg)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_generate(model_path, backends, precisions, batch_sizes, beams, lengths, flags, batches = 5, log = print):
+    """
+    times GE2PE.generate for every combination; each timed call phonemizes one batch of batch_size inputs.
+    flags: list of (use_rules, use_dict) pairs.
+    """
+    from GE2PE import GE2PE
+    results = []
+    for backend, precision in itertools.product(backends, precisions):
+        if backend == 'onnx' and precision != 'fp32':
+            continue
+        g2p = GE2PE(model_path=model_path, backend=backend, precision=precision, dictionary=DICTIONARY)
+        g2p.generate(make_inputs('short', 2), num_beams=1)  # warm-up
+        for batch_size, num_beams, length, (use_rules, use_dict) in itertools.product(batch_sizes, beams, lengths, flags):
+            inputs = [make_inputs(length, batch_size) for _ in range(batches)]
+            latencies = time_calls(lambda batch: g2p.generate(batch, batch_size=batch_size, use_rules=use_rules,
+                                                              use_dict=use_dict, num_beams=num_beams), inputs, 1)
+            params = {'backend': backend, 'precision': precision, 'batch_size': batch_size, 'num_beams': num_beams,
+                      'length': length, 'use_rules': use_rules, 'use_dict': use_dict}
+            result = {'name': 'generate', 'params': params, **summarize(latencies, batch_size * batches)}
+            log(format_result(result))
+            results.append(result)
+    return results
+
+
+def bench_adaptive(model_path, backends, tolerances, batch_size = 8, num_beams = 5, lengths = ('short', 'long'),
+                   batches = 5, log = print):
+    """
+    times AdaptiveGE2PE after calibrating its threshold on the same inputs for every CER tolerance; each result
+    also holds the escalation rate and the CER against full beam search.
+    """
+    from GE2PE import GE2PE
+    from adaptive import AdaptiveGE2PE
+    results = []
+    for backend in backends:
+        g2p = GE2PE(model_path=model_path, backend=backend)
+        g2p.generate(make_inputs('short', 2), num_beams=1)  # warm-up
+        for tolerance, length in itertools.product(tolerances, lengths):
+            inputs = [make_inputs(length, batch_size) for _ in range(batches)]
+            adaptive = AdaptiveGE2PE(g2p, num_beams=num_beams)
+            calibration = adaptive.calibrate([text for batch in inputs for text in batch], tolerance, batch_size)
+            latencies = time_calls(lambda batch: adaptive.generate(batch, batch_size), inputs, 1)
+            params = {'backend': backend, 'batch_size': batch_size, 'num_beams': num_beams, 'length': length,
+                      'tolerance': tolerance}
+            result = {'name': 'adaptive', 'params': params, **summarize(latencies, batch_size * batches),
+                      'escalation_rate': adaptive.stats()['escalation_rate'], 'cer_vs_beam': calibration['cer_vs_beam']}
+            log(format_result(result))
+            results.append(result)
+    return results
+
+
+def bench_functions(repeats = 200, log = print):
+    """ times the pure-Python stages on their own, one call per operation. """
+    from rule_engine import apply_rules, fuzz_corpus
+    from pinglish_to_persian import pinglish_to_persian
+    from validation import is_persian_text
+    rules_corpus = []
+    for grapheme, phoneme in fuzz_corpus(400):
+        try:
+            apply_rules(grapheme, phoneme)
+        except IndexError:
+            continue  # misaligned fuzz pairs the rules reject
+        rules_corpus.append((grapheme, phoneme))
+    cases = [('pinglish_to_persian', pinglish_to_persian, PINGLISH),
+             ('rules', lambda pair: apply_rules(*pair), rules_corpus),
+             ('is_persian_text', is_persian_text, SENTENCES)]
+    results = []
+    for name, fn, args in cases:
+        fn(args[0])
+        latencies = time_calls(fn, args, max(1, repeats * 10 // len(args)))
+        result = {'name': name, 'params': {}, **summarize(latencies, len(latencies))}
+        log(format_result(result))
+        results.append(result)
+    return results
+
+
+def bench_pool(model_path, worker_counts, threads_per_worker = 1, sentences = 256, log = print):
+    from pool import throughput_table
+    results = []
+    for workers, threads, seconds, rate in throughput_table(model_path, make_inputs('medium', sentences), worker_counts,
+                                                           threads_per_worker):
+        result = {'name': 'pool', 'params': {'workers': workers, 'threads_per_worker': threads},
+                  'calls': 1, 'throughput': rate, 'p50_ms': seconds * 1000, 'p95_ms': seconds * 1000,
+                  'p99_ms': seconds * 1000}
+        log(format_result(result))
+        results.append(result)
+    return results
+
+
+def result_key(result):
+    return ' '.join([result['name']] + [f'{k}={v}' for k, v in sorted(result['params'].items())])
+
+
+def format_result(result):
+    line = (f"{result_key(result):<90} {result['throughput']:>10.1f}/s  p50 {result['p50_ms']:.2f}ms  "
+            f"p95 {result['p95_ms']:.2f}ms  p99 {result['p99_ms']:.2f}ms")
+    if 'escalation_rate' in result:
+        line += f"  escalated {result['escalation_rate']:.0%}  CER {result['cer_vs_beam']:.4f}"
+    return line
+
+
+def save(path, env, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'environment': env, 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold = 0.1):
+    """
+    baseline, current: documents written by save.
+    threshold: relative throughput drop or p95 latency increase counted as a regression.
+    returns (rows, regressions, environment differences); a row is (key, baseline throughput,
+    current throughput, throughput change, p95 change, regressed).
+    """
+    before = {result_key(result): result for result in baseline['results']}
+    rows = []
+    regressions = 0
+    for result in current['results']:
+        key = result_key(result)
+        old = before.get(key)
+        if old is None:
+            continue
+        throughput = (result['throughput'] - old['throughput']) / old['throughput'] if old['throughput'] else 0.0
+        p95 = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+        regressed = throughput < -threshold or p95 > threshold
+        regressions += regressed
+        rows.append((key, old['throughput'], result['throughput'], throughput, p95, regressed))
+    ignored = {'timestamp', 'git_commit', 'git_dirty'}
+    env_diff = {k: (baseline['environment'].get(k), v) for k, v in current['environment'].items()
+                if k not in ignored and baseline['environment'].get(k) != v}
+    return rows, regressions, env_diff
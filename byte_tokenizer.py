@@ -0,0 +1,109 @@
+import os
+import re
+import json
+
+
+class ByteTokenizer():
+    """
+    the ByT5 tokenizer without transformers (whose import pulls in torch when it is installed): utf-8 bytes
+    shifted past pad, eos and unk, followed by the added <extra_id_N> tokens. encodes, pads and decodes like
+    ByT5Tokenizer for the calls GE2PE makes.
+    """
+
+    offset = 3
+
+    def __init__(self, added_tokens = None):
+        """
+        added_tokens: dict token -> id of the added special tokens (see from_pretrained).
+        """
+
+        self.pad_token_id, self.eos_token_id, self.unk_token_id = 0, 1, 2
+        self.specials = {'<pad>': 0, '</s>': 1, '<unk>': 2, **(added_tokens or {})}
+        self.names = {i: token for token, i in self.specials.items()}
+        pattern = '|'.join(re.escape(token) for token in sorted(self.specials, key=len, reverse=True))
+        self.split = re.compile(f'({pattern})')
+
+    @classmethod
+    def from_pretrained(cls, model_path):
+        """
+        returns the tokenizer saved in model_path, or None when it is not a ByT5 tokenizer.
+        """
+        try:
+            with open(os.path.join(model_path, 'tokenizer_config.json'), encoding='utf-8') as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if config.get('tokenizer_class') != 'ByT5Tokenizer':
+            return None
+        added = {entry['content']: int(i) for i, entry in config.get('added_tokens_decoder', {}).items()}
+        path = os.path.join(model_path, 'added_tokens.json')
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                added.update(json.load(f))
+        return cls({token: i for token, i in added.items() if i >= cls.offset + 256})
+
+    def encode(self, text, add_special_tokens = True):
+        ids = []
+        for piece in self.split.split(text):
+            if piece in self.specials:
+                ids.append(self.specials[piece])
+            else:
+                ids.extend(b + self.offset for b in piece.encode('utf-8'))
+        if add_special_tokens and ids[-1:] != [self.eos_token_id]:
+            ids.append(self.eos_token_id)
+        return ids
+
+    def __call__(self, text, add_special_tokens = True):
+        """ text: one string or a list of them. returns {'input_ids', 'attention_mask'} without padding. """
+        if isinstance(text, str):
+            ids = self.encode(text, add_special_tokens)
+            return {'input_ids': ids, 'attention_mask': [1] * len(ids)}
+        ids = [self.encode(t, add_special_tokens) for t in text]
+        return {'input_ids': ids, 'attention_mask': [[1] * len(row) for row in ids]}
+
+    def pad(self, encoded, padding = True, return_attention_mask = True, return_tensors = None):
+        """
+        encoded: {'input_ids': list of id lists}. pads every row on the right to the longest one.
+        return_tensors: 'np', 'pt' or None for lists.
+        """
+        rows = encoded['input_ids']
+        width = max((len(row) for row in rows), default=0) if padding else None
+        input_ids = [row + [self.pad_token_id] * (width - len(row)) for row in rows] if padding else rows
+        mask = [[1] * len(row) + [0] * (len(padded) - len(row)) for row, padded in zip(rows, input_ids)]
+        if return_tensors == 'np':
+            import numpy as np
+            input_ids, mask = np.array(input_ids, dtype=np.int64), np.array(mask, dtype=np.int64)
+        elif return_tensors == 'pt':
+            import torch
+            input_ids, mask = torch.tensor(input_ids, dtype=torch.long), torch.tensor(mask, dtype=torch.long)
+        elif return_tensors is not None:
+            raise ValueError(f"return_tensors must be 'np', 'pt' or None, got '{return_tensors}'")
+        return {'input_ids': input_ids, 'attention_mask': mask} if return_attention_mask else {'input_ids': input_ids}
+
+    def decode(self, ids, skip_special_tokens = False):
+        """ special tokens that are kept are written without the spaces transformers puts around them. """
+        if hasattr(ids, 'tolist'):
+            ids = ids.tolist()
+        out = bytearray()
+        for i in ids:
+            if self.offset <= i < self.offset + 256:
+                out.append(i - self.offset)
+            elif not skip_special_tokens and i in self.names:
+                out.extend(self.names[i].encode('utf-8'))
+        return out.decode('utf-8', errors='ignore')
+
+    def batch_decode(self, sequences, skip_special_tokens = False):
+        if hasattr(sequences, 'tolist'):
+            sequences = sequences.tolist()
+        return [self.decode(ids, skip_special_tokens) for ids in sequences]
+
+
+def load_tokenizer(model_path):
+    """
+    returns a ByteTokenizer for ByT5 checkpoints (such as GE2PE's), else the transformers AutoTokenizer.
+    """
+    tokenizer = ByteTokenizer.from_pretrained(model_path)
+    if tokenizer is None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+    return tokenizer
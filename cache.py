@@ -0,0 +1,240 @@
+import os
+import time
+import json
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# written into every converted artifact (quantized, safetensors, onnx) by publish
+SOURCE = 'source.json'
+
+
+def checkpoint_fingerprint(model_path):
+    """
+    model_path: path to a saved checkpoint directory (or single file).
+    returns a short hash of the names, sizes and modification times of the checkpoint files,
+    which changes whenever the checkpoint is replaced or retrained in place.
+    """
+    h = hashlib.sha1()
+    if os.path.isdir(model_path):
+        for root, dirs, files in os.walk(model_path):
+            dirs.sort()
+            for name in sorted(files):
+                st = os.stat(os.path.join(root, name))
+                h.update(os.path.relpath(os.path.join(root, name), model_path).encode('utf-8'))
+                h.update(('%d:%d' % (st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    elif os.path.exists(model_path):
+        st = os.stat(model_path)
+        h.update(('%d:%d' % (st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    else:
+        # hub ids and other non-local paths are keyed on the name alone
+        h.update(str(model_path).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def is_current(path, model_path):
+    """
+    returns True when path holds a complete artifact built from the current version of the checkpoint model_path.
+    """
+    try:
+        with open(os.path.join(path, SOURCE), encoding='utf-8') as f:
+            return json.load(f)['fingerprint'] == checkpoint_fingerprint(model_path)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def publish(model_path, path, write):
+    """
+    runs write(directory) on a fresh directory next to path, records the fingerprint of model_path in it and
+    only then moves it to path, replacing a stale artifact; an interrupted conversion leaves nothing at path.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.tmp-', dir=parent)
+    try:
+        write(tmp)
+        with open(os.path.join(tmp, SOURCE), 'w', encoding='utf-8') as f:
+            json.dump({'source': os.path.abspath(model_path), 'fingerprint': checkpoint_fingerprint(model_path)}, f)
+        if os.path.exists(path):
+            stale = tempfile.mkdtemp(prefix=os.path.basename(path) + '.old-', dir=parent)
+            os.replace(path, os.path.join(stale, 'artifact'))
+            os.replace(tmp, path)
+            shutil.rmtree(stale, ignore_errors=True)
+        else:
+            os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def dictionary_fingerprint(dictionary):
+    """
+    dictionary: the self-defined word dictionary passed to GE2PE (or None).
+    returns a short hash of its content, so edits to the dictionary invalidate cached outputs. objects with a
+    fingerprint() (Lexicon, LexiconOverlay) are asked for theirs; a plain dict is hashed on every call, which
+    costs little next to decoding for the dictionaries users keep by hand.
+    """
+    if dictionary is None:
+        return 'none'
+    if hasattr(dictionary, 'fingerprint'):
+        return dictionary.fingerprint()
+    h = hashlib.sha1()
+    for word in sorted(dictionary):
+        h.update(word.encode('utf-8'))
+        h.update(b'\t')
+        h.update(str(dictionary[word]).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()[:16]
+
+
+class GE2PECache():
+
+    def __init__(self, path = None, max_memory_entries = 10000, max_disk_entries = 1000000, ttl = None):
+        """
+        path: sqlite file shared by all processes; None keeps the cache in memory only.
+        max_memory_entries: size of the in-process LRU in front of the sqlite store.
+        max_disk_entries: number of rows kept in the sqlite store before the least recently used are evicted.
+        ttl: seconds after which an entry is considered expired (None for no expiry).
+        """
+
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._conn = None
+        self._pid = None
+        if self.path is not None:
+            self._connect()
+
+    def _connect(self):
+        # sqlite connections must not cross a fork, so every process opens its own
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                           'created REAL NOT NULL, accessed REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._pid = os.getpid()
+        return self._conn
+
+    def make_key(self, text, *settings):
+        """
+        text: normalized input sentence.
+        settings: everything else the output depends on (model and dictionary fingerprints, flags, beams).
+        """
+        payload = json.dumps([text] + list(settings), ensure_ascii=False)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get_many(self, keys):
+        """
+        keys: list of keys built with make_key.
+        returns a dict of key -> cached output for the keys that were found.
+        """
+        now = time.time()
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                if key in found:
+                    continue
+                entry = self.memory.get(key)
+                if entry is not None and not self._expired(entry[1], now):
+                    self.memory.move_to_end(key)
+                    found[key] = entry[0]
+                else:
+                    if entry is not None:
+                        del self.memory[key]
+                    missing.append(key)
+            self.hits += len(found)
+
+        if missing and self.path is not None:
+            conn = self._connect()
+            rows = []
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i+500]
+                rows += conn.execute('SELECT key, value, created FROM entries WHERE key IN (%s)' % ','.join('?' * len(chunk)),
+                                     chunk).fetchall()
+            fresh = [row for row in rows if not self._expired(row[2], now)]
+            if fresh:
+                conn.execute('UPDATE entries SET accessed = ? WHERE key IN (%s)' % ','.join('?' * len(fresh)),
+                             [now] + [row[0] for row in fresh])
+            with self.lock:
+                for key, value, created in fresh:
+                    found[key] = value
+                    self._remember(key, value, created)
+                self.disk_hits += len(fresh)
+                self.hits += len(fresh)
+
+        with self.lock:
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def set_many(self, items):
+        """
+        items: dict of key -> output to store.
+        """
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            for key, value in items.items():
+                self._remember(key, value, now)
+        if self.path is not None:
+            conn = self._connect()
+            conn.executemany('INSERT OR REPLACE INTO entries (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                             [(key, value, now, now) for key, value in items.items()])
+            self._writes += len(items)
+            # trimming needs a count over the whole table, so only do it every so often
+            if self._writes >= max(1, self.max_disk_entries // 100):
+                self._writes = 0
+                self.evict()
+
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        """
+        drops expired rows and trims the sqlite store down to max_disk_entries.
+        """
+        if self.path is None:
+            return
+        conn = self._connect()
+        if self.ttl is not None:
+            conn.execute('DELETE FROM entries WHERE created < ?', (time.time() - self.ttl,))
+        count = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        if count > self.max_disk_entries:
+            conn.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed LIMIT ?)',
+                         (count - self.max_disk_entries,))
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        if self.path is not None:
+            self._connect().execute('DELETE FROM entries')
+
+    def stats(self):
+        """
+        returns the hit/miss counters of this process.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0, 'memory_entries': len(self.memory)}
@@ -11,4 +11,18 @@ OPENROUTER_MODEL   = os.getenv("OPENROUTER_MODEL", "google/gemini-2.5-flash")
 MODEL_PATH         = os.getenv("MODEL_PATH", "model-weights/homo-t5")
 PROMPT_FILE        = os.getenv("PROMPT_FILE", "prompt_base.txt")
 OPEN_ROUTER        = os.getenv("OPEN_ROUTER", "https://openrouter.ai/api/v1")
+METRICS_PORT       = int(os.getenv("METRICS_PORT", "8000"))
+CACHE_PATH         = os.getenv("CACHE_PATH") or None
+# seconds the app may spend phonemizing before outputs degrade (unset: always full beam search)
+G2P_DEADLINE       = float(os.getenv("G2P_DEADLINE", "0")) or None
+# HTTP service (server.py)
+SERVER_MAX_BATCH_SIZE = int(os.getenv("SERVER_MAX_BATCH_SIZE", "32"))
+SERVER_MAX_WAIT       = float(os.getenv("SERVER_MAX_WAIT", "0.01"))
+SERVER_MAX_QUEUE      = int(os.getenv("SERVER_MAX_QUEUE", "1024"))
+SERVER_TIMEOUT        = float(os.getenv("SERVER_TIMEOUT", "30"))
+SERVER_INTERACTIVE_MAX_BATCH_SIZE = int(os.getenv("SERVER_INTERACTIVE_MAX_BATCH_SIZE", "8"))
+SERVER_INTERACTIVE_MAX_QUEUE      = int(os.getenv("SERVER_INTERACTIVE_MAX_QUEUE", "64"))
+SERVER_CONTINUOUS = os.getenv("SERVER_CONTINUOUS", "0") == "1"
+SERVER_MAX_ROWS   = int(os.getenv("SERVER_MAX_ROWS", "64"))
+SERVER_DEADLINE   = float(os.getenv("SERVER_DEADLINE", "0")) or None
 # https://openrouter.ai/api/v1
\ No newline at end of file
@@ -0,0 +1,448 @@
+import time
+import random
+import argparse
+import threading
+from async_ge2pe import AsyncGE2PE
+from decoding import is_repeating, stop_reached
+
+NEG = -1e9
+
+
+class _Greedy():
+    """ greedy search of one sentence; occupies a single row. """
+
+    def __init__(self, start, eos, limit, repeat_window):
+        self.tokens = [start]
+        self.eos = eos
+        self.limit = limit
+        self.repeat_window = repeat_window
+        self.rows = 1
+
+    def last(self):
+        return self.tokens[-1:]
+
+    def step(self, logits):
+        """ logits: (1, vocab) of this step. returns (done, None) since the row never moves. """
+        self.tokens.append(int(logits[0].argmax()))
+        return stop_reached(self.tokens, self.eos, self.limit, self.repeat_window), None
+
+    def result(self):
+        return self.tokens
+
+    def partial(self):
+        return self.tokens
+
+
+class _Beams():
+    """
+    beam search of one sentence over num_beams rows, reproducing HuggingFace generate
+    (early_stopping=True, length_penalty=1.0) the way onnx_backend does for a whole batch.
+    """
+
+    def __init__(self, start, eos, limit, repeat_window, num_beams):
+        import torch
+        self.torch = torch
+        self.eos = eos
+        self.limit = limit
+        self.repeat_window = repeat_window
+        self.rows = num_beams
+        self.max_length = limit + 1
+        self.running = torch.full((num_beams, self.max_length + 1), eos, dtype=torch.long)
+        self.running[:, 0] = start
+        self.sequences = self.running.clone()
+        self.running_scores = torch.zeros(num_beams)
+        self.running_scores[1:] = NEG
+        self.beam_scores = torch.full((num_beams,), NEG)
+        self.finished = torch.zeros(num_beams, dtype=torch.bool)
+        self.unsatisfied = True
+        self.cur_len = 1
+
+    def last(self):
+        return self.running[:, self.cur_len - 1].tolist()
+
+    def _hits(self, candidates, cur_len):
+        window = self.repeat_window if self.repeat_window is not None and cur_len > self.repeat_window else 0
+        tails = candidates[:, max(0, cur_len - max(window, 1)):cur_len].tolist()
+        return self.torch.tensor([tail[-1] == self.eos or cur_len - 1 >= self.limit or cur_len >= self.max_length or
+                                  bool(window and is_repeating(tail, window)) for tail in tails], dtype=self.torch.bool)
+
+    def step(self, logits):
+        """
+        logits: (num_beams, vocab) of this step.
+        returns (done, source) where source[i] is the row the i-th beam continues from.
+        """
+        torch = self.torch
+        k, vocab = logits.shape
+        cur_len = self.cur_len
+        log_probs = torch.log_softmax(logits, dim=-1) + self.running_scores[:, None]
+        top_scores, top_indices = torch.topk(log_probs.view(-1), 2 * k)
+        source = top_indices // vocab
+        candidates = self.running[source].clone()
+        candidates[:, cur_len] = top_indices % vocab
+        hits = self._hits(candidates, cur_len + 1)
+
+        # best unfinished candidates keep running
+        self.running_scores, chosen = torch.topk(top_scores + hits.float() * NEG, k)
+        self.running = candidates[chosen]
+        beam_source = source[chosen]
+
+        # finished candidates among the top num_beams compete for the final hypotheses
+        just_finished = hits & (torch.arange(2 * k) < k)
+        final_scores = top_scores / cur_len + (~just_finished).float() * NEG
+        if self.finished.all() or not self.unsatisfied:
+            final_scores = final_scores + NEG
+        self.beam_scores, chosen = torch.topk(torch.cat([self.beam_scores, final_scores]), k)
+        self.sequences = torch.cat([self.sequences, candidates])[chosen]
+        self.finished = torch.cat([self.finished, just_finished])[chosen]
+
+        self.cur_len += 1
+        best_running = self.running_scores[0] / (self.cur_len - 1)
+        worst_finished = torch.where(self.finished, self.beam_scores.min(), torch.tensor(NEG))
+        self.unsatisfied = self.unsatisfied and bool((best_running > worst_finished).any())
+        done = not (self.unsatisfied and not self.finished.all() and not hits.all())
+        return done, beam_source
+
+    def result(self):
+        return self.sequences[0, :self.cur_len].tolist()
+
+    def partial(self):
+        """ the best hypothesis of a search stopped before it is done: a finished one, else the best running one. """
+        return self.result() if self.finished[0] else self.running[0, :self.cur_len].tolist()
+
+
+class _Sequence():
+
+    def __init__(self, lane, key, enqueued, deadline = None):
+        self.lane = lane
+        self.key = key
+        self.enqueued = enqueued
+        self.deadline = deadline
+        self.cut = False
+        self.search = None
+
+
+class ContinuousGE2PE(AsyncGE2PE):
+
+    def __init__(self, g2p, max_rows = 64, lanes = None):
+        """
+        g2p: a loaded GE2PE with the torch backend; only the scheduler thread of this wrapper calls its model.
+        max_rows: decoder rows stepped together; a sentence takes num_beams rows from the step it joins
+                  until the step it finishes.
+        lanes: optional list of async_ge2pe.Lane in priority order. A lane's max_batch_size caps how many of its
+               sentences decode at once (keep the bulk one below max_rows to leave room for interactive work),
+               and max_queue how many may wait; max_wait is not used since sentences join at the next step.
+        submit / generate / agenerate / stats behave as in AsyncGE2PE; a sentence whose callers all time out
+        leaves the decoding set at the next step. A sentence keeps its own deadline: it is read from the lexicon
+        when the deadline has passed before it joins, and cut at the first step past it (see GE2PE.generate).
+        """
+
+        if g2p.backend_name != 'torch':
+            raise ValueError('continuous batching steps the torch model, use backend="torch"')
+        import torch
+        self.torch = torch
+        self.max_rows = max_rows
+        self.model = g2p.model
+        self.device = 'cuda' if g2p.GPU else 'cpu'
+        config = self.model.config
+        self.start = config.decoder_start_token_id
+        self.eos = config.eos_token_id
+        self.cross = [block.layer[1].EncDecAttention for block in self.model.decoder.block]
+        self.active = []
+        self.steps = 0
+        self.stepped_rows = 0
+        self._reset()
+        super().__init__(g2p, max_batch_size=max_rows, max_wait=0.0, lanes=lanes)
+
+    def _reset(self):
+        """ drops all per-row decoder state. """
+        self.active = []
+        self.self_kv = None  # per layer [key, value] of shape (rows, heads, length, head dim), left padded
+        self.cross_kv = None  # per layer [key, value] of shape (rows, heads, encoder length, head dim), right padded
+        self.encoder_mask = None
+        self.pads = None  # left padding of every row in self_kv
+        self.length = 0
+
+    def _admit(self):
+        """ moves queued sentences into the decoding set while rows are free; blocks while there is nothing to do. """
+        admitted = []
+        with self.ready:
+            while not self.active and not self._next_lane():
+                self.ready.wait()
+            rows = sum(seq.search.rows for seq in self.active)
+            running = {}
+            for seq in self.active:
+                running[seq.lane.name] = running.get(seq.lane.name, 0) + 1
+            now = time.monotonic()
+            for lane in self.lanes.values():
+                while lane.queue and running.get(lane.name, 0) < lane.max_batch_size:
+                    key, enqueued = lane.queue[0]
+                    needed = key[4]
+                    if rows + needed > self.max_rows and (rows or admitted):
+                        break
+                    lane.queue.popleft()
+                    deadline = self.deadlines.pop(key, None)
+                    lane.waited += 1
+                    lane.wait_seconds += now - enqueued
+                    lane.waits.append(now - enqueued)
+                    if all(future.cancelled() for future in self.inflight[key]):
+                        # every caller of this sentence timed out or went away
+                        del self.inflight[key]
+                        lane.inflight -= 1
+                        lane.dropped += 1
+                        continue
+                    admitted.append(_Sequence(lane, key, enqueued, deadline))
+                    rows += needed
+                    running[lane.name] = running.get(lane.name, 0) + 1
+            for lane in {seq.lane for seq in admitted}:
+                lane.batches += 1
+        if self.on_wait is not None:
+            for seq in admitted:
+                self.on_wait(seq.lane.name, now - seq.enqueued)
+        return admitted
+
+    def _start(self, seqs):
+        """ normalizes, serves cache hits right away and tokenizes the rest; returns the sequences left to decode. """
+        g2p = self.g2p
+        todo = []
+        for seq in seqs:
+            _, text, use_rules, use_dict, num_beams, _ = seq.key
+            seq.text = g2p.normalize(text)
+            seq.keys, seq.found, seq.todo = g2p._lookup([seq.text], use_rules, use_dict, num_beams)
+            if seq.found:
+                self._deliver(seq, g2p._store(seq.keys, seq.found, seq.todo, [])[0])
+                continue
+            (seq.stripped,), (seq.token_ids,) = g2p._prepare([seq.text])
+            if seq.deadline is not None and time.monotonic() >= seq.deadline:
+                self._finish(seq, 'lexicon')
+                continue
+            seq.limit = g2p.decode_limits([len(seq.stripped)])[0]
+            if num_beams == 1:
+                seq.search = _Greedy(self.start, self.eos, seq.limit, g2p.repeat_window)
+            else:
+                seq.search = _Beams(self.start, self.eos, seq.limit, g2p.repeat_window, num_beams)
+            todo.append(seq)
+        return todo
+
+    def _join(self, seqs):
+        """ encodes the new sentences once, caches their cross-attention key/values and appends their rows. """
+        torch = self.torch
+        batch = self.g2p.tokenizer.pad({'input_ids': [seq.token_ids for seq in seqs]}, padding=True,
+                                       return_attention_mask=True, return_tensors='pt')
+        input_ids, mask = batch['input_ids'].to(self.device), batch['attention_mask'].to(self.device)
+        hidden = self.model.encoder(input_ids=input_ids, attention_mask=mask).last_hidden_state
+        for seq, n in zip(seqs, mask.sum(dim=1).tolist()):
+            seq.encoder_length = n
+        rows = torch.tensor([i for i, seq in enumerate(seqs) for _ in range(seq.search.rows)], device=self.device)
+        count, width = len(rows), hidden.shape[1]
+        cross_kv = []
+        for attn in self.cross:
+            key = attn.k(hidden).view(len(seqs), width, attn.n_heads, attn.key_value_proj_dim).transpose(1, 2)
+            value = attn.v(hidden).view(len(seqs), width, attn.n_heads, attn.key_value_proj_dim).transpose(1, 2)
+            cross_kv.append([key[rows], value[rows]])
+        mask = mask[rows]
+        heads, head_dim = cross_kv[0][0].shape[1], cross_kv[0][0].shape[3]
+        self_kv = [[hidden.new_zeros((count, heads, self.length, head_dim)) for _ in range(2)] for _ in cross_kv]
+        pads = torch.full((count,), self.length, dtype=torch.long, device=self.device)
+        if self.active:
+            width = max(width, self.encoder_mask.shape[1])
+            cross_kv = [[self._pad_to(torch.cat([self._pad_to(old, width), self._pad_to(new, width)]), width)
+                         for old, new in zip(old_layer, new_layer)] for old_layer, new_layer in zip(self.cross_kv, cross_kv)]
+            mask = torch.cat([self._pad_to(self.encoder_mask, width, dim=1), self._pad_to(mask, width, dim=1)])
+            self_kv = [[torch.cat([old, new]) for old, new in zip(old_layer, new_layer)]
+                       for old_layer, new_layer in zip(self.self_kv, self_kv)]
+            pads = torch.cat([self.pads, pads])
+        self.cross_kv, self.encoder_mask, self.self_kv, self.pads = cross_kv, mask, self_kv, pads
+        self.active.extend(seqs)
+
+    def _pad_to(self, tensor, width, dim = 2):
+        """ right-pads dimension dim of tensor with zeros up to width. """
+        missing = width - tensor.shape[dim]
+        if missing <= 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = missing
+        return self.torch.cat([tensor, tensor.new_zeros(shape)], dim=dim)
+
+    def _step(self):
+        """ runs the decoder one token further for every active row and retires the sentences that finished. """
+        torch = self.torch
+        from transformers.cache_utils import EncoderDecoderCache
+        rows = len(self.pads)
+        tokens = torch.tensor([token for seq in self.active for token in seq.search.last()], device=self.device).view(-1, 1)
+        cache = EncoderDecoderCache.from_legacy_cache(tuple((sk, sv, ck, cv) for (sk, sv), (ck, cv) in zip(self.self_kv, self.cross_kv)))
+        decoder_mask = (torch.arange(self.length + 1, device=self.device)[None, :] >= self.pads[:, None]).long()
+        # the cross-attention key/values come from the cache; the encoder states only give the shape
+        stub = self.cross_kv[0][0].new_zeros((1, 1, 1)).expand(rows, self.encoder_mask.shape[1], self.model.config.d_model)
+        out = self.model(encoder_outputs=(stub,), attention_mask=self.encoder_mask, decoder_input_ids=tokens,
+                         decoder_attention_mask=decoder_mask, past_key_values=cache, use_cache=True)
+        logits = out.logits[:, -1, :].float().cpu()
+        self.self_kv = [list(layer[:2]) for layer in out.past_key_values.to_legacy_cache()]
+        self.length += 1
+        self.steps += 1
+        self.stepped_rows += rows
+
+        with self.lock:
+            abandoned = {seq.key for seq in self.active if all(future.cancelled() for future in self.inflight[seq.key])}
+        order, kept, finished = [], [], []
+        row = 0
+        now = time.monotonic()
+        for seq in self.active:
+            done, source = seq.search.step(logits[row:row + seq.search.rows])
+            if not done and seq.deadline is not None and now >= seq.deadline:
+                seq.cut = True
+                done = True
+            if seq.key in abandoned:
+                # every caller timed out while it was decoding: free its rows
+                with self.lock:
+                    del self.inflight[seq.key]
+                    seq.lane.inflight -= 1
+                    seq.lane.dropped += 1
+            elif done:
+                finished.append(seq)
+            else:
+                kept.append(seq)
+                order.extend(row + i for i in (range(seq.search.rows) if source is None else source.tolist()))
+            row += seq.search.rows
+        if order != list(range(rows)):
+            # beams moved or rows left: rows of one sentence share their encoder, so one reordering fits all
+            index = torch.tensor(order, dtype=torch.long, device=self.device)
+            self.self_kv = [[kv.index_select(0, index) for kv in layer] for layer in self.self_kv]
+            self.cross_kv = [[kv.index_select(0, index) for kv in layer] for layer in self.cross_kv]
+            self.encoder_mask = self.encoder_mask.index_select(0, index)
+            self.pads = self.pads.index_select(0, index)
+        retired = len(kept) < len(self.active)
+        self.active = kept
+        if not kept:
+            self._reset()
+        elif retired:
+            self._trim()
+        for seq in finished:
+            self._finish(seq, 'cut' if seq.cut else None)
+
+    def _trim(self):
+        """ drops the padding no remaining row needs. """
+        cut = int(self.pads.min())
+        if cut:
+            self.self_kv = [[kv[:, :, cut:] for kv in layer] for layer in self.self_kv]
+            self.pads = self.pads - cut
+            self.length -= cut
+        width = max(seq.encoder_length for seq in self.active)
+        if width < self.encoder_mask.shape[1]:
+            self.cross_kv = [[kv[:, :, :width] for kv in layer] for layer in self.cross_kv]
+            self.encoder_mask = self.encoder_mask[:, :width]
+
+    def _finish(self, seq, strategy = None):
+        """ strategy: None for a finished search, 'cut' for one stopped at its deadline, 'lexicon' for none at all. """
+        g2p = self.g2p
+        _, _, use_rules, use_dict, _, _ = seq.key
+        if strategy == 'lexicon':
+            decoded = g2p._fallback(seq.stripped.split(' '))
+        else:
+            ids = seq.search.result() if strategy is None else seq.search.partial()
+            if g2p.backend.output_ids is not None:
+                ids = g2p.backend.output_ids[ids].tolist()
+            g2p._count_limits(self.torch.tensor([ids]), [seq.limit])
+            decoded = g2p.tokenizer.decode(ids, skip_special_tokens=True)
+            if strategy is not None:
+                decoded = g2p._complete(seq.stripped, decoded)
+        output = g2p._postprocess([seq.text], [seq.stripped], [decoded], use_rules, use_dict)[0]
+        degraded = set(seq.todo) if strategy is not None else set()
+        if seq.deadline is not None:
+            g2p._count_degraded(seq.keys, degraded, dict.fromkeys(seq.todo, strategy))
+        self._deliver(seq, g2p._store(seq.keys, seq.found, seq.todo, [output], degraded)[0], degraded=bool(degraded))
+
+    def _deliver(self, seq, output = None, error = None, degraded = False):
+        with self.lock:
+            waiters = self.inflight.pop(seq.key)
+            seq.lane.inflight -= 1
+        for future in waiters:
+            future.degraded = degraded
+            try:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(output)
+            except Exception:
+                pass  # cancelled by a caller that timed out
+
+    def _run(self):
+        with self.torch.inference_mode():
+            while True:
+                admitted = self._admit()
+                try:
+                    joining = self._start(admitted)
+                    if joining:
+                        self._join(joining)
+                    if self.active:
+                        self._step()
+                except Exception as e:
+                    for seq in self.active + [seq for seq in admitted if seq.key in self.inflight]:
+                        if seq.key in self.inflight:
+                            self._deliver(seq, error=e)
+                    self._reset()
+
+    def stats(self):
+        """ AsyncGE2PE.stats plus the decoder steps taken and the mean number of rows per step. """
+        stats = super().stats()
+        stats.update({'steps': self.steps, 'mean_rows': self.stepped_rows / self.steps if self.steps else 0.0,
+                      'active': len(self.active)})
+        return stats
+
+
+def run_traffic(wrapper, sentences, num_beams, rate = None):
+    """
+    submits sentences (all at once, or as a Poisson process of rate per second) and waits for all of them.
+    returns (seconds, per-sentence latencies).
+    """
+    latencies = [None] * len(sentences)
+    done = threading.Event()
+    remaining = [len(sentences)]
+    lock = threading.Lock()
+
+    def finished(i, started):
+        def callback(future):
+            latencies[i] = time.perf_counter() - started
+            with lock:
+                remaining[0] -= 1
+                if not remaining[0]:
+                    done.set()
+        return callback
+
+    start = time.perf_counter()
+    for i, text in enumerate(sentences):
+        wrapper.submit(text, num_beams=num_beams).add_done_callback(finished(i, time.perf_counter()))
+        if rate:
+            time.sleep(random.expovariate(rate))
+    done.wait()
+    return time.perf_counter() - start, latencies
+
+
+if __name__ == '__main__':
+    from GE2PE import GE2PE
+    from benchmarks.suite import make_inputs, percentile
+    parser = argparse.ArgumentParser(description='Check continuous batching against GE2PE.generate and compare its '
+                                                 'throughput with AsyncGE2PE on mixed-length traffic.')
+    parser.add_argument('model_path')
+    parser.add_argument('--sentences', type=int, default=96)
+    parser.add_argument('--num-beams', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--max-rows', type=int, default=64)
+    parser.add_argument('--max-batch-size', type=int, default=16, help='AsyncGE2PE batch size to compare with')
+    parser.add_argument('--rate', type=float, help='Poisson arrivals per second (default: everything at once)')
+    args = parser.parse_args()
+
+    g2p = GE2PE(model_path=args.model_path)
+    random.seed(0)
+    sentences = [text for length in ['short', 'medium', 'long'] for text in make_inputs(length, args.sentences // 3)]
+    random.shuffle(sentences)
+    sentences = [f'{text} {i}' for i, text in enumerate(sentences)]  # distinct, so nothing is merged
+    continuous = ContinuousGE2PE(g2p, max_rows=args.max_rows)
+    batched = AsyncGE2PE(g2p, max_batch_size=args.max_batch_size)
+    for num_beams in args.num_beams:
+        expected = g2p.generate(sentences, batch_size=args.max_batch_size, num_beams=num_beams)
+        mismatches = sum(a != b for a, b in zip(continuous.generate(sentences, num_beams=num_beams), expected))
+        print(f'num_beams={num_beams}: {mismatches} of {len(sentences)} outputs differ from GE2PE.generate')
+        for name, wrapper in [('AsyncGE2PE', batched), ('ContinuousGE2PE', continuous)]:
+            seconds, latencies = run_traffic(wrapper, sentences, num_beams, args.rate)
+            print(f'  {name:<16} {len(sentences) / seconds:8.1f} sentences/s  p50 {percentile(latencies, 50) * 1000:.0f}ms  '
+                  f'p95 {percentile(latencies, 95) * 1000:.0f}ms')
+    print(f"continuous: {continuous.stats()['steps']} steps, {continuous.stats()['mean_rows']:.1f} rows per step")
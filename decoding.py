@@ -0,0 +1,22 @@
+def is_repeating(tokens, window, max_period = 4):
+    """
+    returns True if the last window tokens are a pattern of at most max_period tokens repeated throughout.
+    """
+    if len(tokens) < window:
+        return False
+    tail = tokens[-window:]
+    for period in range(1, max_period + 1):
+        if all(tail[k] == tail[k - period] for k in range(period, window)):
+            return True
+    return False
+
+
+def stop_reached(tokens, eos, limit, repeat_window = None):
+    """
+    tokens: one decoded row, decoder start token included.
+    returns True once the row must stop, by the criteria the torch backend applies: eos, the row's token
+    budget (limit) or a repeated tail (see is_repeating).
+    """
+    if tokens[-1] == eos or len(tokens) - 1 >= limit:
+        return True
+    return repeat_window is not None and len(tokens) > repeat_window and is_repeating(tokens[-repeat_window:], repeat_window)
@@ -0,0 +1,228 @@
+import io
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+
+FORMATS = {'.txt': 'txt', '.csv': 'csv', '.jsonl': 'jsonl', '.parquet': 'parquet'}
+
+
+def detect_format(path):
+    return FORMATS.get(os.path.splitext(path)[1].lower(), 'txt')
+
+
+def iter_records(path, fmt):
+    """ yields every input row as a dict; a txt line becomes {'text': line}. """
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=4096):
+            yield from batch.to_pylist()
+        return
+    with open(path, encoding='utf-8', newline='' if fmt == 'csv' else None) as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        elif fmt == 'jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for line in f:
+                yield {'text': line.rstrip('\r\n')}
+
+
+def count_records(path, fmt):
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    if fmt == 'txt':
+        count = 0
+        last = b'\n'
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                count += block.count(b'\n')
+                last = block[-1:]
+        return count + (last != b'\n')
+    return sum(1 for _ in iter_records(path, fmt))
+
+
+def iter_chunks(records, chunk_size, skip = 0):
+    chunk = []
+    for i, record in enumerate(records):
+        if i < skip:
+            continue
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Output():
+
+    def __init__(self, path, fmt, column, position = 0):
+        """
+        path: output file, or a directory of part files for parquet.
+        fmt: one of txt, csv, jsonl, parquet; txt writes only the phonemes, the others the input row plus column.
+        column: name of the phonemes field.
+        position: bytes (or parquet parts) written by the checkpointed run; anything after it is dropped.
+        """
+
+        self.path = path
+        self.fmt = fmt
+        self.column = column
+        self.position = position
+        self.fields = None
+        if fmt == 'parquet':
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if name.startswith('part-') and int(name[5:10]) >= position:
+                    os.remove(os.path.join(path, name))
+            return
+        with open(path, 'ab') as f:
+            f.truncate(position)
+        if fmt == 'csv' and position:
+            with open(path, encoding='utf-8', newline='') as f:
+                self.fields = next(csv.reader(f))
+
+    def write(self, records, phonemes):
+        """ appends one chunk durably and returns the new position to checkpoint. """
+        rows = [{**record, self.column: output} for record, output in zip(records, phonemes)]
+        if self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            part = os.path.join(self.path, f'part-{self.position:05d}.parquet')
+            pq.write_table(pa.Table.from_pylist(rows), part + '.tmp')
+            os.replace(part + '.tmp', part)
+            self.position += 1
+            return self.position
+        buf = io.StringIO(newline='')
+        if self.fmt == 'csv':
+            if self.fields is None:
+                self.fields = list(rows[0])
+                csv.writer(buf).writerow(self.fields)
+            csv.DictWriter(buf, self.fields, extrasaction='ignore').writerows(rows)
+        elif self.fmt == 'jsonl':
+            for row in rows:
+                buf.write(json.dumps(row, ensure_ascii=False) + '\n')
+        else:
+            for output in phonemes:
+                buf.write(output + '\n')
+        with open(self.path, 'ab') as f:
+            f.write(buf.getvalue().encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self.position = f.tell()
+        return self.position
+
+
+def load_checkpoint(path, state):
+    """ returns the saved checkpoint if it belongs to the same input and settings, None if there is none. """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        saved = json.load(f)
+    if {k: saved.get(k) for k in state} != state:
+        raise SystemExit(f'{path} was written for another input or other settings; pass --restart to start over')
+    return saved
+
+
+def save_checkpoint(path, state, rows, position):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({**state, 'rows': rows, 'position': position}, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def progress(done, total, started_rows, start, out = sys.stderr):
+    elapsed = time.perf_counter() - start
+    rate = (done - started_rows) / elapsed if elapsed else 0.0
+    eta = format_eta((total - done) / rate) if rate and total is not None else '?'
+    share = f'/{total} ({done / total:.1%})' if total else ''
+    out.write(f'\r{done}{share} rows  {rate:.1f} rows/s  ETA {eta}   ')
+    out.flush()
+
+
+def run(args, log = sys.stderr):
+    in_fmt = args.input_format or detect_format(args.input)
+    out_fmt = args.output_format or detect_format(args.output)
+    checkpoint = args.checkpoint or args.output.rstrip('/\\') + '.ckpt'
+    info = os.stat(args.input)
+    state = {'input': os.path.abspath(args.input), 'input_size': info.st_size, 'input_mtime': info.st_mtime,
+             'output': os.path.abspath(args.output), 'model_path': args.model_path, 'column': args.column,
+             'output_column': args.output_column, 'use_rules': args.use_rules, 'use_dict': args.use_dict,
+             'num_beams': args.num_beams, 'lexicon': args.lexicon}
+    saved = None if args.restart else load_checkpoint(checkpoint, state)
+    done, position = (saved['rows'], saved['position']) if saved else (0, 0)
+    total = count_records(args.input, in_fmt)
+    if done >= total:
+        log.write(f'{args.output} is already complete ({done} rows)\n')
+        return done
+    if done:
+        log.write(f'resuming after {done} rows from {checkpoint}\n')
+
+    kwargs = {'backend': args.backend, 'precision': args.precision}
+    if args.lexicon:
+        from lexicon_store import Lexicon
+        kwargs['dictionary'] = Lexicon(args.lexicon)
+    if args.workers > 1:
+        from pool import GE2PEPool
+        g2p = GE2PEPool(args.model_path, workers=args.workers, threads_per_worker=args.threads_per_worker, **kwargs)
+    else:
+        from GE2PE import GE2PE
+        g2p = GE2PE(model_path=args.model_path, **kwargs)
+
+    output = Output(args.output, out_fmt, args.output_column, position)
+    start = time.perf_counter()
+    started = done
+    try:
+        for chunk in iter_chunks(iter_records(args.input, in_fmt), args.chunk_size, skip=done):
+            texts = [record.get(args.column) if args.column else next(iter(record.values()), None) for record in chunk]
+            texts = ['' if text is None else str(text) for text in texts]
+            todo = [i for i, text in enumerate(texts) if text.strip()]
+            phonemes = [''] * len(texts)  # blank rows are not sent to the model
+            outputs = g2p.generate([texts[i] for i in todo], batch_size=args.batch_size, use_rules=args.use_rules,
+                                   use_dict=args.use_dict, num_beams=args.num_beams, max_tokens=args.max_tokens) if todo else []
+            for i, out in zip(todo, outputs):
+                phonemes[i] = out
+            position = output.write(chunk, phonemes)
+            done += len(chunk)
+            save_checkpoint(checkpoint, state, done, position)
+            progress(done, total, started, start, log)
+    finally:
+        if args.workers > 1:
+            g2p.close()
+    elapsed = time.perf_counter() - start
+    log.write(f'\n{done - started} rows in {elapsed:.1f}s written to {args.output}\n')
+    return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Phonemize a TXT/CSV/JSONL/Parquet file in resumable chunks.')
+    parser.add_argument('model_path')
+    parser.add_argument('input')
+    parser.add_argument('output', help='txt/csv/jsonl file, or a directory of parquet parts for .parquet')
+    parser.add_argument('--input-format', choices=sorted(set(FORMATS.values())), help='default: from the extension')
+    parser.add_argument('--output-format', choices=sorted(set(FORMATS.values())), help='default: from the extension')
+    parser.add_argument('--column', help='field holding the text (default: the first field; "text" for txt input)')
+    parser.add_argument('--output-column', default='phonemes')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='rows read, phonemized and checkpointed at a time')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-tokens', type=int, help='length-sorted batching budget, see GE2PE.generate')
+    parser.add_argument('--num-beams', type=int, default=5)
+    parser.add_argument('--use-rules', action='store_true')
+    parser.add_argument('--use-dict', action='store_true')
+    parser.add_argument('--lexicon', help='compiled lexicon (lexicon_store.py) used with --use-dict')
+    parser.add_argument('--workers', type=int, default=1, help='more than 1 forks a GE2PEPool')
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'])
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument('--checkpoint', help='default: <output>.ckpt')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint and start over')
+    run(parser.parse_args())
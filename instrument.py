@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import threading
+from html import escape
+try:
+    import psutil
+except ImportError:  # optional, only read where /proc/self/statm is missing
+    psutil = None
+
+
+class _Stage():
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def __exit__(self, *exc):
+        times = self.stages.setdefault(self.name, {'wall': 0.0, 'cpu': 0.0})
+        times['wall'] += time.perf_counter() - self.wall
+        times['cpu'] += time.process_time() - self.cpu
+
+
+class _NoStage():
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NO_STAGE = _NoStage()
+
+
+def stage(record, name):
+    """
+    record: a call or batch record (a dict with a 'stages' dict), or None when nothing is listening.
+    returns a context manager adding the wall and CPU (all threads) seconds of the block to record['stages'][name].
+    """
+    return NO_STAGE if record is None else _Stage(record['stages'], name)
+
+
+def rss_mb():
+    """ resident set size of the process now, from /proc/self/statm on Linux or psutil elsewhere (None without either). """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss / 2**20
+
+
+class PeakMemory():
+    """
+    measures the memory peak of a with block, read from peak_mb afterwards: the GPU memory allocated at most, or
+    on CPU the highest resident set size polled every interval seconds while the block runs (so, unlike the
+    process-lifetime ru_maxrss, it belongs to this block).
+    """
+
+    def __init__(self, GPU = False, interval = 0.002):
+        self.GPU = GPU
+        self.interval = interval
+        self.peak_mb = None
+        self.done = None
+        self.thread = None
+
+    def __enter__(self):
+        if self.GPU:
+            import torch
+            torch.cuda.reset_peak_memory_stats()
+            return self
+        self.peak_mb = rss_mb()
+        if self.peak_mb is not None:
+            self.done = threading.Event()
+            self.thread = threading.Thread(target=self._poll, daemon=True)
+            self.thread.start()
+        return self
+
+    def _poll(self):
+        while not self.done.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, rss_mb())
+
+    def __exit__(self, *exc):
+        if self.GPU:
+            import torch
+            self.peak_mb = torch.cuda.max_memory_allocated() / 2**20
+        elif self.thread is not None:
+            self.done.set()
+            self.thread.join()
+            self.peak_mb = max(self.peak_mb, rss_mb())
+
+
+class SamplingProfiler():
+
+    def __init__(self, path, calls = 10, interval = 0.005):
+        """
+        path: output file; '.svg' writes a flamegraph, anything else the folded stacks ('a;b;c count' lines)
+              read by flamegraph.pl, inferno or speedscope.
+        calls: number of generate calls to sample before the file is written.
+        interval: seconds between two samples of the calling thread's stack.
+        """
+
+        self.path = path
+        self.calls = calls
+        self.interval = interval
+        self.counts = {}
+        self.done = 0
+        self.active = None
+        self.thread = None
+
+    def start(self):
+        self.active = threading.Event()
+        self.thread = threading.Thread(target=self._sample, args=(threading.get_ident(), self.active), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ ends one sampled call; returns True once the last call is sampled and the file is written. """
+        self.active.set()
+        self.thread.join()
+        self.done += 1
+        if self.done < self.calls:
+            return False
+        self.write()
+        return True
+
+    def _sample(self, ident, stopped):
+        while not stopped.wait(self.interval):
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            if self.path.endswith('.svg'):
+                f.write(flamegraph_svg(self.counts))
+            else:
+                for stack, count in sorted(self.counts.items()):
+                    f.write(f'{stack} {count}\n')
+
+
+def flamegraph_svg(counts, width = 1200, row = 16):
+    """
+    counts: folded stacks ('a;b;c' -> samples).
+    returns a minimal flamegraph (root at the bottom, hover a frame for its name and share of samples).
+    """
+    tree = {}
+    for stack, count in counts.items():
+        node = tree
+        for name in stack.split(';'):
+            child = node.setdefault(name, [0, {}])
+            child[0] += count
+            node = child[1]
+    total = sum(counts.values()) or 1
+    rects = []
+
+    def layout(node, x, depth):
+        for name, (count, children) in sorted(node.items()):
+            w = width * count / total
+            rects.append((x, depth, w, name, count))
+            layout(children, x, depth + 1)
+            x += w
+
+    layout(tree, 0.0, 0)
+    height = (max((depth for _, depth, _, _, _ in rects), default=0) + 1) * row
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">']
+    for x, depth, w, name, count in rects:
+        y = height - (depth + 1) * row
+        hue = 20 + sum(map(ord, name)) % 40
+        label = escape(name[:int(w / 7)]) if w > 21 else ''
+        parts.append(f'<g><title>{escape(name)} ({count} samples, {count / total:.1%})</title>'
+                     f'<rect x="{x:.1f}" y="{y}" width="{max(w - 0.5, 0.1):.1f}" height="{row - 1}" fill="hsl({hue},90%,60%)"/>'
+                     f'<text x="{x + 2:.1f}" y="{y + row - 4}">{label}</text></g>')
+    parts.append('</svg>\n')
+    return '\n'.join(parts)
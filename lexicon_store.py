@@ -0,0 +1,215 @@
+import os
+import csv
+import mmap
+import time
+import struct
+import hashlib
+import argparse
+import threading
+from cache import dictionary_fingerprint
+
+# file layout: header, then one fixed-size index entry per word sorted by its utf-8 bytes,
+# then the key and value bytes the index entries point to
+MAGIC = b'GE2PELX1'
+HEADER = struct.Struct('<8sQ20s4x')  # magic, number of entries, sha1 of the content
+ENTRY = struct.Struct('<QII')  # offset of the key, key length, value length (value follows the key)
+
+
+def read_entries(path, key_column = 'Grapheme', value_column = 'Mapped Phoneme'):
+    """
+    path: a .csv file, or a tab-separated file with one 'word<TAB>phonemes' pair per line ('#' starts a comment).
+    key_column, value_column: csv columns holding the word and its phonemes; a csv without these headers is
+                              read as (word, phonemes) in its first two columns.
+    yields (word, phonemes) pairs.
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            rows = csv.reader(f)
+            header = next(rows, [])
+            if key_column in header and value_column in header:
+                k, v = header.index(key_column), header.index(value_column)
+            else:
+                k, v = 0, 1
+                if len(header) > 1 and header[0]:
+                    yield header[0], header[1]
+        else:
+            rows = (line.rstrip('\r\n').split('\t') for line in f if line.strip() and not line.startswith('#'))
+            k, v = 0, 1
+        for row in rows:
+            if len(row) > max(k, v) and row[k]:
+                yield row[k], row[v]
+
+
+def compile_lexicon(source, output, key_column = 'Grapheme', value_column = 'Mapped Phoneme'):
+    """
+    source: TSV/CSV lexicon (see read_entries) or a dict of word -> phonemes.
+    output: path of the compiled lexicon; it is written next to it and renamed into place, so a running
+            Lexicon never sees a half-written file and reloads the new one on its next check.
+    returns the number of entries; for duplicated words the last one wins.
+    """
+    entries = dict(source) if isinstance(source, dict) else dict(read_entries(source, key_column, value_column))
+    items = sorted((word.encode('utf-8'), phonemes.encode('utf-8')) for word, phonemes in entries.items())
+    h = hashlib.sha1()
+    for key, value in items:
+        h.update(key + b'\t' + value + b'\n')
+    offset = HEADER.size + ENTRY.size * len(items)
+    index = bytearray()
+    for key, value in items:
+        index += ENTRY.pack(offset, len(key), len(value))
+        offset += len(key) + len(value)
+    tmp = output + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(items), h.digest()))
+        f.write(index)
+        for key, value in items:
+            f.write(key)
+            f.write(value)
+    os.replace(tmp, output)
+    return len(items)
+
+
+class Lexicon():
+
+    def __init__(self, path, check_interval = 1.0):
+        """
+        path: a lexicon compiled by compile_lexicon.
+        check_interval: seconds between checks of the file for a newer version (None never reloads).
+        the file is memory-mapped, so opening it costs the same for any size and all processes
+        using it share one copy in the page cache.
+        """
+
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.lock = threading.Lock()
+        self.checked = time.monotonic()
+        self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, digest = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a compiled GE2PE lexicon')
+        # swapped as one tuple, so lookups running on other threads see either the old or the new file
+        self.state = (mm, count, digest.hex()[:16], (st.st_ino, st.st_size, st.st_mtime_ns))
+
+    def _check(self):
+        now = time.monotonic()
+        if self.check_interval is None or now - self.checked < self.check_interval:
+            return
+        with self.lock:
+            if now - self.checked < self.check_interval:
+                return
+            self.checked = now
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                return  # keep serving the mapped version until a new file appears
+            if (st.st_ino, st.st_size, st.st_mtime_ns) != self.state[3]:
+                self._load()
+                self.reloads += 1
+
+    def get(self, word, default = None):
+        """
+        returns the phonemes of word, or default when it is not in the lexicon (a binary search over the index).
+        """
+        self._check()
+        mm, count, _, _ = self.state
+        key = word.encode('utf-8')
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, key_length, value_length = ENTRY.unpack_from(mm, HEADER.size + mid * ENTRY.size)
+            probe = mm[offset:offset + key_length]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return mm[offset + key_length:offset + key_length + value_length].decode('utf-8')
+        return default
+
+    def __getitem__(self, word):
+        phonemes = self.get(word)
+        if phonemes is None:
+            raise KeyError(word)
+        return phonemes
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __len__(self):
+        self._check()
+        return self.state[1]
+
+    def items(self):
+        mm, count, _, _ = self.state
+        for i in range(count):
+            offset, key_length, value_length = ENTRY.unpack_from(mm, HEADER.size + i * ENTRY.size)
+            yield (mm[offset:offset + key_length].decode('utf-8'),
+                   mm[offset + key_length:offset + key_length + value_length].decode('utf-8'))
+
+    def __iter__(self):
+        return (word for word, _ in self.items())
+
+    def fingerprint(self):
+        """ returns the content hash stored by compile_lexicon, used by GE2PECache to key outputs. """
+        self._check()
+        return self.state[2]
+
+    def overlay(self, entries):
+        return LexiconOverlay(self, entries)
+
+    def __getstate__(self):
+        # pickled (e.g. to GE2PEPool workers) as its path; the copy maps the file again
+        return {'path': self.path, 'check_interval': self.check_interval}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['check_interval'])
+
+
+class LexiconOverlay():
+
+    def __init__(self, base, entries):
+        """
+        base: a Lexicon (or dict) that is looked up but never copied.
+        entries: dict of words that take precedence over base, e.g. the custom words of one request.
+        """
+
+        self.base = base
+        self.entries = entries
+
+    def get(self, word, default = None):
+        phonemes = self.entries.get(word)
+        if phonemes is None:
+            return self.base.get(word, default)
+        return phonemes
+
+    def __getitem__(self, word):
+        phonemes = self.get(word)
+        if phonemes is None:
+            raise KeyError(word)
+        return phonemes
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def fingerprint(self):
+        h = hashlib.sha1()
+        h.update(dictionary_fingerprint(self.base).encode('utf-8'))
+        h.update(dictionary_fingerprint(self.entries).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile a TSV/CSV lexicon into the memory-mapped GE2PE format.')
+    parser.add_argument('source')
+    parser.add_argument('output')
+    parser.add_argument('--key-column', default='Grapheme')
+    parser.add_argument('--value-column', default='Mapped Phoneme')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    count = compile_lexicon(args.source, args.output, args.key_column, args.value_column)
+    print(f'{count} entries, {os.path.getsize(args.output) / 2**20:.1f} MB, {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import itertools
+import subprocess
+import threading
+import requests
+from benchmarks.suite import SENTENCES, percentile
+
+
+def make_texts(count):
+    """ distinct two-sentence inputs, so in-flight merging of identical sentences does not flatter the numbers. """
+    pairs = itertools.cycle(itertools.permutations(SENTENCES, 2))
+    return [f'{a}، {b} {i}' for i, (a, b) in zip(range(count), pairs)]
+
+
+def run_load(url, concurrency, total, num_beams = 5, timeout = 60, lane = None):
+    """
+    posts total single-sentence /phonemize requests from concurrency threads, on lane (default: the server's).
+    returns throughput (requests/s), p50 and p95 latency in ms and the number of failed requests.
+    """
+    texts = iter(make_texts(total))
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                text = next(texts, None)
+            if text is None:
+                return
+            start = time.perf_counter()
+            try:
+                response = session.post(f'{url}/phonemize', json={'text': text, 'num_beams': num_beams, 'lane': lane},
+                                        timeout=timeout)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors[0] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'throughput': len(latencies) / elapsed, 'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000, 'errors': errors[0]}
+
+
+def bulk_traffic(url, concurrency, batch_size, num_beams = 5):
+    """
+    keeps concurrency threads posting batches of batch_size texts to the bulk lane until the returned event is set.
+    """
+    stop = threading.Event()
+
+    def client():
+        session = requests.Session()
+        texts = make_texts(batch_size * 50)
+        for i in itertools.count():
+            if stop.is_set():
+                return
+            batch = texts[i % 50 * batch_size:(i % 50 + 1) * batch_size]
+            try:
+                session.post(f'{url}/phonemize', json={'texts': batch, 'num_beams': num_beams, 'lane': 'bulk'}, timeout=300)
+            except requests.RequestException:
+                time.sleep(0.1)
+
+    for _ in range(concurrency):
+        threading.Thread(target=client, daemon=True).start()
+    return stop
+
+
+def wait_ready(url, proc = None, timeout = 600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f'server exited with code {proc.returncode}')
+        try:
+            if requests.get(f'{url}/ready', timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    raise TimeoutError(f'{url} not ready after {timeout}s')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(model_path, max_batch_size, max_wait):
+    port = free_port()
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    proc = subprocess.Popen([sys.executable, server, model_path, '--host', '127.0.0.1', '--port', str(port),
+                             '--max-batch-size', str(max_batch_size), '--interactive-batch-size', str(max_batch_size),
+                             '--max-wait', str(max_wait)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc, f'http://127.0.0.1:{port}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for server.py; shows the throughput gained from batching.')
+    parser.add_argument('--url', default='http://localhost:8080', help='server to load (ignored with --model-path)')
+    parser.add_argument('--model-path', help='start one server per --batch-sizes value and compare them')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 32])
+    parser.add_argument('--max-wait', type=float, default=0.01)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='requests per concurrency level')
+    parser.add_argument('--num-beams', type=int, default=5)
+    parser.add_argument('--lane', choices=['interactive', 'bulk'], help='lane of the measured requests')
+    parser.add_argument('--bulk-concurrency', type=int, default=0,
+                        help='clients sending bulk batches in the background while measuring')
+    parser.add_argument('--bulk-batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    print('| max batch | concurrency | requests/s | p50 ms | p95 ms | errors |')
+    print('|---|---|---|---|---|---|')
+    for batch_size in (args.batch_sizes if args.model_path else [None]):
+        proc, url = start_server(args.model_path, batch_size, args.max_wait) if args.model_path else (None, args.url)
+        try:
+            wait_ready(url, proc)
+            run_load(url, 1, 2, args.num_beams)  # warm-up
+            bulk = bulk_traffic(url, args.bulk_concurrency, args.bulk_batch_size, args.num_beams) if args.bulk_concurrency else None
+            for concurrency in args.concurrency:
+                result = run_load(url, concurrency, args.requests, args.num_beams, lane=args.lane)
+                print(f"| {batch_size or 'server'} | {concurrency} | {result['throughput']:.1f} | {result['p50_ms']:.0f} | "
+                      f"{result['p95_ms']:.0f} | {result['errors']} |", flush=True)
+            if bulk is not None:
+                bulk.set()
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
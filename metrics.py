@@ -0,0 +1,149 @@
+import time
+import threading
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Histogram, start_http_server, make_asgi_app
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+
+# stages of the app's button handler: validation, g2p, llm, tts_input, tts_llm
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram('ge2pe_stage_seconds', 'Wall time of one stage of the pipeline.', ['stage'],
+                          buckets=STAGE_BUCKETS)
+PIPELINE_SECONDS = Histogram('ge2pe_pipeline_seconds', 'Wall time of one button click, from validation to the last speech.',
+                             buckets=STAGE_BUCKETS)
+MODEL_STAGE_SECONDS = Histogram('ge2pe_model_stage_seconds', 'Wall time of one stage inside GE2PE.generate.', ['stage'],
+                                buckets=STAGE_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram('ge2pe_queue_wait_seconds', 'Time a sentence waited for its batch to start, by lane.',
+                               ['lane'], buckets=STAGE_BUCKETS)
+ERRORS = Counter('ge2pe_errors', 'Requests that failed, by stage.', ['stage'])
+LLM_TOKENS = Counter('ge2pe_llm_tokens', 'Tokens reported by the LLM API.', ['kind'])
+TTS_BYTES = Counter('ge2pe_tts_bytes', 'Bytes of synthesized audio.', ['source'])
+TTS_CHARACTERS = Counter('ge2pe_tts_characters', 'Characters of text sent to speech synthesis.', ['source'])
+# exported by the global REGISTRY and by every registry of make_registry
+SHARED_METRICS = (STAGE_SECONDS, PIPELINE_SECONDS, MODEL_STAGE_SECONDS, QUEUE_WAIT_SECONDS, ERRORS, LLM_TOKENS, TTS_BYTES,
+                  TTS_CHARACTERS)
+
+_server_lock = threading.Lock()
+_server_port = None
+
+
+@contextmanager
+def timed_stage(name):
+    """
+    observes the seconds spent inside the block in ge2pe_stage_seconds{stage=name}; an exception leaving the
+    block is counted in ge2pe_errors{stage=name} and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(name).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def record_llm_usage(usage):
+    """ usage: the `usage` of a chat completion response (may be None when the provider omits it). """
+    if usage is None:
+        return
+    LLM_TOKENS.labels('prompt').inc(usage.prompt_tokens or 0)
+    LLM_TOKENS.labels('completion').inc(usage.completion_tokens or 0)
+
+
+def record_tts(source, text, audio):
+    TTS_CHARACTERS.labels(source).inc(len(text))
+    TTS_BYTES.labels(source).inc(len(audio))
+
+
+def observe_generate(record):
+    """ GE2PE hook (g2p.add_hook(observe_generate)) exporting the stages of every generate call and batch. """
+    for name, times in record['stages'].items():
+        MODEL_STAGE_SECONDS.labels(name).observe(times['wall'])
+    for batch in record['batches']:
+        for name, times in batch['stages'].items():
+            MODEL_STAGE_SECONDS.labels(name).observe(times['wall'])
+
+
+class G2PCollector():
+    """ reads the counters GE2PE and its wrappers already keep, at scrape time. """
+
+    def __init__(self, g2p):
+        """
+        g2p: a GE2PE, or an AsyncGE2PE wrapping one.
+        """
+
+        self.g2p = g2p
+
+    def collect(self):
+        model = getattr(self.g2p, 'g2p', self.g2p)
+        if model.cache is not None:
+            stats = model.cache.stats()
+            hits = CounterMetricFamily('ge2pe_cache_hits', 'Sentences served from the result cache.', labels=['tier'])
+            hits.add_metric(['memory'], stats['hits'] - stats['disk_hits'])
+            hits.add_metric(['disk'], stats['disk_hits'])
+            yield hits
+            yield CounterMetricFamily('ge2pe_cache_misses', 'Sentences the result cache did not hold.',
+                                      value=stats['misses'])
+        if model is not self.g2p:
+            lanes = self.g2p.stats()['lanes']
+            families = [CounterMetricFamily('ge2pe_requests', 'Sentences submitted to the inference thread.', labels=['lane']),
+                        CounterMetricFamily('ge2pe_requests_merged', 'Sentences merged with an identical in-flight one.', labels=['lane']),
+                        CounterMetricFamily('ge2pe_requests_rejected', 'Sentences refused because their lane was full.', labels=['lane']),
+                        CounterMetricFamily('ge2pe_requests_dropped', 'Queued sentences dropped after their callers timed out.', labels=['lane']),
+                        CounterMetricFamily('ge2pe_batches', 'Batched generate calls of the inference thread.', labels=['lane']),
+                        GaugeMetricFamily('ge2pe_queued', 'Distinct sentences queued or decoding.', labels=['lane'])]
+            for name, stats in lanes.items():
+                for family, key in zip(families, ['requests', 'merged', 'rejected', 'dropped', 'batches', 'inflight']):
+                    family.add_metric([name], stats[key])
+            yield from families
+        decode = CounterMetricFamily('ge2pe_decode_stops', 'Rows stopped early while decoding.', labels=['reason'])
+        decode.add_metric(['length_cap'], model.decode_stats['length_cap_hits'])
+        decode.add_metric(['repetition'], model.decode_stats['repetition_stops'])
+        yield decode
+        stats = model.degrade_stats
+        yield CounterMetricFamily('ge2pe_deadline_requests', 'Generate calls given a deadline.', value=stats['requests'])
+        yield CounterMetricFamily('ge2pe_degraded_requests', 'Generate calls with a deadline that degraded some output.',
+                                  value=stats['degraded_requests'])
+        degraded = CounterMetricFamily('ge2pe_degraded_sentences', 'Sentences phonemized below the requested beam width '
+                                       'to meet a deadline.', labels=['strategy'])
+        for strategy, count in stats['strategies'].items():
+            degraded.add_metric([strategy], count)
+        yield degraded
+
+
+def make_registry():
+    """
+    returns a new registry exporting the module-level metrics, for one app to register its g2p in; several apps in
+    one process would otherwise collide on the collectors of the global REGISTRY.
+    """
+    registry = CollectorRegistry()
+    for metric in SHARED_METRICS:
+        registry.register(metric)
+    return registry
+
+
+def register_g2p(g2p, registry = REGISTRY):
+    """
+    exports the cache, micro-batching (per lane), decoding and deadline counters of g2p in registry, hooks
+    observe_generate into it and observes the queue wait of every sentence of an AsyncGE2PE.
+    """
+    model = getattr(g2p, 'g2p', g2p)
+    model.add_hook(observe_generate)
+    if model is not g2p:
+        g2p.on_wait = lambda lane, seconds: QUEUE_WAIT_SECONDS.labels(lane).observe(seconds)
+    registry.register(G2PCollector(g2p))
+    return g2p
+
+
+def serve(port):
+    """
+    starts the /metrics endpoint on a daemon thread of this process; later calls (e.g. Streamlit reruns) are no-ops.
+    returns the port being served.
+    """
+    global _server_port
+    with _server_lock:
+        if _server_port is None:
+            start_http_server(port)
+            _server_port = port
+    return _server_port
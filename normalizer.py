@@ -0,0 +1,396 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import itertools
+
+# target -> characters rewritten to it; the composition of the replacement chain of Parsivar's sub_alphabets
+# (including its quirks, e.g. the initial form of noon becoming ذ), applied in a single str.translate
+LETTERS = {
+    'ئ': 'ء',
+    'آ': 'ﺁ',
+    'ا': 'ٲٱإﺍأ',
+    'ب': 'ﺏﺐﺑ',
+    'پ': 'ﭖﭗﭘﭙﺒ',
+    'ت': 'ٹٺټٿﭞﭡﺕﺖﺗﺘ',
+    'ث': 'ﺙﺛ',
+    'ج': 'ڃﺝﺟﺠ',
+    'چ': 'ﭼﭽ',
+    'ح': 'ځڅﺢﺣﺤ',
+    'خ': 'ﺥﺦﺧﺨ',
+    'د': 'ډڏﺩﺪ',
+    'ذ': 'ﺫﺬﻧ',
+    'ر': 'ڑڒڕڗڙﺭﺮ',
+    'ز': 'ﺯﺰ',
+    'ژ': 'ﮊ',
+    'س': 'ښݜݭﺱﺲﺳﺴ',
+    'ش': 'ﺵﺶﺷﺸ',
+    'ص': 'ﺺﺻﺼ',
+    'ض': 'ﺽﺾﺿﻀ',
+    'ط': 'ﻁﻂﻃﻄ',
+    'ظ': 'ﻆﻇﻈ',
+    'ع': 'ڠﻉﻊﻋ',
+    'غ': 'ۼﻍﻎﻏﻐ',
+    'ف': 'ﻑﻒﻓﻔ',
+    'ق': 'ڤﻕﻖﻗ',
+    'ک': 'كڪګڭﮎﮏﮐﮑﻚﻛﻜ',
+    'گ': 'ﮒﮓﮔﮕﮚ',
+    'ل': 'ڵﻝﻞﻠ',
+    'م': 'ﻡﻢﻣﻤ',
+    'ن': 'ڼﻥﻦﻨ',
+    'و': 'ؤۅۇۈۉۊۋۏވﯙﺆﻭﻮ',
+    'ه': 'ةھۀہەﺔﻩﻪﻫﻬ',
+    'ی': 'ىيںۍێېےﭛﯼﯽﯾﯿﻯﻰﻱﻲﻳﻴ',
+    '‌': '¬',
+    '.': '··•∙●ⴰ・｡',
+    '،': ',٫٬‚，',
+    '؟': 'ʕ',
+    '0': '٠۰',
+    '1': '١۱',
+    '2': '٢۲',
+    '3': '٣۳',
+    '4': '٤۴',
+    '5': '۵',
+    '6': '٦۶',
+    '7': '٧۷',
+    '8': '٨۸',
+    '9': '٩۹',
+}
+# short vowels are kept by default: GE2PE strips them before the model and re-applies them with its rules
+SHORT_VOWELS = 'ِ' + 'ُ' + 'َ'
+REMOVED = 'ـ' + 'ٍ' + 'ٌ' + 'ً'
+STRIP_DIACRITICS = str.maketrans('', '', SHORT_VOWELS)
+
+SPACES = re.compile(r' +')
+NEWLINES = re.compile(r'\n+')
+NUMBER = re.compile(r'[-+]?\d*\.\d+|\d+')
+PLACEHOLDER = re.compile('floatingpointnumber')
+# built exactly like Parsivar's (unescaped, so the backslash of string.punctuation only escapes ']')
+PUNCTUATION = re.compile(r'\s*' + ('[' + r')(}{:؟!،؛»«.' + r'/<>?.,:;' + string.punctuation + ']').replace('@', '') + r'+\s*')
+# the same character class as Parsivar's clean_text, where '!-،' is a range covering ascii and latin-1
+NOT_ALLOWED = re.compile(r'[^' + r')(}{:؟!-،؛»«.@$&%' + r'/<>?.,:;' + r'a-zA-Z0-9' + 'آ-ی' + '‌' + r'\d\s:]')
+LATIN = re.compile(r'[a-zA-Z]')
+
+SPACE_FIXES = [
+    (re.compile(r'^(بی|می|نمی)( )'), r'\1‌'),
+    (re.compile(r'( )(می|نمی|بی)( )'), r'\1\2‌'),
+    (re.compile(r'( )(هایی|ها|های|ایی|هایم|هایت|هایش|هایمان|هایتان|هایشان|ات|ان|ین'
+                r'|انی|بان|ام|ای|یم|ید|اید|اند|بودم|بودی|بود|بودیم|بودید|بودند|ست)( )'), r'‌\2\3'),
+    (re.compile(r'( )(شده|نشده)( )'), r'‌\2‌'),
+    (re.compile(r'( )(طلبان|طلب|گرایی|گرایان|شناس|شناسی|گذاری|گذار|گذاران|شناسان|گیری|پذیری|بندی|آوری|سازی|'
+                r'بندی|کننده|کنندگان|گیری|پرداز|پردازی|پردازان|آمیز|سنجی|ریزی|داری|دهنده|آمیز|پذیری'
+                r'|پذیر|پذیران|گر|ریز|ریزی|رسانی|یاب|یابی|گانه|گانه‌ای|انگاری|گا|بند|رسانی|دهندگان|دار)( )'), r'‌\2\3'),
+]
+
+# Parsivar's space-correction dictionaries and Pinglish word lists, shipped with the repo (see resources/normalizer)
+RESOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'normalizer')
+# inputs and the outputs Parsivar gave for them, checked by `python normalizer.py`
+FIXTURES = os.path.join(RESOURCE_DIR, 'parsivar_pairs.json')
+# fixture keys, GE2PE's configuration (short vowels kept) first
+CONFIGURATIONS = {True: 'keep_short_vowels', False: 'strip_short_vowels'}
+
+# Pinglish letter (or digraph) -> the Persian letters it may stand for, as in Parsivar's PinglishNormalizer
+# (including its quirks, e.g. the comma in the first reading of gh)
+PINGLISH_LETTERS = {
+    'a': ['', 'ا'], 'c': ['ث', 'ص', 'ص'], 'h': ['ه', 'ح'], 'b': ['ب'], 'p': ['پ'], 't': ['ت', 'ط'], 's': ['س', 'ص', 'ث'],
+    'j': ['ج'], 'ch': ['چ'], 'kh': ['خ'], 'q': ['ق', 'غ'], 'd': ['د'], 'z': ['ز', 'ذ', 'ض', 'ظ'], 'r': ['ر'], 'zh': ['ژ'],
+    'sh': ['ش'], 'gh': [',ق', 'غ'], 'f': ['ف'], 'k': ['ک'], 'g': ['گ'], 'l': ['ل'], 'm': ['م'], 'n': ['ن'], 'v': ['و'],
+    'aa': ['ا'], 'ee': ['ی'], 'oo': ['و'], 'ou': ['و'], 'i': ['ی'], 'y': ['ی'], ' ': [''], 'w': ['و'], 'e': ['', 'ه'],
+    'o': ['', 'و'],
+}
+PINGLISH_DIGRAPHS = frozenset(['ch', 'kh', 'zh', 'sh', 'gh', 'aa', 'ee', 'oo', 'ou'])
+PINGLISH_ENDINGS = {'e': 'ه', 'a': 'ا', 'o': 'و', 'u': 'و'}
+
+
+def _load_dictionary(path):
+    # parsed exactly like Parsivar's load_dictionary (a leading BOM stays part of the first word)
+    words = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f.readlines():
+            parts = line.split(' ')
+            words[parts[0].strip()] = parts[1].strip().replace('\n', '')
+    return words
+
+
+def _read_lines(path):
+    with open(path, 'r', encoding='utf-8', newline='\n') as f:
+        return [line[:-1] if line.endswith('\n') else line for line in f]
+
+
+class PinglishNormalizer():
+
+    def __init__(self, resource_dir = None):
+        """
+        resource_dir: directory holding pinglish_words.tsv (known Pinglish words and their Persian spelling) and
+                      persian_words.txt (the Persian words a guessed spelling must be one of), default RESOURCE_DIR.
+        same output as Parsivar's PinglishNormalizer.pingilish2persian; every spelling a word may stand for is
+        tried and the last one that is a known Persian word wins.
+        """
+
+        resource_dir = resource_dir or RESOURCE_DIR
+        self.en_dict = dict(line.split('\t', 1) for line in _read_lines(os.path.join(resource_dir, 'pinglish_words.tsv')))
+        self.fa_words = frozenset(_read_lines(os.path.join(resource_dir, 'persian_words.txt')))
+
+    def characterize(self, word):
+        letters = []
+        i = 0
+        while i < len(word):
+            if word[i:i + 2] in PINGLISH_DIGRAPHS:
+                letters.append(word[i:i + 2])
+                i += 2
+            else:
+                letters.append(word[i])
+                i += 1
+        return letters
+
+    def spellings(self, letters):
+        choices = []
+        start = 0
+        if letters[0] in ('a', 'e', 'o', 'u', 'ee', 'ou'):
+            choices.append(['ا'])
+            start = 1
+        elif letters[0] == 'oo':
+            choices.append(['او'])
+            start = 1
+        choices.extend(PINGLISH_LETTERS.get(letter, '') for letter in letters[start:])
+        if letters[-1] in PINGLISH_ENDINGS:
+            choices.append([PINGLISH_ENDINGS[letters[-1]]])
+        for pieces in itertools.product(*choices):
+            # a piece repeated right after itself is written once (pairs only, as Parsivar's escalation)
+            out = []
+            i = 0
+            while i < len(pieces) - 1:
+                out.append(pieces[i])
+                if pieces[i] == pieces[i + 1]:
+                    i += 1
+                i += 1
+            if i != len(pieces):
+                out.append(pieces[i])
+            yield ''.join(out)
+
+    def convert(self, word):
+        if word in self.en_dict:
+            return self.en_dict[word]
+        for spelling in self.spellings(self.characterize(word)):
+            if spelling in self.fa_words:
+                word = spelling
+        return word
+
+    def pingilish2persian(self, words):
+        return ' '.join(self.convert(word) for word in words)
+
+
+class Normalizer():
+
+    def __init__(self, pinglish_conversion_needed = False, keep_short_vowels = True, resource_dir = None):
+        """
+        pinglish_conversion_needed: convert Latin-script Persian words to Persian script, as Parsivar does.
+        keep_short_vowels: keep ِ ُ َ in the output (the behaviour of the Parsivar bundled with this repo).
+        resource_dir: directory holding Parsivar's Dic1_new.txt, Dic2_new.txt and Dic3_new.txt space-correction
+                      dictionaries and the Pinglish word lists (default: RESOURCE_DIR).
+        same output as Parsivar's Normalizer(pinglish_conversion_needed=...).normalize, but without importing Parsivar:
+        the letter, digit and punctuation fixes are one str.translate pass and the remaining regexes are compiled once.
+        the Pinglish word lists are only read, on first use, to convert tokens that contain Latin letters.
+        """
+
+        resource_dir = resource_dir or RESOURCE_DIR
+        self.resource_dir = resource_dir
+        self.dic1 = _load_dictionary(os.path.join(resource_dir, 'Dic1_new.txt'))
+        self.dic2 = _load_dictionary(os.path.join(resource_dir, 'Dic2_new.txt'))
+        self.dic3 = _load_dictionary(os.path.join(resource_dir, 'Dic3_new.txt'))
+        self.pinglish_conversion_needed = pinglish_conversion_needed
+        self.pinglish = None
+        table = {source: target for target, sources in LETTERS.items() for source in sources}
+        table.update({char: None for char in REMOVED + ('' if keep_short_vowels else SHORT_VOWELS)})
+        self.table = str.maketrans(table)
+
+    def sub_alphabets(self, text):
+        return NEWLINES.sub('\n', SPACES.sub(' ', text.translate(self.table)))
+
+    def clean_text(self, text):
+        numbers = iter(NUMBER.findall(text))
+        text = NUMBER.sub('floatingpointnumber', text)
+        text = PUNCTUATION.sub(lambda match: ' ' + match.group().strip(' ') + ' ', text)
+        text = SPACES.sub(' ', NOT_ALLOWED.sub('', text))
+        return PLACEHOLDER.sub(lambda match: next(numbers, match.group()), text)
+
+    def space_correction_plus3(self, text):
+        words = text.split(' ')
+        if len(words) < 3:
+            return text
+        out = []
+        cnt = 1
+        cnt2 = 0
+        for i in range(len(words) - 2):
+            merged = self.dic3.get(words[i] + words[i + 1] + words[i + 2])
+            if merged is not None:
+                out.append(merged)
+                cnt = 0
+                cnt2 = 2
+            else:
+                if cnt == 1 and cnt2 == 0:
+                    out.append(words[i])
+                else:
+                    cnt2 -= 1
+                cnt = 1
+        if cnt == 1 and cnt2 == 0:
+            out.extend(words[-2:])
+        elif cnt == 1 and cnt2 == 1:
+            out.append(words[-1])
+        return ' ' + ' '.join(out)
+
+    def space_correction_plus2(self, text):
+        words = text.split(' ')
+        if len(words) < 2:
+            return text
+        out = []
+        cnt = 1
+        for i in range(len(words) - 1):
+            merged = self.dic2.get(words[i] + words[i + 1])
+            if merged is not None:
+                out.append(merged)
+                cnt = 0
+            else:
+                if cnt == 1:
+                    out.append(words[i])
+                cnt = 1
+        if cnt == 1:
+            out.append(words[-1])
+        return ' ' + ' '.join(out)
+
+    def space_correction_plus1(self, text):
+        return ' ' + ' '.join(self.dic1.get(word, word) for word in text.split(' '))
+
+    def space_correction(self, text):
+        for pattern, replacement in SPACE_FIXES:
+            text = pattern.sub(replacement, text)
+        return text
+
+    def pinglish_to_persian(self, tokens):
+        if self.pinglish is None:
+            self.pinglish = PinglishNormalizer(self.resource_dir)
+        # tokens without Latin letters are never changed by PinglishNormalizer
+        return [self.pinglish.convert(token) if LATIN.search(token) else token for token in tokens]
+
+    def normalize(self, text):
+        text = self.clean_text(self.sub_alphabets(text)).strip()
+        text = self.space_correction(self.space_correction_plus1(self.space_correction_plus2(self.space_correction_plus3(text)))).strip()
+        if self.pinglish_conversion_needed:
+            tokens = [token.strip('‌') for token in text.split()]
+            tokens = [token for token in tokens if token]
+            if LATIN.search(text):
+                tokens = self.pinglish_to_persian(tokens)
+            text = ' '.join(tokens)
+        return text
+
+
+def fuzz_corpus(size, seed = 0):
+    rng = random.Random(seed)
+    alphabet = (''.join(LETTERS) + ''.join(LETTERS.values()) + SHORT_VOWELS + REMOVED + 'آابپتثجچحخدرزژسشصضطظعغفقکگلمنوهی' * 4
+                + '٥' + '۰۱۲۳۴۵۶۷۸۹0123456789' + string.punctuation + '؛»«؟،' + '  \n\t‌' * 6 + 'abcdeghkoszu' + 'ðé😀')
+    words = ['می', 'نمی', 'بی', 'ها', 'های', 'شده', 'گذاری', 'حمل', 'و', 'نقل', 'salam', 'khob', 'ketab', 'آیت', 'الله', 'کِتاب', 'میرَوَد', 'بُرده']
+    corpus = []
+    for _ in range(size):
+        pieces = [rng.choice(words) if rng.random() < 0.3 else ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 8)))
+                  for _ in range(rng.randint(1, 12))]
+        corpus.append(' '.join(pieces))
+    return corpus
+
+
+def check_fixtures(keep_short_vowels = True, path = FIXTURES):
+    """ returns (mismatches, pairs): the stored Parsivar pairs for keep_short_vowels the native normalizer does not reproduce. """
+    with open(path, encoding='utf-8') as f:
+        pairs = json.load(f)[CONFIGURATIONS[keep_short_vowels]]
+    native = Normalizer(pinglish_conversion_needed=True, keep_short_vowels=keep_short_vowels)
+    outputs = [native.normalize(text) for text, _ in pairs]
+    return [(text, expected, output) for (text, expected), output in zip(pairs, outputs) if output != expected], pairs
+
+
+def parsivar_reference(keep_short_vowels = True):
+    """
+    returns Parsivar's normalize with the short vowels kept or removed.
+    the bundled Parsivar keeps ِ ُ َ, the PyPI release removes them in sub_alphabets: whichever one is installed, the
+    other behaviour is obtained by hiding the vowels from sub_alphabets (or removing them before it).
+    """
+    from Parsivar.Parsivar.normalizer import Normalizer as ParsivarNormalizer
+    reference = ParsivarNormalizer(pinglish_conversion_needed=True)
+    if ('َ' in reference.normalize('بَ')) != keep_short_vowels:
+        sub_alphabets = reference.sub_alphabets
+        if keep_short_vowels:
+            hide = str.maketrans(SHORT_VOWELS, '\ue000\ue001\ue002')
+            show = str.maketrans('\ue000\ue001\ue002', SHORT_VOWELS)
+            reference.sub_alphabets = lambda text: sub_alphabets(text.translate(hide)).translate(show)
+        else:
+            strip = str.maketrans('', '', SHORT_VOWELS)
+            reference.sub_alphabets = lambda text: sub_alphabets(text.translate(strip))
+    return reference.normalize
+
+
+def write_fixtures(corpus, path = FIXTURES):
+    """ normalizes corpus with Parsivar in both configurations and stores the pairs for check_fixtures. """
+    fixtures = {}
+    for keep_short_vowels, name in CONFIGURATIONS.items():
+        reference = parsivar_reference(keep_short_vowels)
+        fixtures[name] = [[text, reference(text)] for text in corpus]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(fixtures, f, ensure_ascii=False, indent=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the native normalizer against Parsivar\'s outputs, stored in '
+                                                 'resources/normalizer or from an installed Parsivar with --parsivar.')
+    parser.add_argument('corpus', nargs='?', help='text file with one sentence per line (default: a fuzzed corpus)')
+    parser.add_argument('--size', type=int, default=20000, help='size of the fuzzed corpus')
+    parser.add_argument('--parsivar', action='store_true', help='compare with the bundled Parsivar and time both')
+    parser.add_argument('--write-fixtures', action='store_true', help='store the corpus and its Parsivar outputs as the new fixtures')
+    args = parser.parse_args()
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f:
+            corpus = [line.rstrip('\n') for line in f]
+    else:
+        corpus = fuzz_corpus(args.size)
+
+    if args.write_fixtures:
+        write_fixtures(corpus)
+        print(f'{len(corpus)} pairs per configuration written to {FIXTURES}')
+        sys.exit()
+    if not args.parsivar:
+        failed = False
+        for keep_short_vowels, name in CONFIGURATIONS.items():
+            mismatches, pairs = check_fixtures(keep_short_vowels)
+            print(f'{name}: {len(mismatches)} mismatches on {len(pairs)} stored Parsivar pairs')
+            for text, a, b in mismatches[:5]:
+                print(repr(text), repr(a), repr(b), sep='\n  ', file=sys.stderr)
+            failed = failed or bool(mismatches)
+        sys.exit(1 if failed else 0)
+
+    # startup and throughput are timed on the configuration GE2PE uses (short vowels kept)
+    start = time.perf_counter()
+    native = Normalizer(pinglish_conversion_needed=True)
+    native_startup = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = parsivar_reference()
+    parsivar_startup = time.perf_counter() - start
+
+    timings = {}
+    outputs = {}
+    for name, fn in [('parsivar', reference), ('native', native.normalize)]:
+        start = time.perf_counter()
+        outputs[name] = [fn(text) for text in corpus]
+        timings[name] = time.perf_counter() - start
+    for keep_short_vowels, name in CONFIGURATIONS.items():
+        if not keep_short_vowels:
+            outputs['parsivar'] = [parsivar_reference(False)(text) for text in corpus]
+            stripping = Normalizer(pinglish_conversion_needed=True, keep_short_vowels=False)
+            outputs['native'] = [stripping.normalize(text) for text in corpus]
+        mismatches = [(text, a, b) for text, a, b in zip(corpus, outputs['parsivar'], outputs['native']) if a != b]
+        print(f'{name}: {len(mismatches)} mismatches on {len(corpus)} sentences')
+        for text, a, b in mismatches[:5]:
+            print(repr(text), repr(a), repr(b), sep='\n  ', file=sys.stderr)
+    print(f'startup: parsivar {parsivar_startup:.3f}s, native {native_startup:.3f}s')
+    print(f"throughput: parsivar {len(corpus) / timings['parsivar']:.0f}/s, native {len(corpus) / timings['native']:.0f}/s, "
+          f"speedup {timings['parsivar'] / timings['native']:.1f}x")
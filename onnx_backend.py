@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import onnxruntime as ort
+from decoding import is_repeating
+from cache import is_current, publish
+
+
+def onnx_path(model_path):
+    """
+    returns the directory the ONNX graphs of model_path are exported to, next to the checkpoint.
+    """
+    return os.path.normpath(model_path) + '-onnx'
+
+
+def export(model_path, output_dir = None, opset = 17):
+    """
+    model_path: path to the GE2PE/T5 checkpoint.
+    output_dir: where to write encoder.onnx, decoder_init.onnx and decoder_with_past.onnx (default: onnx_path(model_path)).
+    the decoder is split in two graphs: decoder_init runs the first step and returns the self- and cross-attention
+    key/values of every layer, decoder_with_past consumes them and only returns the grown self-attention key/values,
+    so each later step processes a single token. the graphs are written to a temporary directory and published
+    (see cache.publish) with the checkpoint fingerprint, so readers never see a partial export.
+    """
+    # exporting needs torch; serving the exported graphs does not
+    import torch
+    from transformers import AutoTokenizer
+    from transformers.cache_utils import EncoderDecoderCache
+    from quantize import load_model, read_token_map
+
+    output_dir = output_dir or onnx_path(model_path)
+    model = load_model(model_path).eval()
+    config = model.config
+    layers = config.num_decoder_layers
+    scale = config.d_model ** -0.5 if config.tie_word_embeddings else 1.0
+
+    # the wrappers hold the model as a submodule so its weights are exported as initializers
+    class Wrapper(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+    class Encoder(Wrapper):
+        def forward(self, input_ids, attention_mask):
+            return self.model.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+    class DecoderInit(Wrapper):
+        def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask):
+            out = self.model.decoder(input_ids=decoder_input_ids, encoder_hidden_states=encoder_hidden_states,
+                                encoder_attention_mask=encoder_attention_mask, past_key_values=EncoderDecoderCache.from_legacy_cache(None),
+                                use_cache=True, return_dict=True)
+            logits = self.model.lm_head(out.last_hidden_state * scale)
+            present = out.past_key_values.to_legacy_cache()
+            return (logits,) + tuple(t for layer in present for t in layer)
+
+    class DecoderWithPast(Wrapper):
+        def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+            past = tuple(tuple(past[4 * i:4 * i + 4]) for i in range(layers))
+            out = self.model.decoder(input_ids=decoder_input_ids, encoder_hidden_states=encoder_hidden_states,
+                                encoder_attention_mask=encoder_attention_mask, past_key_values=EncoderDecoderCache.from_legacy_cache(past),
+                                use_cache=True, return_dict=True)
+            logits = self.model.lm_head(out.last_hidden_state * scale)
+            present = out.past_key_values.to_legacy_cache()
+            return (logits,) + tuple(t for layer in present for t in layer[:2])
+
+    def write(directory):
+        batch, length = 2, 7
+        input_ids = torch.ones((batch, length), dtype=torch.long)
+        attention_mask = torch.ones((batch, length), dtype=torch.long)
+        hidden = torch.zeros((batch, length, config.d_model))
+        start = torch.full((batch, 1), config.decoder_start_token_id, dtype=torch.long)
+        past_names = [f'past.{i}.{kind}' for i in range(layers) for kind in ['self_key', 'self_value', 'cross_key', 'cross_value']]
+        present_names = [name.replace('past.', 'present.') for name in past_names]
+        self_present = [name for name in present_names if '.self_' in name]
+        kv_axes = {name: {0: 'batch', 2: ('past_length' if '.self_' in name else 'encoder_length')} for name in past_names}
+
+        with torch.no_grad():
+            torch.onnx.export(Encoder(), (input_ids, attention_mask), os.path.join(directory, 'encoder.onnx'),
+                              input_names=['input_ids', 'attention_mask'], output_names=['encoder_hidden_states'],
+                              dynamic_axes={'input_ids': {0: 'batch', 1: 'encoder_length'}, 'attention_mask': {0: 'batch', 1: 'encoder_length'},
+                                            'encoder_hidden_states': {0: 'batch', 1: 'encoder_length'}},
+                              opset_version=opset, dynamo=False)
+            torch.onnx.export(DecoderInit(), (start, hidden, attention_mask), os.path.join(directory, 'decoder_init.onnx'),
+                              input_names=['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask'],
+                              output_names=['logits'] + present_names,
+                              dynamic_axes={'decoder_input_ids': {0: 'batch'}, 'encoder_hidden_states': {0: 'batch', 1: 'encoder_length'},
+                                            'encoder_attention_mask': {0: 'batch', 1: 'encoder_length'}, 'logits': {0: 'batch'},
+                                            **{name: {0: 'batch', 2: 'encoder_length' if '.cross_' in name else 'past_length'} for name in present_names}},
+                              opset_version=opset, dynamo=False)
+            past = DecoderInit()(start, hidden, attention_mask)[1:]
+            torch.onnx.export(DecoderWithPast(), (start, hidden, attention_mask) + tuple(past), os.path.join(directory, 'decoder_with_past.onnx'),
+                              input_names=['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask'] + past_names,
+                              output_names=['logits'] + self_present,
+                              dynamic_axes={'decoder_input_ids': {0: 'batch'}, 'encoder_hidden_states': {0: 'batch', 1: 'encoder_length'},
+                                            'encoder_attention_mask': {0: 'batch', 1: 'encoder_length'}, 'logits': {0: 'batch'},
+                                            **kv_axes, **{name: {0: 'batch', 2: 'present_length'} for name in self_present}},
+                              opset_version=opset, dynamo=False)
+
+        with open(os.path.join(directory, 'ge2pe_onnx.json'), 'w') as f:
+            json.dump({'num_layers': layers, 'decoder_start_token_id': config.decoder_start_token_id,
+                       'eos_token_id': config.eos_token_id, 'pad_token_id': config.pad_token_id,
+                       'vocab_size': config.vocab_size, 'token_map': read_token_map(model_path)}, f, indent=2)
+        AutoTokenizer.from_pretrained(model_path).save_pretrained(directory)
+
+    publish(model_path, output_dir, write)
+    return output_dir
+
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+def topk(scores, k):
+    # stable, so equal scores keep the lower index first like torch.topk does on CPU
+    indices = np.argsort(-scores, axis=-1, kind='stable')[..., :k]
+    return np.take_along_axis(scores, indices, axis=-1), indices
+
+
+class OnnxBackend():
+    """
+    runs the exported encoder/decoder graphs with ONNX Runtime and reproduces the HuggingFace
+    beam search (early_stopping=True, length_penalty=1.0) and greedy search in numpy.
+    """
+
+    tensor_type = 'np'
+
+    def __init__(self, model_path, GPU = False, threads = None):
+        """
+        model_path: the checkpoint (graphs are exported next to it on first use and after it changes) or an
+                    exported directory, used as it is.
+        GPU: boolean indicating use of the CUDA execution provider.
+        threads: intra-op threads of each session (None lets ONNX Runtime decide).
+        """
+        if os.path.exists(os.path.join(model_path, 'encoder.onnx')):
+            path = model_path
+        else:
+            # exported again whenever the checkpoint has changed since the graphs were built
+            path = onnx_path(model_path)
+            if not is_current(path, model_path):
+                export(model_path, path)
+        with open(os.path.join(path, 'ge2pe_onnx.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.layers = meta['num_layers']
+        self.start = meta['decoder_start_token_id']
+        self.eos = meta['eos_token_id']
+        self.pad = meta['pad_token_id']
+        token_map = meta.get('token_map')
+        self.output_ids = None if token_map is None else np.asarray(token_map['output_ids'], dtype=np.int64)
+        options = ort.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if GPU else ['CPUExecutionProvider']
+        self.encoder = ort.InferenceSession(os.path.join(path, 'encoder.onnx'), options, providers=providers)
+        self.decoder_init = ort.InferenceSession(os.path.join(path, 'decoder_init.onnx'), options, providers=providers)
+        self.decoder_with_past = ort.InferenceSession(os.path.join(path, 'decoder_with_past.onnx'), options, providers=providers)
+        # the exporter prunes encoder_hidden_states from decoder_with_past since the cross key/values are cached
+        self.with_past_inputs = [i.name for i in self.decoder_with_past.get_inputs()]
+
+    def _step(self, tokens, hidden, mask, past):
+        """
+        runs one decoder step for a (rows, 1) array of tokens.
+        returns (logits of the last position, self-attention past, cross-attention past).
+        """
+        feed = {'decoder_input_ids': tokens, 'encoder_hidden_states': hidden, 'encoder_attention_mask': mask}
+        if past is None:
+            out = self.decoder_init.run(None, feed)
+            kv = out[1:]
+            return out[0][:, -1, :], [kv[4 * i:4 * i + 2] for i in range(self.layers)], [kv[4 * i + 2:4 * i + 4] for i in range(self.layers)]
+        self_kv, cross_kv = past
+        for i in range(self.layers):
+            feed[f'past.{i}.self_key'], feed[f'past.{i}.self_value'] = self_kv[i]
+            feed[f'past.{i}.cross_key'], feed[f'past.{i}.cross_value'] = cross_kv[i]
+        out = self.decoder_with_past.run(None, {name: feed[name] for name in self.with_past_inputs})
+        return out[0][:, -1, :], [out[1 + 2 * i:3 + 2 * i] for i in range(self.layers)], cross_kv
+
+    def _hits(self, sequences, cur_len, limits, repeat_window, max_length, deadline = None):
+        """
+        stopping criteria of every candidate row of shape (batch, candidates, cur_len): eos, max_length,
+        the per-row token budget, the repetition guard and the deadline, as applied by the torch backend.
+        """
+        if deadline is not None and time.monotonic() >= deadline:
+            return np.ones(sequences.shape[:2], dtype=bool)
+        hits = (sequences[:, :, cur_len - 1] == self.eos) | (cur_len >= max_length)
+        hits |= (cur_len - 1 >= np.asarray(limits))[:, None]
+        if repeat_window is not None and cur_len > repeat_window:
+            for b in range(sequences.shape[0]):
+                for c in range(sequences.shape[1]):
+                    if not hits[b, c] and is_repeating(sequences[b, c, cur_len - repeat_window:cur_len].tolist(), repeat_window):
+                        hits[b, c] = True
+        return hits
+
+    def generate(self, input_ids, attention_mask, num_beams, limits, repeat_window = None, deadline = None):
+        """
+        input_ids, attention_mask: padded numpy batch as returned by the tokenizer.
+        limits: maximum number of output tokens of every row.
+        deadline: optional time.monotonic() value at which decoding stops with the best hypotheses so far.
+        returns the output token ids, one row per input.
+        """
+        input_ids = input_ids.astype(np.int64)
+        attention_mask = attention_mask.astype(np.int64)
+        hidden = self.encoder.run(None, {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+        max_length = max(limits) + 1
+        if num_beams == 1:
+            out_ids = self._greedy(hidden, attention_mask, limits, repeat_window, max_length, deadline=deadline)
+        else:
+            out_ids = self._beam_search(hidden, attention_mask, num_beams, limits, repeat_window, max_length, deadline)
+        return out_ids if self.output_ids is None else self.output_ids[out_ids]
+
+    def generate_with_confidence(self, input_ids, attention_mask, limits, repeat_window = None):
+        """
+        greedy decoding of a padded batch, as generate with num_beams=1.
+        returns (output token ids, confidence of every row): the probability the model gave to the least certain
+        token it emitted, eos included.
+        """
+        attention_mask = attention_mask.astype(np.int64)
+        hidden = self.encoder.run(None, {'input_ids': input_ids.astype(np.int64), 'attention_mask': attention_mask})[0]
+        worst = np.zeros(hidden.shape[0], dtype=np.float32)
+        out_ids = self._greedy(hidden, attention_mask, limits, repeat_window, max(limits) + 1, worst)
+        return (out_ids if self.output_ids is None else self.output_ids[out_ids]), np.exp(worst).tolist()
+
+    def _greedy(self, hidden, mask, limits, repeat_window, max_length, worst = None, deadline = None):
+        """ worst: optional array receiving the lowest log-probability among the tokens of every row. """
+        batch = hidden.shape[0]
+        sequences = np.full((batch, 1), self.start, dtype=np.int64)
+        unfinished = np.ones(batch, dtype=bool)
+        past = None
+        while True:
+            logits, self_kv, cross_kv = self._step(sequences[:, -1:], hidden, mask, past)
+            past = (self_kv, cross_kv)
+            tokens = np.where(unfinished, logits.argmax(axis=-1), self.pad)
+            if worst is not None:
+                picked = log_softmax(logits.astype(np.float32))[np.arange(batch), tokens]
+                worst[:] = np.where(unfinished, np.minimum(worst, picked), worst)
+            sequences = np.concatenate([sequences, tokens[:, None]], axis=1)
+            unfinished &= ~self._hits(sequences[:, None, :], sequences.shape[1], limits, repeat_window, max_length,
+                                      deadline)[:, 0]
+            if not unfinished.any():
+                return sequences
+
+    def _beam_search(self, hidden, mask, num_beams, limits, repeat_window, max_length, deadline = None):
+        batch = hidden.shape[0]
+        keep = 2 * num_beams
+        hidden = np.repeat(hidden, num_beams, axis=0)
+        mask = np.repeat(mask, num_beams, axis=0)
+        running = np.full((batch, num_beams, max_length), self.eos, dtype=np.int64)
+        running[:, :, 0] = self.start
+        sequences = running.copy()
+        running_scores = np.zeros((batch, num_beams), dtype=np.float32)
+        running_scores[:, 1:] = -1e9
+        beam_scores = np.full((batch, num_beams), -1e9, dtype=np.float32)
+        finished = np.zeros((batch, num_beams), dtype=bool)
+        unsatisfied = np.ones((batch, 1), dtype=bool)
+        top_mask = np.arange(keep) < num_beams
+        offsets = (np.arange(batch) * num_beams)[:, None]
+        cur_len = 1
+        past = None
+        while True:
+            logits, self_kv, cross_kv = self._step(running[:, :, cur_len - 1].reshape(-1, 1), hidden, mask, past)
+            vocab = logits.shape[-1]
+            log_probs = log_softmax(logits.astype(np.float32)).reshape(batch, num_beams, vocab) + running_scores[:, :, None]
+            top_scores, top_indices = topk(log_probs.reshape(batch, num_beams * vocab), keep)
+            source = top_indices // vocab
+            candidates = np.take_along_axis(running, source[:, :, None], axis=1)
+            candidates[:, :, cur_len] = top_indices % vocab
+            hits = self._hits(candidates, cur_len + 1, limits, repeat_window, max_length, deadline)
+
+            # best unfinished candidates keep running
+            scores = top_scores + hits.astype(np.float32) * np.float32(-1e9)
+            running_scores, chosen = topk(scores, num_beams)
+            running = np.take_along_axis(candidates, chosen[:, :, None], axis=1)
+            beam_source = np.take_along_axis(source, chosen, axis=1)
+
+            # finished candidates among the top num_beams compete for the final hypotheses
+            just_finished = hits & top_mask[None, :]
+            final_scores = top_scores / np.float32(cur_len)
+            final_scores = final_scores + finished.all(axis=-1, keepdims=True).astype(np.float32) * np.float32(-1e9)
+            final_scores = final_scores + (~unsatisfied).astype(np.float32) * np.float32(-1e9)
+            final_scores = final_scores + (~just_finished).astype(np.float32) * np.float32(-1e9)
+            merged_scores = np.concatenate([beam_scores, final_scores], axis=1)
+            beam_scores, chosen = topk(merged_scores, num_beams)
+            sequences = np.take_along_axis(np.concatenate([sequences, candidates], axis=1), chosen[:, :, None], axis=1)
+            finished = np.take_along_axis(np.concatenate([finished, just_finished], axis=1), chosen, axis=1)
+
+            order = (beam_source + offsets).reshape(-1)
+            past = ([[kv[order] for kv in layer] for layer in self_kv], cross_kv)
+            cur_len += 1
+            best_running = running_scores[:, :1] / np.float32(cur_len - 1)
+            worst_finished = np.where(finished, beam_scores.min(axis=1, keepdims=True), np.float32(-1e9))
+            unsatisfied = unsatisfied & (best_running > worst_finished).any(axis=-1, keepdims=True)
+            if not (unsatisfied.any() and not finished.all() and not hits.all()):
+                break
+        return sequences[:, 0, :cur_len]
+
+
+def verify(model_path, reference = None, num_beams = 5):
+    """
+    decodes the reference sentences one by one with both backends and returns the sentences whose
+    output token ids differ (an empty list means the ONNX backend matches token for token).
+    """
+    from GE2PE import GE2PE
+    from quantize import read_reference
+
+    sentences = read_reference(reference)
+    outputs = {}
+    for backend in ['torch', 'onnx']:
+        g2p = GE2PE(model_path=model_path, backend=backend)
+        stripped, token_ids = g2p._prepare([g2p.normalize(text) for text in sentences])
+        rows = []
+        for ids, text in zip(token_ids, stripped):
+            in_ids = g2p.tokenizer.pad({"input_ids": [ids]}, padding=True, return_attention_mask=True, return_tensors=g2p.backend.tensor_type)
+            out = g2p.backend.generate(in_ids["input_ids"], in_ids["attention_mask"], num_beams, g2p.decode_limits([len(text)]), g2p.repeat_window)
+            row = [int(t) for t in out[0][1:]]
+            ends = [k for k, t in enumerate(row) if t in (g2p.tokenizer.eos_token_id, g2p.tokenizer.pad_token_id)]
+            rows.append(row[:ends[0]] if ends else row)
+        outputs[backend] = rows
+    return [s for s, a, b in zip(sentences, outputs['torch'], outputs['onnx']) if a != b]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a GE2PE checkpoint to ONNX encoder/decoder graphs.')
+    parser.add_argument('model_path')
+    parser.add_argument('--output-dir')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--reference', help='text file with one reference sentence per line to verify against torch')
+    args = parser.parse_args()
+    print('exported to', export(args.model_path, args.output_dir, args.opset))
+    mismatches = verify(args.model_path, args.reference)
+    print(f'{len(mismatches)} reference sentences differ from the torch backend')
+    for sentence in mismatches:
+        print('  ', sentence)
@@ -0,0 +1,188 @@
+import os
+import time
+import argparse
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from GE2PE import GE2PE
+
+
+def _worker(g2p, conn, threads):
+    if g2p.backend.tensor_type == 'pt':
+        import torch
+        torch.set_num_threads(threads)
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        shard_id, texts, kwargs = task
+        try:
+            outputs = g2p.generate(texts, **kwargs)
+            conn.send((shard_id, outputs, g2p.last_degraded, None))
+        except Exception as e:
+            conn.send((shard_id, None, None, f'{type(e).__name__}: {e}'))
+
+
+class GE2PEPool():
+
+    def __init__(self, model_path, workers = None, threads_per_worker = 1, shard_size = 64, timeout = 300,
+                 max_retries = 2, **kwargs):
+        """
+        model_path: path to where the GE2PE transformer is saved.
+        workers: number of forked worker processes (default: cores // threads_per_worker).
+        threads_per_worker: PyTorch intra-op threads of every worker.
+        shard_size: number of sentences sent to a worker at a time.
+        timeout: seconds after which a worker still busy with one shard is considered hung and restarted.
+        max_retries: how many times a shard is retried after its worker crashed or hung.
+        kwargs: any other GE2PE argument (dictionary, precision, ...).
+        the model is loaded once here; workers are forked afterwards and share its weights copy-on-write.
+        """
+
+        self.g2p = GE2PE(model_path=model_path, **kwargs)
+        self.workers = workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        self.threads_per_worker = threads_per_worker
+        self.shard_size = shard_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.restarts = 0
+        self.last_degraded = []
+        self.context = mp.get_context('fork')
+        self.procs = [self._spawn() for _ in range(self.workers)]
+
+    def _spawn(self):
+        parent, child = self.context.Pipe()
+        proc = self.context.Process(target=_worker, args=(self.g2p, child, self.threads_per_worker), daemon=True)
+        proc.start()
+        child.close()
+        return {'proc': proc, 'conn': parent, 'task': None, 'started': None}
+
+    def _restart(self, index):
+        worker = self.procs[index]
+        if worker['proc'].is_alive():
+            worker['proc'].kill()
+        worker['proc'].join()
+        worker['conn'].close()
+        self.restarts += 1
+        self.procs[index] = self._spawn()
+
+    def _reset(self):
+        # workers still busy with shards of an abandoned call would answer the next one
+        for index, worker in enumerate(self.procs):
+            if worker['task'] is not None:
+                self._restart(index)
+
+    def _retry(self, index, pending, retries):
+        """ restarts a worker that crashed, hung or lost its pipe and queues its shard again. """
+        shard_id = self.procs[index]['task']
+        retries[shard_id] += 1
+        if retries[shard_id] > self.max_retries:
+            self._reset()
+            raise RuntimeError(f'shard {shard_id} failed {retries[shard_id]} times, giving up')
+        pending.append(shard_id)
+        self._restart(index)
+
+    def generate(self, input_list, batch_size = 10, use_rules = False, use_dict = False, num_beams = 5, max_tokens = None,
+                 segment = False, max_chunk_chars = 200, dictionary = None, deadline = None):
+        """
+        same arguments and result as GE2PE.generate; the inputs are sorted by length, cut into shards
+        of similar length and phonemized by the workers in parallel. a worker that died while idle is
+        restarted before it gets a shard. deadline covers the whole call: every shard gets what is left of
+        it when it is sent, and last_degraded flags the degraded outputs.
+        """
+        kwargs = {'batch_size': batch_size, 'use_rules': use_rules, 'use_dict': use_dict, 'num_beams': num_beams,
+                  'max_tokens': max_tokens, 'segment': segment, 'max_chunk_chars': max_chunk_chars,
+                  'dictionary': dictionary}
+        expires = None if deadline is None else time.monotonic() + deadline
+        order = sorted(range(len(input_list)), key=lambda i: len(input_list[i]))
+        shards = [order[i:i + self.shard_size] for i in range(0, len(order), self.shard_size)]
+        pending = list(range(len(shards)))
+        retries = [0] * len(shards)
+        output_list = [None] * len(input_list)
+        degraded_list = [False] * len(input_list)
+        done = 0
+        while done < len(shards):
+            for index in range(len(self.procs)):
+                if self.procs[index]['task'] is None and pending:
+                    if not self.procs[index]['proc'].is_alive():
+                        self._restart(index)
+                    worker = self.procs[index]
+                    shard_id = pending.pop()
+                    worker['task'], worker['started'] = shard_id, time.monotonic()
+                    kwargs['deadline'] = None if expires is None else max(0.0, expires - time.monotonic())
+                    try:
+                        worker['conn'].send((shard_id, [input_list[i] for i in shards[shard_id]], kwargs))
+                    except (OSError, EOFError):
+                        self._retry(index, pending, retries)
+
+            busy = {worker['conn']: index for index, worker in enumerate(self.procs) if worker['task'] is not None}
+            for conn in wait(list(busy), timeout=1.0):
+                index = busy[conn]
+                try:
+                    shard_id, outputs, degraded, error = conn.recv()
+                except (OSError, EOFError):
+                    self._retry(index, pending, retries)
+                    continue
+                if error is not None:
+                    self._reset()
+                    raise RuntimeError(f'GE2PE worker failed: {error}')
+                for i, output, flag in zip(shards[shard_id], outputs, degraded):
+                    output_list[i] = output
+                    degraded_list[i] = flag
+                self.procs[index]['task'] = None
+                done += 1
+
+            for index, worker in enumerate(self.procs):
+                if worker['task'] is None:
+                    continue
+                hung = time.monotonic() - worker['started'] > self.timeout
+                if hung or not worker['proc'].is_alive():
+                    self._retry(index, pending, retries)
+        self.last_degraded = degraded_list
+        return output_list
+
+    def close(self):
+        for worker in self.procs:
+            try:
+                worker['conn'].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.procs:
+            worker['proc'].join(timeout=5)
+            if worker['proc'].is_alive():
+                worker['proc'].kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def throughput_table(model_path, sentences, worker_counts, threads_per_worker = 1, **kwargs):
+    """
+    phonemizes sentences with pools of every size in worker_counts and returns rows of
+    (workers, threads_per_worker, seconds, sentences per second).
+    """
+    rows = []
+    for workers in worker_counts:
+        with GE2PEPool(model_path, workers=workers, threads_per_worker=threads_per_worker) as pool:
+            pool.generate(sentences[:workers], **kwargs)  # warm-up
+            start = time.perf_counter()
+            pool.generate(sentences, **kwargs)
+            seconds = time.perf_counter() - start
+        rows.append((workers, threads_per_worker, seconds, len(sentences) / seconds))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput of GE2PEPool for several worker counts.')
+    parser.add_argument('model_path')
+    parser.add_argument('corpus', help='text file with one sentence per line')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    args = parser.parse_args()
+    with open(args.corpus, encoding='utf-8') as f:
+        corpus = [line.strip() for line in f if line.strip()]
+    print('| workers | threads/worker | seconds | sentences/s |')
+    print('|---|---|---|---|')
+    for row in throughput_table(args.model_path, corpus, args.workers, args.threads_per_worker):
+        print('| %d | %d | %.2f | %.1f |' % row)
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import argparse
+import torch
+from transformers import AutoTokenizer
+from quantize import (TOKEN_MAP, load_model, empty_model, save_pruned, quantized_path, read_reference,
+                      character_error_rate)
+
+# printable ASCII: the phoneme letters, / ; @ $ ? and the ezafe marker 1, space and anything else the model
+# might echo from Latin input; pass --data to check the training phonemes are covered
+PHONEME_ALPHABET = ''.join(chr(c) for c in range(32, 127))
+
+
+def pruned_path(model_path):
+    """
+    returns the directory the pruned checkpoint of model_path is written to, next to it.
+    """
+    return quantized_path(model_path, 'pruned')
+
+
+def read_phonemes(path, column = 'Mapped Phoneme'):
+    """
+    path: training csv (phonemes in column) or a TSV/CSV lexicon, read as in lexicon_store.read_entries.
+    yields every phoneme string.
+    """
+    from lexicon_store import read_entries
+    for _, phonemes in read_entries(path, 'Grapheme', column):
+        yield phonemes
+
+
+def output_vocabulary(tokenizer, config, texts = (), alphabet = PHONEME_ALPHABET):
+    """
+    returns the sorted tokenizer ids the decoder has to be able to produce: pad, eos, unk, the decoder start
+    token and every token of alphabet and of the phoneme strings texts.
+    """
+    ids = {tokenizer.pad_token_id, tokenizer.eos_token_id, tokenizer.unk_token_id, config.decoder_start_token_id}
+    for text in [alphabet, *texts]:
+        ids.update(tokenizer(text, add_special_tokens=False)['input_ids'])
+    return sorted(i for i in ids if i is not None)
+
+
+def prune_model(model, output_ids):
+    """
+    model: an fp32 T5ForConditionalGeneration.
+    output_ids: tokenizer ids to keep on the decoder side; decoder id i stands for output_ids[i].
+    returns a model whose lm_head and decoder embedding only cover output_ids, and whose encoder keeps the full
+    embedding, so inputs are tokenized as before.
+    """
+    config = model.config
+    index = torch.tensor(output_ids)
+    shared = model.shared.weight.detach()
+    head = model.lm_head.weight.detach()[index]
+    if config.tie_word_embeddings:
+        # tied T5 scales the decoder output by d_model**-0.5 before the shared projection; an untied head
+        # does not, so the scale moves into the head
+        head = head * config.d_model ** -0.5
+    ids = {token: i for i, token in enumerate(output_ids)}
+    pruned_config = config.__class__.from_dict(config.to_dict())
+    pruned_config.vocab_size = len(output_ids)
+    pruned_config.tie_word_embeddings = False
+    for name in ['pad_token_id', 'eos_token_id', 'decoder_start_token_id']:
+        setattr(pruned_config, name, ids[getattr(config, name)])
+    pruned = empty_model(pruned_config, {'encoder_vocab_size': shared.shape[0]})
+    state = model.state_dict()
+    state.update({'shared.weight': shared[index], 'decoder.embed_tokens.weight': shared[index],
+                  'encoder.embed_tokens.weight': shared, 'lm_head.weight': head})
+    pruned.load_state_dict(state)
+    pruned.generation_config = model.generation_config
+    for name in ['pad_token_id', 'eos_token_id', 'decoder_start_token_id']:
+        if getattr(pruned.generation_config, name, None) is not None:
+            setattr(pruned.generation_config, name, ids[getattr(pruned.generation_config, name)])
+    return pruned.eval()
+
+
+def prune(model_path, output_dir = None, data = (), column = 'Mapped Phoneme', alphabet = PHONEME_ALPHABET,
+          reference = None, num_beams = 5):
+    """
+    model_path: path to the fp32 checkpoint.
+    output_dir: where to write the pruned checkpoint (default: pruned_path(model_path)); GE2PE loads it like
+                any checkpoint and maps its output ids back through token_map.json.
+    data: training csv / lexicon files whose phonemes must stay producible (see read_phonemes).
+    reference: list of sentences or a text file with one sentence per line for the comparison with the original.
+    writes pruning.json next to the weights with the vocabulary sizes, the CER and exact match against the
+    original outputs, seconds per sentence and weight sizes. returns that report.
+    """
+    from GE2PE import GE2PE
+
+    output_dir = output_dir or pruned_path(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = load_model(model_path).eval()
+    texts = [text for path in data for text in read_phonemes(path, column)]
+    output_ids = output_vocabulary(tokenizer, model.config, texts, alphabet)
+    save_pruned(prune_model(model, output_ids), output_dir)
+    with open(os.path.join(output_dir, TOKEN_MAP), 'w', encoding='utf-8') as f:
+        json.dump({'output_ids': output_ids, 'encoder_vocab_size': model.shared.weight.shape[0]}, f)
+    tokenizer.save_pretrained(output_dir)
+
+    sentences = read_reference(reference)
+    results = {}
+    for name, path in [('original', model_path), ('pruned', output_dir)]:
+        g2p = GE2PE(model_path=path)
+        g2p.generate(sentences[:1], num_beams=num_beams)  # warm-up
+        start = time.perf_counter()
+        outputs = g2p.generate(sentences, num_beams=num_beams)
+        results[name] = (outputs, time.perf_counter() - start)
+    report = {
+        'source': os.path.abspath(model_path),
+        'vocab_size': {'original': model.config.vocab_size, 'pruned': len(output_ids)},
+        'training_phonemes': len(texts),
+        'reference_sentences': len(sentences),
+        'cer_vs_original': character_error_rate(results['original'][0], results['pruned'][0]),
+        'exact_match_vs_original': sum(a == b for a, b in zip(results['original'][0], results['pruned'][0])) / len(sentences),
+        'seconds_per_sentence': {name: results[name][1] / len(sentences) for name in results},
+        'weights_mb': {name: sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+                                 if f.endswith(('.safetensors', '.bin'))) / 2**20
+                       for name, path in [('original', model_path), ('pruned', output_dir)]},
+    }
+    with open(os.path.join(output_dir, 'pruning.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"pruned checkpoint written to {output_dir}: {report['vocab_size']['original']} -> {report['vocab_size']['pruned']} "
+          f"output tokens, exact match {report['exact_match_vs_original']:.0%}, "
+          f"{report['seconds_per_sentence']['pruned']:.3f}s/sentence (original {report['seconds_per_sentence']['original']:.3f}s)")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prune the output vocabulary of a GE2PE checkpoint to the phoneme alphabet.')
+    parser.add_argument('model_path')
+    parser.add_argument('--output-dir')
+    parser.add_argument('--data', nargs='*', default=[], help='training csv or lexicon files whose phonemes must be kept')
+    parser.add_argument('--column', default='Mapped Phoneme', help='phoneme column of csv data')
+    parser.add_argument('--alphabet', default=PHONEME_ALPHABET, help='characters always kept')
+    parser.add_argument('--reference', help='text file with one reference sentence per line')
+    parser.add_argument('--num-beams', type=int, default=5)
+    args = parser.parse_args()
+    prune(args.model_path, args.output_dir, args.data, args.column, args.alphabet, args.reference, args.num_beams)
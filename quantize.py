@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import torch
+from transformers import AutoConfig, AutoTokenizer, GenerationConfig, T5ForConditionalGeneration
+from transformers.modeling_utils import no_init_weights
+# is_current and publish live in cache.py so that onnx serving can use them without importing torch
+from cache import SOURCE, is_current, publish
+
+PRECISIONS = ['fp32', 'bf16', 'int8']
+TOKEN_MAP = 'token_map.json'
+
+# small default reference set for the accuracy check; pass your own with --reference for a real figure
+REFERENCE_SENTENCES = [
+    'این کتابِ علی است',
+    'تست مدل تبدیل نویسه به واج',
+    'سعدی گفت: شکر خدا که هر چه طلب کردم از خدا بر منتهای همت خود کامران شدم',
+    'علی به مدرسه می‌رود',
+    'کاش تو هم می‌آمدی',
+    'دیروز باران شدیدی بارید و خیابان‌ها پر از آب شد',
+    'او کتاب‌هایش را روی میز گذاشت',
+    'شیر را از یخچال بیاور',
+    'مردم این شهر بسیار مهمان‌نواز هستند',
+    'قند را در چای حل کرد',
+]
+
+
+def quantized_path(model_path, precision):
+    """
+    returns the directory the converted artifact of model_path is written to, next to the checkpoint.
+    """
+    return os.path.normpath(model_path) + '-' + precision
+
+
+def safetensors_path(model_path):
+    """
+    returns a checkpoint directory holding model_path's weights as safetensors, which from_pretrained memory-maps
+    instead of unpickling; a pytorch_model.bin checkpoint is converted once into a '-safetensors' directory next to it.
+    """
+    if not os.path.isdir(model_path) or any(name.endswith('.safetensors') for name in os.listdir(model_path)):
+        return model_path
+    path = quantized_path(model_path, 'safetensors')
+    if not is_current(path, model_path):
+        model = T5ForConditionalGeneration.from_pretrained(model_path)
+        publish(model_path, path, lambda tmp: model.save_pretrained(tmp, safe_serialization=True))
+    return path
+
+
+def read_token_map(model_path):
+    """
+    returns the token map of a checkpoint with a pruned output vocabulary (see prune_vocab.py):
+    {'output_ids': tokenizer id of every output id, 'encoder_vocab_size': rows of the encoder embedding},
+    or None for a regular checkpoint.
+    """
+    path = os.path.join(model_path, TOKEN_MAP)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def empty_model(config, token_map = None):
+    """
+    builds an uninitialized T5 for config; with a token map, the encoder gets its own embedding over the
+    tokenizer's vocabulary while the decoder and lm_head cover config.vocab_size output ids.
+    """
+    with no_init_weights():
+        model = T5ForConditionalGeneration(config)
+        if token_map is not None:
+            model.encoder.set_input_embeddings(torch.nn.Embedding(token_map['encoder_vocab_size'], config.d_model))
+    return model
+
+
+def save_pruned(model, path):
+    """
+    writes a model built by empty_model with a token map; from_pretrained cannot load it, load_model can.
+    the shared decoder embedding is stored under each of its names, so every tensor is written on its own.
+    """
+    from safetensors.torch import save_file
+    os.makedirs(path, exist_ok=True)
+    model.config.save_pretrained(path)
+    if model.generation_config is not None:
+        model.generation_config.save_pretrained(path)
+    save_file({name: tensor.detach().clone().contiguous() for name, tensor in model.state_dict().items()},
+              os.path.join(path, 'model.safetensors'), metadata={'format': 'pt'})
+
+
+def load_pruned(path):
+    from safetensors.torch import load_file
+    model = empty_model(AutoConfig.from_pretrained(path), read_token_map(path))
+    model.load_state_dict(load_file(os.path.join(path, 'model.safetensors')))
+    if os.path.isfile(os.path.join(path, 'generation_config.json')):
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    return model.eval()
+
+
+def quantize_model(model, precision):
+    """
+    model: an fp32 T5ForConditionalGeneration.
+    precision: 'fp32', 'bf16' (bfloat16 weights) or 'int8' (dynamic int8 quantization of the linear layers).
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got '{precision}'")
+    if precision == 'bf16':
+        return model.to(torch.bfloat16)
+    if precision == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def load_model(model_path, precision = 'fp32'):
+    """
+    model_path: path to the fp32 checkpoint.
+    precision: one of PRECISIONS; for anything but fp32 the converted artifact is loaded, and built first
+               with convert() if it does not exist yet or was built from an older version of the checkpoint.
+    """
+    if precision == 'fp32':
+        if read_token_map(model_path) is not None:
+            return load_pruned(model_path)
+        return T5ForConditionalGeneration.from_pretrained(safetensors_path(model_path))
+    path = quantized_path(model_path, precision)
+    if not is_current(path, model_path):
+        convert(model_path, precision)
+    if precision == 'bf16':
+        if read_token_map(path) is not None:
+            return load_pruned(path).to(torch.bfloat16)
+        return T5ForConditionalGeneration.from_pretrained(path, torch_dtype=torch.bfloat16)
+    config = AutoConfig.from_pretrained(path)
+    model = empty_model(config, read_token_map(path))
+    model = quantize_model(model.eval(), precision)
+    # packed int8 weights are not plain tensors, so they cannot go through the weights_only loader
+    model.load_state_dict(torch.load(os.path.join(path, 'quantized.pt'), weights_only=False, mmap=True))
+    return model.eval()
+
+
+def character_error_rate(references, hypotheses):
+    edits = 0
+    total = 0
+    for ref, hyp in zip(references, hypotheses):
+        previous = list(range(len(hyp) + 1))
+        for i, r in enumerate(ref, 1):
+            current = [i]
+            for j, h in enumerate(hyp, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (r != h)))
+            previous = current
+        edits += previous[-1]
+        total += len(ref)
+    return edits / total if total else 0.0
+
+
+def read_reference(reference):
+    if reference is None:
+        return REFERENCE_SENTENCES
+    if isinstance(reference, str):
+        with open(reference, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    return list(reference)
+
+
+def convert(model_path, precision = 'int8', reference = None, num_beams = 5):
+    """
+    model_path: path to the fp32 checkpoint.
+    precision: 'bf16' or 'int8'.
+    reference: list of sentences or a text file with one sentence per line used for the accuracy check.
+    writes the ready-to-load artifact to quantized_path(model_path, precision) (see publish), together with a
+    quantization.json report holding the CER of the converted model against the fp32 outputs.
+    returns the report.
+    """
+    from GE2PE import GE2PE
+
+    if precision not in PRECISIONS or precision == 'fp32':
+        raise ValueError(f"precision must be 'bf16' or 'int8', got '{precision}'")
+    path = quantized_path(model_path, precision)
+    model = quantize_model(load_model(model_path).eval(), precision)
+
+    def write(directory):
+        if read_token_map(model_path) is not None:
+            shutil.copy(os.path.join(model_path, TOKEN_MAP), directory)
+        if precision == 'bf16' and read_token_map(model_path) is not None:
+            save_pruned(model, directory)
+        elif precision == 'bf16':
+            model.save_pretrained(directory)
+        else:
+            model.config.save_pretrained(directory)
+            if model.generation_config is not None:
+                model.generation_config.save_pretrained(directory)
+            torch.save(model.state_dict(), os.path.join(directory, 'quantized.pt'))
+        AutoTokenizer.from_pretrained(model_path).save_pretrained(directory)
+
+    publish(model_path, path, write)
+
+    sentences = read_reference(reference)
+    reports = {}
+    for name in ['fp32', precision]:
+        g2p = GE2PE(model_path=model_path, precision=name)
+        start = time.perf_counter()
+        outputs = g2p.generate(sentences, num_beams=num_beams)
+        reports[name] = (outputs, time.perf_counter() - start)
+    report = {
+        'precision': precision,
+        'source': os.path.abspath(model_path),
+        'reference_sentences': len(sentences),
+        'cer_vs_fp32': character_error_rate(reports['fp32'][0], reports[precision][0]),
+        'exact_match_vs_fp32': sum(a == b for a, b in zip(reports['fp32'][0], reports[precision][0])) / len(sentences),
+        'seconds_per_sentence': {name: reports[name][1] / len(sentences) for name in reports},
+        'weights_mb': {
+            'fp32': sum(os.path.getsize(os.path.join(model_path, f)) for f in os.listdir(model_path)
+                        if f.endswith(('.safetensors', '.bin'))) / 2**20,
+            precision: sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+                           if f.endswith(('.safetensors', '.bin', '.pt'))) / 2**20,
+        },
+    }
+    with open(os.path.join(path, 'quantization.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"{precision} artifact written to {path}: CER vs fp32 {report['cer_vs_fp32']:.4f}, "
+          f"{report['seconds_per_sentence'][precision]:.3f}s/sentence (fp32 {report['seconds_per_sentence']['fp32']:.3f}s)")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a GE2PE checkpoint to a quantized CPU artifact.')
+    parser.add_argument('model_path')
+    parser.add_argument('--precision', choices=['bf16', 'int8'], default='int8')
+    parser.add_argument('--reference', help='text file with one reference sentence per line')
+    parser.add_argument('--num-beams', type=int, default=5)
+    args = parser.parse_args()
+    convert(args.model_path, args.precision, args.reference, args.num_beams)
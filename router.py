@@ -0,0 +1,163 @@
+import csv
+import json
+from normalizer import STRIP_DIACRITICS
+from rule_engine import has_ezafe, strip_ezafe
+
+
+class HomographIndex():
+
+    def __init__(self, homographs = (), lexicon = None, ezafe = ()):
+        """
+        homographs: words whose pronunciation depends on context; they are always decoded in context.
+        lexicon: dict of unambiguous word -> pronunciation (without the ezafe marker).
+        ezafe: words seen taking ezafe; when followed by another word, the model decides their marker.
+        """
+
+        self.homographs = set(homographs)
+        self.lexicon = dict(lexicon or {})
+        self.ezafe = set(ezafe)
+
+    @classmethod
+    def from_csv(cls, path, grapheme_column = 'Grapheme', phoneme_column = 'Mapped Phoneme',
+                 homograph_column = 'Homograph Grapheme'):
+        """
+        path: the training csv used by training-scripts/finetune-ge2pe.py.
+        words listed in homograph_column, and words aligned to more than one pronunciation anywhere in the data,
+        become homographs; every other word whose sentence aligns word by word with its phonemes enters the lexicon.
+        """
+        homographs = set()
+        prons = {}
+        ezafe = set()
+        with open(path, encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                homographs.update((row.get(homograph_column) or '').translate(STRIP_DIACRITICS).split())
+                words = (row.get(grapheme_column) or '').translate(STRIP_DIACRITICS).split(' ')
+                phonemes = (row.get(phoneme_column) or '').split(' ')
+                if len(words) != len(phonemes):
+                    continue
+                for word, pron in zip(words, phonemes):
+                    if not word or not pron:
+                        continue
+                    if has_ezafe(pron):
+                        ezafe.add(word)
+                    prons.setdefault(word, set()).add(strip_ezafe(pron))
+        homographs.update(word for word, found in prons.items() if len(found) > 1)
+        lexicon = {word: next(iter(found)) for word, found in prons.items() if word not in homographs}
+        return cls(homographs, lexicon, ezafe)
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'homographs': sorted(self.homographs), 'lexicon': self.lexicon, 'ezafe': sorted(self.ezafe)},
+                      f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['homographs'], data['lexicon'], data['ezafe'])
+
+
+class HomographRouter():
+
+    def __init__(self, g2p, index, context = 2):
+        """
+        g2p: a loaded GE2PE instance.
+        index: HomographIndex (e.g. HomographIndex.from_csv on the training data).
+        context: number of words on each side of an ambiguous word that are decoded with it.
+        unambiguous words are taken from the index, or decoded once on their own and remembered; only windows
+        around homographs (and around words that may take ezafe) go through the model in context.
+        """
+
+        self.g2p = g2p
+        self.index = index
+        self.context = context
+        self.words = {}  # words decoded on their own, in addition to index.lexicon
+        self.stats_counts = {'words': 0, 'skipped': 0, 'decoded_words': 0, 'windows': 0, 'fallbacks': 0}
+
+    def _known(self, word):
+        pron = self.index.lexicon.get(word)
+        return self.words.get(word) if pron is None else pron
+
+    def _ambiguous(self, words, i):
+        word = words[i]
+        if word in self.index.homographs or self._known(word) is None:
+            return True
+        return word in self.index.ezafe and i + 1 < len(words) and words[i + 1] != ''
+
+    def _windows(self, words):
+        windows = []
+        for i in range(len(words)):
+            if words[i] and self._ambiguous(words, i):
+                start, end = max(0, i - self.context), min(len(words), i + self.context + 1)
+                if windows and start <= windows[-1][1]:
+                    windows[-1][1] = end
+                else:
+                    windows.append([start, end])
+        return windows
+
+    def generate(self, input_list, batch_size = 10, use_rules = False, use_dict = False, num_beams = 5):
+        """
+        same arguments and result as GE2PE.generate for the routed sentences.
+        """
+        g2p = self.g2p
+        normalized = [g2p.normalize(text) for text in input_list]
+        sentences = [text.translate(STRIP_DIACRITICS).split(' ') for text in normalized]
+
+        # every unknown, unambiguous word of the whole call is decoded once, on its own
+        unknown = {word: None for words in sentences for word in words
+                   if word and word not in self.index.homographs and self._known(word) is None}
+        if unknown:
+            for word, pron in zip(unknown, g2p.generate(list(unknown), batch_size, num_beams=num_beams)):
+                if pron and ' ' not in pron:
+                    self.words[word] = strip_ezafe(pron)
+            self.stats_counts['decoded_words'] += len(unknown)
+
+        plans = [self._windows(words) for words in sentences]
+        texts = {}
+        for words, windows in zip(sentences, plans):
+            for start, end in windows:
+                texts[' '.join(words[start:end])] = None
+        if texts:
+            for text, pron in zip(texts, g2p.generate(list(texts), batch_size, num_beams=num_beams)):
+                texts[text] = pron
+            self.stats_counts['windows'] += len(texts)
+
+        outputs = [None] * len(sentences)
+        fallback = []
+        for n, (words, windows) in enumerate(zip(sentences, plans)):
+            prons = [self._known(word) or '' for word in words]
+            for start, end in windows:
+                pieces = texts[' '.join(words[start:end])].split(' ')
+                if len(pieces) != end - start:
+                    break
+                for i, pron in enumerate(pieces, start):
+                    prons[i] = pron
+                    if has_ezafe(pron):
+                        self.index.ezafe.add(words[i])
+            else:
+                self.stats_counts['words'] += len(words)
+                in_window = set(i for start, end in windows for i in range(start, end))
+                self.stats_counts['skipped'] += sum(1 for i, word in enumerate(words) if i not in in_window and word not in unknown)
+                outputs[n] = ' '.join(prons)
+                continue
+            fallback.append(n)
+
+        # a window whose phonemes do not line up with its words is decoded as part of its whole sentence
+        if fallback:
+            for n, pron in zip(fallback, g2p.generate([' '.join(sentences[n]) for n in fallback], batch_size,
+                                                      num_beams=num_beams)):
+                outputs[n] = pron
+                self.stats_counts['words'] += len(sentences[n])
+            self.stats_counts['fallbacks'] += len(fallback)
+
+        stripped = [' '.join(words) for words in sentences]
+        return g2p._postprocess(normalized, stripped, outputs, use_rules, use_dict)
+
+    def stats(self):
+        """
+        returns word counts and skipped_fraction, the share of words resolved without running the model
+        (not inside a decoded window and not decoded on their own in the same call).
+        """
+        stats = dict(self.stats_counts)
+        stats['skipped_fraction'] = stats['skipped'] / stats['words'] if stats['words'] else 0.0
+        return stats
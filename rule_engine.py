@@ -0,0 +1,187 @@
+import time
+import random
+import argparse
+
+FATHA = 'َ'
+KASRA = 'ِ'
+DAMMA = 'ُ'
+# short-vowel diacritic -> phoneme it stands for
+VOWELS = {FATHA: '/', KASRA: 'e', DAMMA: 'o'}
+PHONEME_VOWELS = frozenset('a/ieuo')
+# letter -> its most common phoneme in the model's alphabet (a long a, / short a, $ sh, c ch, ; zh, @ glottal stop),
+# one phoneme per letter so apply_rules can still place diacritics; آ is two since apply_rules reads it as ءا
+LETTER_PHONEMES = {
+    'ا': 'a', 'آ': '@a', 'ب': 'b', 'پ': 'p', 'ت': 't', 'ث': 's', 'ج': 'j', 'چ': 'c', 'ح': 'h', 'خ': 'x', 'د': 'd',
+    'ذ': 'z', 'ر': 'r', 'ز': 'z', 'ژ': ';', 'س': 's', 'ش': '$', 'ص': 's', 'ض': 'z', 'ط': 't', 'ظ': 'z', 'ع': '@',
+    'غ': 'q', 'ف': 'f', 'ق': 'q', 'ک': 'k', 'گ': 'g', 'ل': 'l', 'م': 'm', 'ن': 'n', 'و': 'v', 'ه': 'h', 'ی': 'y',
+    'ء': '@', 'أ': '@', 'ئ': '@', 'ؤ': '@', 'ة': 'e',
+}
+
+
+def has_ezafe(pron):
+    return pron.endswith('1')
+
+
+def add_ezafe(pron):
+    """ returns pron with ezafe written the way the model writes it: ye1 after a final e, else e1. """
+    return pron + ('ye1' if pron.endswith('e') else 'e1')
+
+
+def strip_ezafe(pron):
+    """
+    pron: phonemes of one word.
+    returns the word's own pronunciation without the ezafe that belongs to its context, undoing add_ezafe
+    (a bare trailing 1 is dropped as well).
+    """
+    if pron.endswith('eye1'):
+        return pron[:-3]
+    if pron.endswith('e1') and len(pron) > 2:
+        return pron[:-2]
+    return pron[:-1] if has_ezafe(pron) else pron
+
+
+def spell_out(word):
+    """
+    word: a diacritic-free word.
+    returns a rough pronunciation read letter by letter, for words no model output or dictionary covers:
+    an initial ا is the glottal stop before its vowel, و and ی are read as vowels inside a word and a final
+    ه as e; short vowels are not guessed.
+    """
+    pron = []
+    last = len(word) - 1
+    for j, char in enumerate(word):
+        phoneme = LETTER_PHONEMES.get(char, '' if char == '‌' else char)
+        if not j and char == 'ا':
+            phoneme = '@'
+        elif j and char == 'و':
+            phoneme = 'u'
+        elif j and char == 'ی':
+            phoneme = 'i'
+        elif j and j == last and char == 'ه':
+            phoneme = 'e'
+        pron.append(phoneme)
+    return ''.join(pron)
+
+
+def apply_rules(grapheme, phoneme, strip = False):
+    """
+    grapheme: normalized input sentence, with its diacritics.
+    phoneme: decoded phonemes of that sentence.
+    strip: also apply the final .strip() of GE2PE.generate.
+    returns the phonemes with the short vowels written in the grapheme applied; identical to the
+    original GE2PE.rules, but every word is rebuilt in one left-to-right pass instead of re-slicing
+    the pronunciation for each diacritic.
+    """
+    pron = phoneme.replace('1', '')
+    if grapheme.count(' ') != phoneme.count(' '):
+        result = phoneme
+    elif FATHA not in grapheme and KASRA not in grapheme and DAMMA not in grapheme:
+        result = pron
+    else:
+        prons = pron.split(' ')
+        for i, word in enumerate(grapheme.split(' ')):
+            if FATHA in word or KASRA in word or DAMMA in word:
+                prons[i] = _apply_word(word.replace('آ', 'ءا'), prons[i])
+        result = ' '.join(prons)
+    return result.strip() if strip else result
+
+
+def _apply_word(word, pron):
+    # out holds the finished prefix of the pronunciation, pron[k:] the part not yet reached,
+    # so the pronunciation the original rules would hold at step j is ''.join(out) + pron[k:]
+    out = []
+    k = 0
+    size = len(pron)
+    last = len(word) - 1
+    for j, char in enumerate(word):
+        vowel = VOWELS.get(char)
+        if vowel is None:
+            if k < size:
+                out.append(pron[k])
+                k += 1
+            continue
+        if j == last:
+            if k < size:
+                end = pron[-1]
+            elif out:
+                end = out[-1]
+            else:
+                raise IndexError('string index out of range')
+            if end != vowel:
+                return ''.join(out) + pron[k:] + vowel
+        if len(out) < j or k >= size:
+            raise IndexError('string index out of range')
+        if pron[k] in PHONEME_VOWELS:
+            k += 1
+        out.append(vowel)
+    return ''.join(out) + pron[k:]
+
+
+def apply_rules_batch(graphemes, phonemes):
+    """
+    graphemes, phonemes: parallel lists for a whole batch.
+    returns the final, stripped outputs.
+    """
+    return [apply_rules(grapheme, phoneme, True) for grapheme, phoneme in zip(graphemes, phonemes)]
+
+
+def reference_rules(grapheme, phoneme):
+    """ the original GE2PE.rules, kept as the reference for the equivalence check below. """
+    grapheme = grapheme.replace('آ', 'ءا')
+    words = grapheme.split(' ')
+    prons = phoneme.replace('1', '').split(' ')
+    if len(words) != len(prons):
+        return phoneme
+    for i in range(len(words)):
+        if 'ِ' not in words[i] and  'ُ' not in words[i] and 'َ' not in words[i]:
+            continue
+        for j in range(len(words[i])):
+            for diacritic, vowel in VOWELS.items():
+                if words[i][j] == diacritic:
+                    if j == len(words[i]) - 1 and prons[i][-1] != vowel:
+                        prons[i] = prons[i] + vowel
+                    elif prons[i][j] in PHONEME_VOWELS:
+                        prons[i] = prons[i][:j] + vowel + prons[i][j+1:]
+                    else:
+                        prons[i] = prons[i][:j] + vowel + prons[i][j:]
+    return ' '.join(prons)
+
+
+def fuzz_corpus(size, seed = 0):
+    rng = random.Random(seed)
+    letters = 'ابپتجچخدرزسشکگلمنوهیآ' + FATHA * 3 + KASRA * 3 + DAMMA * 3
+    phones = 'abptjcxdrzsSkglmnvhyiuoeA/1'
+    corpus = []
+    for _ in range(size):
+        words = rng.randint(1, 12)
+        grapheme = ' '.join(''.join(rng.choice(letters) for _ in range(rng.randint(1, 9))) for _ in range(words))
+        phoneme = ' '.join(''.join(rng.choice(phones) for _ in range(rng.randint(0, 11)))
+                           for _ in range(words if rng.random() < 0.9 else rng.randint(1, 12)))
+        corpus.append((grapheme, phoneme))
+    return corpus
+
+
+def _outcome(fn, grapheme, phoneme):
+    try:
+        return fn(grapheme, phoneme)
+    except IndexError:
+        return IndexError
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check apply_rules against the original rules and time both.')
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    corpus = fuzz_corpus(args.size, args.seed)
+    mismatches = sum(_outcome(apply_rules, g, p) != _outcome(reference_rules, g, p) for g, p in corpus)
+    print(f'{mismatches} mismatches on {len(corpus)} fuzzed pairs')
+    valid = [(g, p) for g, p in corpus if _outcome(reference_rules, g, p) is not IndexError]
+    timings = {}
+    for name, fn in [('original', reference_rules), ('compiled', apply_rules)]:
+        start = time.perf_counter()
+        for g, p in valid:
+            fn(g, p)
+        timings[name] = time.perf_counter() - start
+    print(f"original {timings['original'] * 1e6 / len(valid):.2f}us/pair, compiled {timings['compiled'] * 1e6 / len(valid):.2f}us/pair, "
+          f"speedup {timings['original'] / timings['compiled']:.2f}x")
@@ -0,0 +1,60 @@
+import re
+
+# sentence and clause boundaries; a dot between digits is a decimal point, not a boundary
+BOUNDARY = r'(?:[،؛؟!?\n]|\.(?!\d))'
+SEPARATOR = re.compile(r'\s*' + BOUNDARY + r'(?:\s|' + BOUNDARY + r')*')
+
+
+def split_text(text, max_chars = None):
+    """
+    text: raw input as typed by the user.
+    max_chars: chunks longer than this are further split at spaces (None for no limit).
+    returns (chunks, glue) where len(glue) == len(chunks) + 1 and
+    glue[0] + chunks[0] + glue[1] + ... + chunks[-1] + glue[-1] == text,
+    so punctuation and spacing live in glue and are put back unchanged by join_chunks.
+    """
+    chunks = []
+    glue = []
+    position = 0
+    pending = ''
+    for match in SEPARATOR.finditer(text):
+        pending = _add(text[position:match.start()], pending, chunks, glue, max_chars)
+        pending += match.group()
+        position = match.end()
+    pending = _add(text[position:], pending, chunks, glue, max_chars)
+    glue.append(pending)
+    return chunks, glue
+
+
+def _add(piece, pending, chunks, glue, max_chars):
+    # leading/trailing whitespace of a piece belongs to the glue around it
+    stripped = piece.strip()
+    if not stripped:
+        return pending + piece
+    start = piece.index(stripped)
+    pending += piece[:start]
+    words = stripped.split(' ')
+    current = words[0]
+    for word in words[1:]:
+        if max_chars is not None and len(current) + 1 + len(word) > max_chars:
+            glue.append(pending)
+            chunks.append(current)
+            pending = ' '
+            current = word
+        else:
+            current += ' ' + word
+    glue.append(pending)
+    chunks.append(current)
+    return piece[start + len(stripped):]
+
+
+def join_chunks(outputs, glue):
+    """
+    outputs: phonemes of every chunk returned by split_text.
+    glue: the glue returned by split_text.
+    """
+    parts = [glue[0]]
+    for output, after in zip(outputs, glue[1:]):
+        parts.append(output)
+        parts.append(after)
+    return ''.join(parts)
@@ -0,0 +1,162 @@
+import argparse
+from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field, model_validator
+import metrics
+from startup import Warmup
+from async_ge2pe import AsyncGE2PE, Overloaded, priority_lanes
+from segmenter import split_text
+from continuous import ContinuousGE2PE
+from pinglish_to_persian import pinglish_to_persian
+from config import (MODEL_PATH, SERVER_MAX_BATCH_SIZE, SERVER_MAX_WAIT, SERVER_MAX_QUEUE, SERVER_TIMEOUT,
+                    SERVER_INTERACTIVE_MAX_BATCH_SIZE, SERVER_INTERACTIVE_MAX_QUEUE, SERVER_CONTINUOUS, SERVER_MAX_ROWS,
+                    SERVER_DEADLINE)
+
+
+# longest chunk a segmented text is split into before queueing
+MAX_CHUNK_CHARS = 200
+
+
+class PhonemizeRequest(BaseModel):
+    text: Optional[str] = None
+    texts: Optional[List[str]] = None
+    use_rules: bool = True
+    use_dict: bool = False
+    num_beams: int = Field(5, ge=1, le=16)
+    segment: bool = True
+    timeout: Optional[float] = Field(None, gt=0, description='seconds; capped by the server timeout')
+    deadline: Optional[float] = Field(None, gt=0, description='seconds; outputs that would miss it degrade instead of failing')
+    lane: Optional[Literal['interactive', 'bulk']] = Field(None, description='default: interactive for text, bulk for texts')
+
+    @model_validator(mode='after')
+    def one_input(self):
+        if (self.text is None) == (self.texts is None):
+            raise ValueError('pass exactly one of "text" and "texts"')
+        return self
+
+
+class PinglishRequest(BaseModel):
+    text: str
+    original: Optional[str] = None
+
+
+def create_app(model_path = MODEL_PATH, max_batch_size = SERVER_MAX_BATCH_SIZE, max_wait = SERVER_MAX_WAIT,
+               max_queue = SERVER_MAX_QUEUE, timeout = SERVER_TIMEOUT, interactive_batch_size = SERVER_INTERACTIVE_MAX_BATCH_SIZE,
+               interactive_queue = SERVER_INTERACTIVE_MAX_QUEUE, continuous = SERVER_CONTINUOUS, max_rows = SERVER_MAX_ROWS,
+               deadline = SERVER_DEADLINE, **kwargs):
+    """
+    model_path: path to where the GE2PE transformer is saved.
+    max_batch_size, max_queue: batch size and queue depth of the bulk lane of the AsyncGE2PE batcher shared
+                               by all requests.
+    interactive_batch_size, interactive_queue: the same for the interactive lane, which is always served first.
+    max_wait: seconds both lanes gather requests before decoding.
+    timeout: longest a request may wait for its phonemes, in seconds.
+    continuous: decode with the ContinuousGE2PE step scheduler (torch backend only) instead of whole batches;
+                the lane batch sizes then cap how many sentences of each lane decode at once.
+    max_rows: decoder rows the continuous scheduler steps together.
+    deadline: default latency budget of a request in seconds (None: none); a request past it gets degraded
+              phonemes, flagged in the response, rather than a 504 (see GE2PE.generate).
+    kwargs: any other GE2PE argument.
+    every call builds an independent app with its own metrics registry; serve it with
+    `uvicorn server:create_app --factory`, which reads the settings from the environment (see config.py).
+    """
+    lanes = priority_lanes(interactive_batch_size, interactive_queue, max_batch_size, max_queue, max_wait)
+    limits = {lane.name: lane.max_queue for lane in lanes}
+    registry = metrics.make_registry()
+
+    def wrap(g2p):
+        if continuous:
+            return metrics.register_g2p(ContinuousGE2PE(g2p, max_rows, lanes=lanes), registry)
+        return metrics.register_g2p(AsyncGE2PE(g2p, lanes=lanes), registry)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        # /health answers right away; /ready and /phonemize wait for the background load
+        app.state.warmup = Warmup(model_path, wrap=wrap, **kwargs)
+        yield
+
+    app = FastAPI(title='GE2PE', lifespan=lifespan)
+    app.mount('/metrics', metrics.make_asgi_app(registry))
+
+    def loaded():
+        warmup = app.state.warmup
+        if not warmup.ready():
+            raise HTTPException(503, 'model is loading', headers={'Retry-After': '5'})
+        try:
+            return warmup.result()
+        except Exception as e:
+            raise HTTPException(503, f'model failed to load: {e}')
+
+    @app.get('/health')
+    def health():
+        return {'status': 'ok'}
+
+    @app.get('/ready')
+    def ready():
+        warmup = app.state.warmup
+        if not warmup.ready():
+            return JSONResponse({'status': 'loading'}, status_code=503)
+        if warmup.future.exception() is not None:
+            return JSONResponse({'status': 'failed', 'error': str(warmup.future.exception())}, status_code=503)
+        return {'status': 'ready', 'load_times': warmup.times, 'batcher': warmup.result().stats()}
+
+    @app.post('/phonemize')
+    async def phonemize(request: PhonemizeRequest):
+        g2p = loaded()
+        texts = [request.text] if request.text is not None else request.texts
+        lane = request.lane or ('interactive' if request.text is not None else 'bulk')
+        # segmented texts are queued chunk by chunk, so the chunks are what has to fit in the lane
+        queued = sum(len(split_text(text, MAX_CHUNK_CHARS)[0]) for text in texts) if request.segment else len(texts)
+        if limits[lane] is not None and queued > limits[lane]:
+            raise HTTPException(413, f'at most {limits[lane]} sentences per request in the {lane} lane, got {queued}')
+        wait = min(request.timeout or timeout, timeout)
+        try:
+            with metrics.timed_stage('http_phonemize'):
+                outputs, degraded = await g2p.agenerate(texts, use_rules=request.use_rules, use_dict=request.use_dict,
+                                                        num_beams=request.num_beams, segment=request.segment,
+                                                        max_chunk_chars=MAX_CHUNK_CHARS, timeout=wait,
+                                                        lane=lane, deadline=request.deadline or deadline,
+                                                        return_degraded=True)
+        except Overloaded as e:
+            raise HTTPException(503, str(e), headers={'Retry-After': '1'})
+        except TimeoutError:
+            raise HTTPException(504, f'not phonemized within {wait:g}s')
+        if request.text is not None:
+            return {'phonemes': outputs[0], 'degraded': degraded[0]}
+        return {'phonemes': outputs, 'degraded': degraded}
+
+    @app.post('/pinglish-to-persian')
+    def to_persian(request: PinglishRequest):
+        with metrics.timed_stage('http_pinglish'):
+            return {'persian': pinglish_to_persian(request.text, request.original)}
+
+    return app
+
+
+if __name__ == '__main__':
+    import uvicorn
+    parser = argparse.ArgumentParser(description='HTTP phonemization service with server-side dynamic batching.')
+    parser.add_argument('model_path', nargs='?', default=MODEL_PATH)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=SERVER_MAX_BATCH_SIZE, help='bulk lane batch size')
+    parser.add_argument('--max-wait', type=float, default=SERVER_MAX_WAIT, help='seconds to gather a batch')
+    parser.add_argument('--max-queue', type=int, default=SERVER_MAX_QUEUE, help='bulk sentences waiting before 503')
+    parser.add_argument('--interactive-batch-size', type=int, default=SERVER_INTERACTIVE_MAX_BATCH_SIZE)
+    parser.add_argument('--interactive-queue', type=int, default=SERVER_INTERACTIVE_MAX_QUEUE,
+                        help='interactive sentences waiting before 503')
+    parser.add_argument('--continuous', action='store_true', default=SERVER_CONTINUOUS,
+                        help='step the decoder token by token over a rolling set of sentences (torch backend)')
+    parser.add_argument('--max-rows', type=int, default=SERVER_MAX_ROWS, help='decoder rows per step with --continuous')
+    parser.add_argument('--timeout', type=float, default=SERVER_TIMEOUT, help='per-request timeout in seconds')
+    parser.add_argument('--deadline', type=float, default=SERVER_DEADLINE,
+                        help='default per-request latency budget in seconds; later outputs degrade instead of failing')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'])
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'int8'])
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.model_path, args.max_batch_size, args.max_wait, args.max_queue, args.timeout,
+                           args.interactive_batch_size, args.interactive_queue, args.continuous, args.max_rows,
+                           args.deadline, backend=args.backend,
+                           precision=args.precision), host=args.host, port=args.port)
@@ -0,0 +1,246 @@
+import time
+import argparse
+from decoding import stop_reached
+from rule_engine import strip_ezafe
+
+
+class WordDraft():
+
+    def __init__(self, lexicon = None, learn = True, lookahead = 3, max_words = 100000):
+        """
+        lexicon: dict-like word -> phonemes (e.g. the GE2PE dictionary, a lexicon_store.Lexicon or
+                 HomographIndex.lexicon); may be None.
+        learn: remember the pronunciation of every word of decoded sentences whose output lines up word by word,
+               so words seen before are drafted even when the lexicon lacks them.
+        lookahead: number of whole words drafted after the one being decoded.
+        max_words: learned words kept; the memory is cleared when it is full.
+        """
+
+        self.lexicon = lexicon
+        self.learn_words = learn
+        self.lookahead = lookahead
+        self.max_words = max_words
+        self.words = {}
+
+    def pron(self, word):
+        pron = self.lexicon.get(word) if self.lexicon is not None else None
+        return self.words.get(word) if pron is None else pron
+
+    def __call__(self, words, generated):
+        """
+        words: the diacritic-free input split at spaces.
+        generated: phonemes decoded so far.
+        returns (draft text continuing generated, True if the draft runs to the end of the sentence).
+        """
+        done = generated.split(' ')
+        i, partial = len(done) - 1, done[-1]
+        if i >= len(words):
+            return '', False
+        pron = self.pron(words[i])
+        if pron is None:
+            return '', False
+        if pron.startswith(partial):
+            draft = pron[len(partial):]
+        elif partial.startswith(pron):
+            draft = ''  # the word is decoded, with a suffix such as ezafe: guess the words after it
+        else:
+            return '', False
+        for j in range(i + 1, min(len(words), i + 1 + self.lookahead)):
+            pron = self.pron(words[j])
+            if pron is None:
+                return draft, False
+            draft += ' ' + pron
+        return draft, i + self.lookahead >= len(words) - 1
+
+    def learn(self, words, output):
+        if not self.learn_words:
+            return
+        prons = output.split(' ')
+        if len(prons) != len(words):
+            return
+        if len(self.words) + len(words) > self.max_words:
+            self.words.clear()
+        for word, pron in zip(words, prons):
+            if word and pron:
+                self.words[word] = strip_ezafe(pron)
+
+
+class SpeculativeGE2PE():
+
+    def __init__(self, g2p, drafter = None, max_draft = 32):
+        """
+        g2p: a loaded GE2PE with the torch backend.
+        drafter: callable(words, generated) -> (draft text, reaches the end) proposing how the phonemes continue,
+                 e.g. WordDraft (the default, over g2p.dictionary) or a wrapper around a small student model;
+                 an optional learn(words, output) method is called with every decoded sentence.
+        max_draft: most draft tokens verified in one decoder pass; each sentence starts there, verifies two more
+                   after a fully accepted draft and one fewer after a rejection, so poor drafts cost little.
+        greedy decoding only: the model checks a whole draft in one forward pass and keeps the longest prefix
+        it agrees with plus its own next token, so the output is the one greedy decoding gives without a draft.
+        """
+
+        if g2p.backend_name != 'torch':
+            raise ValueError('speculative decoding runs the torch model, use backend="torch"')
+        import torch
+        self.torch = torch
+        self.g2p = g2p
+        self.model = g2p.model
+        self.device = 'cuda' if g2p.GPU else 'cpu'
+        self.drafter = WordDraft(g2p.dictionary) if drafter is None else drafter
+        self.max_draft = max_draft
+        self.start = self.model.config.decoder_start_token_id
+        self.eos = self.model.config.eos_token_id
+        # tokenizer id of every decoder id, and back (the identity unless the output vocabulary is pruned)
+        output_ids = g2p.backend.output_ids
+        self.output_ids = list(range(self.model.config.vocab_size)) if output_ids is None else output_ids.tolist()
+        self.decoder_ids = {token: i for i, token in enumerate(self.output_ids)}
+        self.last_stats = []
+        self.totals = {'sentences': 0, 'tokens': 0, 'passes': 0, 'proposed': 0, 'accepted': 0}
+
+    def _text(self, tokens):
+        # ByT5 ids are utf-8 bytes shifted by the special tokens; tokenizer.decode is far slower than the decoder step
+        offset = self.g2p.tokenizer.offset
+        tokens = [self.output_ids[t] for t in tokens[1:]]
+        return bytes(t - offset for t in tokens if offset <= t < offset + 256).decode('utf-8', errors='ignore')
+
+    def _draft(self, words, tokens, budget):
+        text, final = self.drafter(words, self._text(tokens))
+        ids = []
+        for token in self.g2p.tokenizer(text, add_special_tokens=False)['input_ids'] if text else []:
+            if token not in self.decoder_ids:
+                return ids[:budget]  # the model cannot emit it, so nothing after it can be accepted
+            ids.append(self.decoder_ids[token])
+        if final:
+            ids.append(self.eos)
+        return ids[:budget]
+
+    def decode(self, token_ids, limit, words = None):
+        """
+        token_ids: tokenized input (see GE2PE._prepare); limit: its token budget (see GE2PE.decode_limits).
+        words: the input words to draft from; None decodes one token per pass, as plain greedy search does.
+        returns (decoder token ids including the start token, record of this sentence).
+        """
+        torch = self.torch
+        start = time.perf_counter()
+        with torch.inference_mode():
+            input_ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+            mask = torch.ones_like(input_ids)
+            encoder_outputs = self.model.encoder(input_ids=input_ids, attention_mask=mask)
+            tokens = [self.start]
+            cache = None
+            passes = proposed = accepted = 0
+            length = self.max_draft
+            while True:
+                draft = self._draft(words, tokens, min(length, limit - len(tokens) + 1)) if words is not None else []
+                fed = (tokens if cache is None else tokens[-1:]) + draft
+                out = self.model(encoder_outputs=encoder_outputs, attention_mask=mask,
+                                 decoder_input_ids=torch.tensor([fed], device=self.device), past_key_values=cache,
+                                 use_cache=True)
+                cache = out.past_key_values
+                passes += 1
+                proposed += len(draft)
+                # predictions[j] is the greedy token after fed[:j + 1]; the last len(draft) + 1 of them are new
+                predictions = out.logits[0, -len(draft) - 1:].argmax(dim=-1).tolist()
+                finished = False
+                for j, token in enumerate(predictions):
+                    tokens.append(token)
+                    if stop_reached(tokens, self.eos, limit, self.g2p.repeat_window):
+                        finished = True
+                        break
+                    if j == len(draft) or draft[j] != token:
+                        break
+                    accepted += 1
+                if finished:
+                    break
+                if draft:
+                    length = min(self.max_draft, length + 2) if j == len(draft) else max(1, length - 1)
+                # the cache keeps every fed position; drop the rejected part of the draft
+                cache.crop(len(tokens) - 1)
+        record = {'tokens': len(tokens) - 1, 'passes': passes, 'proposed': proposed, 'accepted': accepted,
+                  'acceptance_rate': accepted / proposed if proposed else 0.0, 'seconds': time.perf_counter() - start}
+        return tokens, record
+
+    def generate(self, input_list, use_rules = False, use_dict = False, num_beams = 1, measure = False):
+        """
+        input_list: list of sentences to be phonemized.
+        use_rules, use_dict: as in GE2PE.generate.
+        num_beams: only 1 is decoded speculatively; beam search is handed to GE2PE.generate.
+        measure: also decode every sentence without a draft, adding its time, the wall-clock speedup and whether
+                 both outputs are the same to the sentence's record.
+        returns the list of phonemized sentences; last_stats holds one record per decoded sentence with its
+        tokens, decoder passes, proposed and accepted draft tokens and acceptance rate.
+        """
+        g2p = self.g2p
+        if num_beams != 1:
+            return g2p.generate(input_list, batch_size=max(1, len(input_list)), use_rules=use_rules,
+                                use_dict=use_dict, num_beams=num_beams)
+        normalized = [g2p.normalize(text) for text in input_list]
+        keys, found, todo = g2p._lookup(normalized, use_rules, use_dict, num_beams)
+        inputs = list(todo.values())
+        stripped, token_ids = g2p._prepare(inputs)
+        limits = g2p.decode_limits([len(text) for text in stripped])
+        outputs = []
+        self.last_stats = []
+        for text, ids, limit in zip(stripped, token_ids, limits):
+            words = text.split(' ')
+            tokens, record = self.decode(ids, limit, words)
+            output_ids = [self.output_ids[token] for token in tokens]
+            g2p._count_limits(self.torch.tensor([output_ids]), [limit])
+            output = g2p.tokenizer.decode(output_ids, skip_special_tokens=True)
+            if measure:
+                plain, baseline = self.decode(ids, limit)
+                record.update({'baseline_seconds': baseline['seconds'], 'speedup': baseline['seconds'] / record['seconds'],
+                               'identical': plain == tokens})
+            if hasattr(self.drafter, 'learn'):
+                self.drafter.learn(words, output)
+            for k in ['tokens', 'passes', 'proposed', 'accepted']:
+                self.totals[k] += record[k]
+            self.totals['sentences'] += 1
+            self.last_stats.append(record)
+            outputs.append(output)
+        outputs = g2p._postprocess(inputs, stripped, outputs, use_rules, use_dict)
+        return g2p._store(keys, found, todo, outputs)
+
+    def stats(self):
+        """ totals over all calls, with the acceptance rate and the mean tokens decoded per decoder pass. """
+        stats = dict(self.totals)
+        stats['acceptance_rate'] = stats['accepted'] / stats['proposed'] if stats['proposed'] else 0.0
+        stats['tokens_per_pass'] = stats['tokens'] / stats['passes'] if stats['passes'] else 0.0
+        return stats
+
+
+if __name__ == '__main__':
+    from GE2PE import GE2PE
+    from benchmarks.suite import SENTENCES
+    parser = argparse.ArgumentParser(description='Speculative greedy decoding with a lexicon draft: per-sentence '
+                                                 'acceptance rate and speedup over plain greedy decoding.')
+    parser.add_argument('model_path')
+    parser.add_argument('--input', help='text file with one sentence per line (default: the benchmark sentences)')
+    parser.add_argument('--lexicon', help='TSV/CSV lexicon (see lexicon_store.read_entries) to draft from')
+    parser.add_argument('--passes', type=int, default=2, help='passes over the input; later ones draft from learned words')
+    parser.add_argument('--max-draft', type=int, default=32)
+    args = parser.parse_args()
+
+    lexicon = None
+    if args.lexicon:
+        from lexicon_store import read_entries
+        lexicon = dict(read_entries(args.lexicon))
+    g2p = GE2PE(model_path=args.model_path)
+    spec = SpeculativeGE2PE(g2p, WordDraft(lexicon), args.max_draft)
+    if args.input:
+        with open(args.input, encoding='utf-8') as f:
+            sentences = [line.strip() for line in f if line.strip()]
+    else:
+        sentences = list(SENTENCES)
+    g2p.generate(sentences[:1], num_beams=1)  # warm-up
+    for n in range(args.passes):
+        outputs = spec.generate(sentences, num_beams=1, measure=True)
+        expected = g2p.generate(sentences, batch_size=1, num_beams=1)
+        print(f'pass {n + 1}: {sum(a != b for a, b in zip(outputs, expected))} of {len(sentences)} outputs differ from GE2PE.generate')
+        print('| sentence | tokens | passes | accepted / proposed | acceptance | speedup |')
+        print('|---|---|---|---|---|---|')
+        for i, record in enumerate(spec.last_stats):
+            print(f"| {i} | {record['tokens']} | {record['passes']} | {record['accepted']} / {record['proposed']} | "
+                  f"{record['acceptance_rate']:.0%} | {record['speedup']:.2f}x |")
+    stats = spec.stats()
+    print(f"overall: acceptance {stats['acceptance_rate']:.0%}, {stats['tokens_per_pass']:.2f} tokens per decoder pass")
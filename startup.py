@@ -0,0 +1,88 @@
+import sys
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+WARM_UP_TEXT = 'این یک جمله برای گرم کردن مدل است'
+
+
+@contextmanager
+def timed(times, stage):
+    """ adds the seconds spent inside the block to times[stage]. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        times[stage] = times.get(stage, 0.0) + time.perf_counter() - start
+
+
+class Warmup():
+
+    def __init__(self, model_path, wrap = None, warm_up_text = WARM_UP_TEXT, **kwargs):
+        """
+        model_path: path to where the GE2PE transformer is saved.
+        wrap: optional callable applied to the loaded GE2PE (e.g. AsyncGE2PE) before it is handed out.
+        warm_up_text: sentence decoded once in the background, so the first real request does not pay for
+                      lazy initialisation inside torch / onnxruntime and requests with a deadline find the decode
+                      rate of the default beam width already timed (see GE2PE.decode_rates).
+        kwargs: any other GE2PE argument.
+        loading starts right away on a background thread; result() blocks until it is done.
+        """
+
+        self.model_path = model_path
+        self.wrap = wrap
+        self.warm_up_text = warm_up_text
+        self.kwargs = kwargs
+        self.times = {}
+        self.future = Future()
+        self.thread = threading.Thread(target=self._run, name='ge2pe-warmup', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            with timed(self.times, 'imports'):
+                from GE2PE import GE2PE
+            g2p = GE2PE(model_path=self.model_path, **self.kwargs)
+            for stage, seconds in g2p.load_times.items():
+                self.times[stage] = self.times.get(stage, 0.0) + seconds
+            with timed(self.times, 'first decode'):
+                g2p.generate([self.warm_up_text], use_rules=True)
+            # the first decode timed lazy initialisation too; time the default width again without it
+            with timed(self.times, 'rate seeding'):
+                g2p.decode_rates.clear()
+                g2p.generate([self.warm_up_text], use_rules=True)
+            self.future.set_result(self.wrap(g2p) if self.wrap is not None else g2p)
+        except BaseException as e:
+            self.future.set_exception(e)
+
+    def ready(self):
+        return self.future.done()
+
+    def result(self, timeout = None):
+        return self.future.result(timeout)
+
+    def report(self):
+        """
+        returns a markdown table of where the startup time went (imports, weights, tokenizer, normalizer, first decode,
+        rate seeding).
+        """
+        lines = ['| stage | seconds |', '|---|---|']
+        for stage, seconds in self.times.items():
+            lines.append(f'| {stage} | {seconds:.2f} |')
+        lines.append(f'| total | {sum(self.times.values()):.2f} |')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load GE2PE the way the app does and report where the startup time goes.')
+    parser.add_argument('model_path')
+    parser.add_argument('--backend', default='torch')
+    parser.add_argument('--precision', default='fp32')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    warmup = Warmup(args.model_path, backend=args.backend, precision=args.precision)
+    warmup.result()
+    print(warmup.report())
+    print(f'\nwall clock {time.perf_counter() - start:.2f}s, modules loaded: {len(sys.modules)}')
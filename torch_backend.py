@@ -0,0 +1,88 @@
+import math
+import time
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from decoding import is_repeating
+from quantize import load_model, read_token_map
+
+
+class DecodeLimits(StoppingCriteria):
+    """
+    per-row stopping for model.generate: a row stops once it reaches the token budget of its own input,
+    or once its tail degenerates into a short repeated pattern, without holding up the rest of the batch;
+    all rows stop together once the deadline passes.
+    """
+
+    def __init__(self, limits, repeat_window = None, deadline = None):
+        """ deadline: time.monotonic() value from which every row stops, keeping what it decoded so far. """
+        self.limits = torch.tensor(limits)
+        self.repeat_window = repeat_window
+        self.deadline = deadline
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return torch.ones(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        # beam search passes batch * beams rows, grouped by input
+        rows_per_input = input_ids.shape[0] // len(self.limits)
+        limits = self.limits.to(input_ids.device).repeat_interleave(rows_per_input)
+        done = input_ids.shape[1] - 1 >= limits
+        if self.repeat_window is not None and input_ids.shape[1] > self.repeat_window:
+            for row, tokens in enumerate(input_ids[:, -self.repeat_window:].tolist()):
+                if not done[row] and is_repeating(tokens, self.repeat_window):
+                    done[row] = True
+        return done
+
+
+class TorchBackend():
+    """ runs the T5 through HuggingFace model.generate with PyTorch. """
+
+    tensor_type = 'pt'
+
+    def __init__(self, model_path, precision = 'fp32', GPU = False):
+        if precision == 'int8' and GPU:
+            raise ValueError("int8 precision is only supported on CPU")
+        self.GPU = GPU
+        self.model = load_model(model_path, precision)
+        if self.GPU:
+            self.model = self.model.cuda()
+        # a checkpoint with a pruned output vocabulary decodes its own ids; they are mapped back for the tokenizer
+        token_map = read_token_map(model_path)
+        self.output_ids = None if token_map is None else torch.tensor(token_map['output_ids'], device=self.model.device)
+
+    def generate(self, input_ids, attention_mask, num_beams, limits, repeat_window = None, deadline = None):
+        """
+        input_ids, attention_mask: padded batch as returned by the tokenizer.
+        limits: maximum number of output tokens of every row.
+        deadline: optional time.monotonic() value at which decoding stops with the best hypotheses so far.
+        returns the output token ids, one row per input.
+        """
+        stopping = StoppingCriteriaList([DecodeLimits(limits, repeat_window, deadline)])
+        if self.GPU:
+            input_ids, attention_mask = input_ids.cuda(), attention_mask.cuda()
+        out_ids = self.model.generate(input_ids, attention_mask=attention_mask, num_beams=num_beams,
+                                      min_length= 1, max_length=max(limits) + 1, early_stopping=True, stopping_criteria=stopping,)
+        return out_ids if self.output_ids is None else self.output_ids[out_ids]
+
+    def generate_with_confidence(self, input_ids, attention_mask, limits, repeat_window = None):
+        """
+        greedy decoding of a padded batch, as generate with num_beams=1.
+        returns (output token ids, confidence of every row): the probability the model gave to the least certain
+        token it emitted, eos included.
+        """
+        stopping = StoppingCriteriaList([DecodeLimits(limits, repeat_window)])
+        if self.GPU:
+            input_ids, attention_mask = input_ids.cuda(), attention_mask.cuda()
+        out = self.model.generate(input_ids, attention_mask=attention_mask, num_beams=1, min_length=1,
+                                  max_length=max(limits) + 1, stopping_criteria=stopping, output_scores=True,
+                                  return_dict_in_generate=True)
+        sequences = out.sequences
+        # log-probability of the chosen token at every step, (rows, steps)
+        chosen = torch.stack([torch.log_softmax(scores.float(), dim=-1).gather(1, sequences[:, step + 1:step + 2])[:, 0]
+                              for step, scores in enumerate(out.scores)], dim=1)
+        ends = (self.model.config.eos_token_id, self.model.config.pad_token_id)
+        confidences = []
+        for row, logprobs in zip(sequences[:, 1:].tolist(), chosen.tolist()):
+            # finished rows are padded; the row ends with its eos or its last token before padding
+            length = next((k + (token != ends[1]) for k, token in enumerate(row) if token in ends), len(row))
+            confidences.append(math.exp(min(logprobs[:length])) if length else 1.0)
+        return (sequences if self.output_ids is None else self.output_ids[sequences]), confidences